@@ -8,7 +8,11 @@ import os
 import subprocess
 import sys
 
+from consumer import PullConsumer, add_follow_arguments
+from dedupe import DEFAULT_SEEN_DB, SeenSet, message_key
+from metrics import MESSAGES, STEP_SECONDS, add_metrics_arguments, metrics_exporter
 from models import Task
+from publisher import BatchPublisher
 
 logger = logging.getLogger(__name__)
 
@@ -43,6 +47,7 @@ async def add_reminder(task: Task, reminder_list: str):
 
 async def main():
     default_nats = os.environ.get("NATS", "nats://localhost:4222")
+    default_seen_db = os.environ.get("SEEN_DB", DEFAULT_SEEN_DB)
 
     parser = argparse.ArgumentParser(
         description="Add reminders for tasks from emails",
@@ -55,10 +60,18 @@ async def main():
                         help="NATS consumer name")
     parser.add_argument("--reminder-list", default="Automatic",
                         help="List to add reminders to")
+    parser.add_argument("--dedupe", action=argparse.BooleanOptionalAction,
+                        help="Skip tasks that reminders have already been added for")
+    parser.add_argument("--seen-db", default=default_seen_db,
+                        help="SQLite file to record added reminders in for --dedupe")
+    parser.add_argument("--fetch-batch", type=int, default=10,
+                        help="Number of messages to fetch at a time")
     parser.add_argument("--limit", type=int, default=-1,
                         help="Number of messages to process (-1 for all)")
     parser.add_argument("--debug", action=argparse.BooleanOptionalAction,
                         help="Enable debug logging")
+    add_metrics_arguments(parser)
+    add_follow_arguments(parser)
     args = parser.parse_args()
 
     if args.debug:
@@ -73,28 +86,52 @@ async def main():
     psub = await js.pull_subscribe("", stream=args.nats_stream,
                                    durable=args.nats_consumer)
 
-    count = args.limit
-    while count != 0:
-        count -= 1
-
-        try:
-            msgs = await psub.fetch(batch=1, timeout=2)
-            if not msgs:
-                logger.debug("No messages available, exiting")
-                break
-
-            for msg in msgs:
-                await msg.ack()
-
-                task = Task.model_validate_json(msg.data.decode())
-                logger.debug("Received task %s", task)
-
+    seen = None
+    if args.dedupe:
+        logger.debug("Recording added reminders in %s", args.seen_db)
+        seen = SeenSet(args.seen_db, stage="reminders")
+
+    # Acks are sent in batches, once the reminder has been added
+    publisher = BatchPublisher(nc, max_batch=args.fetch_batch, stage="reminders")
+
+    exporter = metrics_exporter(args, nc)
+    reminder_seconds = STEP_SECONDS.labels("reminders", "reminder")
+    processed = MESSAGES.labels("reminders", "processed")
+    duplicates = MESSAGES.labels("reminders", "duplicate")
+
+    consumer = PullConsumer(psub, batch=args.fetch_batch, timeout=2,
+                            limit=args.limit, follow=args.follow,
+                            max_batch=args.max_fetch_batch, max_idle=args.max_idle,
+                            stage="reminders")
+    consumer.stop_on_signals()
+
+    async for msgs in consumer.batches():
+        for msg in msgs:
+            task = Task.model_validate_json(msg.data.decode())
+            logger.debug("Received task %s", task)
+
+            # Tasks are keyed by the message ID they were published with,
+            # which identifies the email they are for
+            key = message_key(msg)
+            if seen is not None and not seen.claim(key):
+                logger.info("Skipping duplicate task %s", key)
+                duplicates.inc()
+                await publisher.ack(msg)
+                continue
+
+            with reminder_seconds.time():
                 await add_reminder(task, args.reminder_list)
-
-        except nats.errors.TimeoutError:
-            logger.debug("Timeout waiting for messages, exiting")
-            break
-
+            await publisher.ack(msg)
+            processed.inc()
+            if seen is not None:
+                seen.add(key)
+
+    await publisher.close()
+    if seen is not None:
+        logger.info("Dedupe: %(duplicates)d of %(checked)d tasks skipped as duplicates",
+                    seen.stats())
+        seen.close()
+    await exporter.close()
     await nc.close()
 
 if __name__ == "__main__":
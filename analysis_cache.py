@@ -0,0 +1,111 @@
+import abc
+import hashlib
+import json
+import logging
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+def cache_key(model_id: str, prompt_tag: str, prompt: str, response_schema) -> str:
+    """Generate a cache key for a model response"""
+    schema = json.dumps(response_schema.model_json_schema(), sort_keys=True)
+    h = hashlib.sha256()
+    for part in (model_id, prompt_tag, prompt, schema):
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+class ResultCache(abc.ABC):
+    """Base class for caches of analysis results"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached value for the key, or None if not cached"""
+        pass
+
+    @abc.abstractmethod
+    def put(self, key: str, value: str):
+        """Store a value in the cache"""
+        pass
+
+    def close(self):
+        """Release any resources held by the cache"""
+        pass
+
+    def stats(self) -> dict[str, int]:
+        """Return the hit and miss counters"""
+        return {"hits": self.hits, "misses": self.misses}
+
+class SQLiteCache(ResultCache):
+    """Result cache stored in an SQLite database
+
+    Entries older than `ttl` seconds are treated as misses, and the least
+    recently used entries are evicted once there are more than
+    `max_entries` in the cache.
+    """
+
+    def __init__(self, path: str | Path, ttl: Optional[float] = None,
+                 max_entries: Optional[int] = None):
+        super().__init__()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        path = Path(path).expanduser()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS results (
+                               key TEXT PRIMARY KEY,
+                               value TEXT NOT NULL,
+                               created REAL NOT NULL,
+                               accessed REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT value, created FROM results WHERE key = ?",
+                                  (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.db.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str):
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                            (key, value, now, now))
+            if self.max_entries is not None:
+                self.evict()
+
+    def evict(self):
+        """Evict expired and least recently used entries"""
+        if self.ttl is not None:
+            self.db.execute("DELETE FROM results WHERE created < ?",
+                            (time.time() - self.ttl,))
+        excess = self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0] - self.max_entries
+        if excess > 0:
+            logger.debug("Evicting %d cache entries", excess)
+            self.db.execute("""DELETE FROM results WHERE key IN (
+                                   SELECT key FROM results ORDER BY accessed LIMIT ?)""",
+                            (excess,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,170 @@
+# Parsing and publishing of raw email messages, shared by the mail-archiver
+# MDA and the resident archiver daemon.
+
+import asyncio
+from concurrent.futures import Executor
+from datetime import datetime
+import io
+import logging
+import time
+from typing import Optional
+
+from dedupe import SeenSet, msg_id_headers
+from fast_parser import (email_data, header_fields, message_attachments, message_id,
+                         needs_unstructured, parse_headers, parse_message)
+from metrics import MESSAGES, STEP_SECONDS
+from models import EmailData, EmailParseError
+from ocr import AttachmentStore
+from wire import EMAIL_SEQ_HEADER, EMAIL_STREAM_HEADER, WireFormat, header_record
+
+logger = logging.getLogger(__name__)
+
+# Parser backends: the stdlib-based fast parser, unstructured, or a choice
+# between the two per email
+PARSERS = ("fast", "unstructured", "auto")
+
+PARSE_SECONDS = STEP_SECONDS.labels("archive", "parse")
+PUBLISH_SECONDS = STEP_SECONDS.labels("archive", "publish")
+ARCHIVED = MESSAGES.labels("archive", "processed")
+DUPLICATES = MESSAGES.labels("archive", "duplicate")
+FAILED = MESSAGES.labels("archive", "error")
+
+def render_body(elements) -> str:
+    """Render the text of the parsed elements as the email body"""
+    body = io.StringIO()
+    separator = ""
+    for el in elements:
+        body.write(separator)
+        body.write(el.text)
+        separator = "\n\n"
+    return body.getvalue()
+
+def load_unstructured():
+    """Import the unstructured email partitioner, which is slow to import"""
+    from unstructured.partition.email import partition_email
+    return partition_email
+
+def parse_email_unstructured(email: bytes) -> EmailData:
+    """Parse a raw email message using unstructured"""
+    partition_email = load_unstructured()
+
+    # Parse email using unstructured, straight from memory
+    elements = partition_email(file=io.BytesIO(email))
+
+    # The headers are parsed as by the fast parser, so that both backends
+    # give the same addresses, date and message_id
+    return EmailData(**header_fields(parse_headers(email)), body=render_body(elements))
+
+def parse_email(email: bytes, parser: str = "unstructured") -> EmailData:
+    """Parse a raw email message with the given parser backend
+
+    With the "auto" backend, emails are parsed with the fast parser unless
+    their MIME tree contains images or documents that need unstructured.
+    """
+    if parser == "unstructured":
+        return parse_email_unstructured(email)
+
+    message = parse_message(email)
+    if parser == "auto" and needs_unstructured(message):
+        logger.debug("Parsing email %s with unstructured", message.get("Message-ID"))
+        return parse_email_unstructured(email)
+    return email_data(message)
+
+def parse_email_deferred(email: bytes, store: AttachmentStore) -> EmailData:
+    """Parse a raw email with the fast parser, storing its attachments
+
+    The text of images and documents is extracted later by the OCR stage,
+    from the attachments in `store` referenced by the email data.
+    """
+    message = parse_message(email)
+    data = email_data(message)
+    data.attachments = [store.put(filename, content_type, content)
+                        for filename, content_type, content in message_attachments(message)]
+    return data
+
+def parse_email_timed(email: bytes, parser: str = "unstructured") -> tuple[EmailData, float]:
+    """Parse a raw email, also returning the time taken to parse it"""
+    start = time.perf_counter()
+    data = parse_email(email, parser)
+    return data, time.perf_counter() - start
+
+async def archive(nc, email: bytes, sender: str, subject: str, error_subject: str,
+                  executor: Optional[Executor] = None, parser: str = "unstructured",
+                  seen: Optional[SeenSet] = None,
+                  attachments: Optional[AttachmentStore] = None,
+                  attachment_subject: str = "email.attachments",
+                  wire: Optional[WireFormat] = None,
+                  header_subject: Optional[str] = None):
+    """Parse a raw email and publish it to NATS
+
+    The email is parsed on `executor` (the default executor if None) so that
+    the event loop keeps servicing NATS while parsing. Parse errors are
+    published to `error_subject` instead. Emails are published with their
+    message_id as the JetStream message ID, and emails whose Message-ID is
+    already in `seen` are skipped without being parsed.
+
+    With an attachment store, emails are parsed with the fast parser and
+    their images and documents are stored for the OCR stage instead of being
+    parsed by `parser`. Emails with such attachments are published through
+    JetStream to `attachment_subject` for the OCR stage instead of to
+    `subject`, and enter the pipeline once their text has been extracted.
+
+    Emails are published as JSON, or encoded by `wire` if given.
+
+    With a `header_subject`, emails are published through JetStream, and
+    their header record is also published through JetStream to
+    `header_subject`, with the stream sequence of the full email so that it
+    can be fetched if needed.
+    """
+    key = message_id(email)
+    if seen is not None and not seen.claim(key):
+        logger.info("Skipping duplicate email %s from %s", key, sender)
+        DUPLICATES.inc()
+        return
+
+    try:
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        if attachments is not None:
+            data = await loop.run_in_executor(executor, parse_email_deferred, email,
+                                              attachments)
+        else:
+            data = await loop.run_in_executor(executor, parse_email, email, parser)
+        PARSE_SECONDS.observe(time.perf_counter() - start)
+
+        # Publish parsed email data to NATS
+        start = time.perf_counter()
+        if wire is not None:
+            payload, headers = await wire.encode(data)
+        else:
+            payload, headers = data.model_dump_json().encode(), None
+        if data.attachments:
+            # The email is held back from the pipeline until the OCR stage
+            # publishes it with the text of its attachments
+            await nc.jetstream().publish(
+                attachment_subject, payload,
+                headers=msg_id_headers(attachment_subject, data.message_id, headers))
+        elif header_subject is not None:
+            ack = await nc.jetstream().publish(
+                subject, payload, headers=msg_id_headers(subject, data.message_id, headers))
+            record_headers = {EMAIL_STREAM_HEADER: ack.stream, EMAIL_SEQ_HEADER: str(ack.seq)}
+            await nc.jetstream().publish(
+                header_subject, header_record(data).model_dump_json().encode(),
+                headers=msg_id_headers(header_subject, data.message_id, record_headers))
+        else:
+            await nc.publish(subject, payload,
+                             headers=msg_id_headers(subject, data.message_id, headers))
+        PUBLISH_SECONDS.observe(time.perf_counter() - start)
+        ARCHIVED.inc()
+        if seen is not None:
+            seen.add(key)
+
+    except Exception as e:
+        logger.error("Error archiving email from %s: %s", sender, e)
+        FAILED.inc()
+        if seen is not None:
+            seen.release(key)
+
+        # Publish error to NATS
+        error = EmailParseError(sender=sender, date=str(datetime.now()), error=str(e))
+        await nc.publish(error_subject, error.model_dump_json().encode())
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Compares the original temporary-file parsing path of the archiver with the
+# in-memory path, on a corpus of large MIME messages with attachments.
+
+import argparse
+from email.message import EmailMessage
+from pathlib import Path
+import random
+import statistics
+import sys
+from tempfile import NamedTemporaryFile
+import time
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from archiver import parse_email
+from unstructured.partition.email import partition_email
+
+def make_email(i: int, paragraphs: int, attachments: int, attachment_size: int) -> bytes:
+    """Generate a multipart email with a large body and binary attachments"""
+    rng = random.Random(i)
+    words = ["invoice", "payment", "due", "meeting", "report", "account",
+             "statement", "delivery", "order", "reminder", "update", "please"]
+
+    msg = EmailMessage()
+    msg["From"] = f"sender{i}@example.com"
+    msg["To"] = "me@example.com"
+    msg["Subject"] = f"Benchmark email {i}"
+    msg["Date"] = "Sat, 22 Feb 2025 09:07:27 +0000"
+    msg["Message-ID"] = f"<bench{i}@example.com>"
+
+    text = "\n\n".join(" ".join(rng.choices(words, k=80)) for _ in range(paragraphs))
+    msg.set_content(text)
+    msg.add_alternative("".join(f"<p>{p}</p>" for p in text.split("\n\n")), subtype="html")
+    for j in range(attachments):
+        msg.add_attachment(rng.randbytes(attachment_size), maintype="application",
+                           subtype="octet-stream", filename=f"attachment{j}.bin")
+    return msg.as_bytes()
+
+def parse_email_tempfile(email: bytes, tmpdir: str | None) -> str:
+    """Original parsing path: write to a temporary file and re-read it"""
+    with NamedTemporaryFile(delete_on_close=False, dir=tmpdir) as f:
+        f.write(email)
+        f.close()
+        elements = partition_email(filename=f.name)
+    return "\n\n".join([str(el) for el in elements])
+
+def parse_email_memory(email: bytes) -> str:
+    """Current parsing path: parse straight from memory"""
+    return parse_email(email).body
+
+def bench(name: str, parse, corpus: list[bytes], rounds: int):
+    times = []
+    for _ in range(rounds):
+        for email in corpus:
+            start = time.perf_counter()
+            parse(email)
+            times.append(time.perf_counter() - start)
+    times.sort()
+    print(f"{name:>10}: mean {statistics.mean(times) * 1000:8.2f}ms  "
+          f"p50 {times[len(times) // 2] * 1000:8.2f}ms  "
+          f"p99 {times[int(len(times) * 0.99)] * 1000:8.2f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark archiver email parsing",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--corpus", type=Path,
+                        help="Directory of .eml files to use instead of generated emails")
+    parser.add_argument("--count", type=int, default=20,
+                        help="Number of emails to generate")
+    parser.add_argument("--paragraphs", type=int, default=50,
+                        help="Paragraphs in the body of each generated email")
+    parser.add_argument("--attachments", type=int, default=3,
+                        help="Attachments in each generated email")
+    parser.add_argument("--attachment-size", type=int, default=1024 * 1024,
+                        help="Size in bytes of each generated attachment")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="Number of times to parse the corpus")
+    parser.add_argument("--tmpdir",
+                        help="Directory for the temporary files of the original path")
+    args = parser.parse_args()
+
+    if args.corpus:
+        corpus = [p.read_bytes() for p in sorted(args.corpus.glob("*.eml"))]
+    else:
+        corpus = [make_email(i, args.paragraphs, args.attachments, args.attachment_size)
+                  for i in range(args.count)]
+    size = sum(len(email) for email in corpus)
+    print(f"Corpus: {len(corpus)} emails, {size / len(corpus) / 1024:.0f} KiB on average")
+
+    # Warm up imports and caches in unstructured
+    parse_email_memory(corpus[0])
+
+    bench("tempfile", lambda email: parse_email_tempfile(email, args.tmpdir),
+          corpus, args.rounds)
+    bench("memory", parse_email_memory, corpus, args.rounds)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+# In-process stand-in for a NATS server with JetStream, for benchmarking the
+# pipeline without a nats-server. It implements the parts of the nats-py
+# client the scripts use: core and JetStream publishes captured by streams,
+# durable pull consumers with ack, nak, term and redelivery, message metadata and
+# fetching a stored message by sequence number.
+
+import asyncio
+from datetime import datetime, timezone
+import time
+from types import SimpleNamespace
+from typing import Optional
+
+import nats.errors
+import nats.js.errors
+
+MSG_ID_HEADER = "Nats-Msg-Id"
+
+def subject_matches(pattern: str, subject: str) -> bool:
+    """Match a subject against a pattern with * and > wildcards"""
+    pattern_tokens, tokens = pattern.split("."), subject.split(".")
+    for i, token in enumerate(pattern_tokens):
+        if token == ">":
+            return len(tokens) > i
+        if i >= len(tokens) or (token != "*" and token != tokens[i]):
+            return False
+    return len(pattern_tokens) == len(tokens)
+
+class StoredMsg:
+    """Message stored in a stream"""
+
+    def __init__(self, stream: str, seq: int, subject: str, data: bytes,
+                 headers: Optional[dict]):
+        self.stream = stream
+        self.seq = seq
+        self.subject = subject
+        self.data = data
+        self.headers = headers
+        self.timestamp = datetime.now(timezone.utc)
+
+class Stream:
+    def __init__(self, name: str, subjects: list[str]):
+        self.name = name
+        self.subjects = subjects
+        self.messages: list[StoredMsg] = []
+        self.msg_ids: set[str] = set()
+        self.consumers: dict[str, "Consumer"] = {}
+        self.duplicates = 0
+
+    def captures(self, subject: str) -> bool:
+        return any(subject_matches(pattern, subject) for pattern in self.subjects)
+
+    def store(self, subject: str, data: bytes, headers: Optional[dict]) -> tuple[int, bool]:
+        """Store a message, returning its sequence and whether it was a duplicate"""
+        msg_id = (headers or {}).get(MSG_ID_HEADER)
+        if msg_id is not None:
+            if msg_id in self.msg_ids:
+                self.duplicates += 1
+                return len(self.messages), True
+            self.msg_ids.add(msg_id)
+        msg = StoredMsg(self.name, len(self.messages) + 1, subject, data, headers)
+        self.messages.append(msg)
+        for consumer in self.consumers.values():
+            consumer.pending.append(msg)
+        return msg.seq, False
+
+class Msg:
+    """Message delivered to a pull consumer"""
+
+    def __init__(self, consumer: "Consumer", stored: StoredMsg, delivered: int):
+        self.consumer = consumer
+        self.stored = stored
+        self.subject = stored.subject
+        self.data = stored.data
+        self.headers = stored.headers
+        self.reply = f"$JS.ACK.{stored.stream}.{consumer.name}.{delivered}.{stored.seq}"
+        self.metadata = SimpleNamespace(
+            timestamp=stored.timestamp, num_delivered=delivered,
+            sequence=SimpleNamespace(stream=stored.seq))
+
+    async def ack(self):
+        self.consumer.acked(self.stored)
+
+    async def nak(self, delay: Optional[float] = None):
+        self.consumer.nakd(self.stored)
+
+    async def term(self):
+        self.consumer.acked(self.stored)
+
+    async def in_progress(self):
+        pass
+
+class Consumer:
+    """Durable pull consumer, delivering each message until it is acked
+
+    Records the time from the first delivery of each message to its ack.
+    """
+
+    def __init__(self, stream: Stream, name: str):
+        self.stream = stream
+        self.name = name
+        self.pending: list[StoredMsg] = list(stream.messages)
+        self.delivered: dict[int, float] = {}
+        self.deliveries: dict[int, int] = {}
+        self.latencies: list[float] = []
+        self.redelivered = 0
+
+    async def fetch(self, batch: int = 1, timeout: Optional[float] = 5) -> list[Msg]:
+        """Fetch up to `batch` messages, with a timeout error if there are none
+
+        The stand-in never waits for messages, as the benchmark only fetches
+        from streams that have been filled.
+        """
+        # Yield to the event loop, like a round trip to the server
+        await asyncio.sleep(0)
+        if not self.pending:
+            raise nats.errors.TimeoutError
+        stored, self.pending = self.pending[:batch], self.pending[batch:]
+        now = time.perf_counter()
+        msgs = []
+        for msg in stored:
+            self.delivered.setdefault(msg.seq, now)
+            self.deliveries[msg.seq] = self.deliveries.get(msg.seq, 0) + 1
+            msgs.append(Msg(self, msg, self.deliveries[msg.seq]))
+        return msgs
+
+    def acked(self, msg: StoredMsg):
+        start = self.delivered.pop(msg.seq, None)
+        if start is not None:
+            self.latencies.append(time.perf_counter() - start)
+
+    def nakd(self, msg: StoredMsg):
+        self.redelivered += 1
+        self.pending.append(msg)
+
+class JetStream:
+    def __init__(self, nc: "StandInNATS"):
+        self.nc = nc
+
+    async def publish(self, subject: str, payload: bytes = b"",
+                      headers: Optional[dict] = None, **kwargs):
+        stream = self.nc.stream_for(subject)
+        if stream is None:
+            raise nats.js.errors.NoStreamResponseError
+        seq, duplicate = stream.store(subject, payload, headers)
+        return SimpleNamespace(stream=stream.name, seq=seq, duplicate=duplicate)
+
+    async def pull_subscribe(self, subject: str, durable: Optional[str] = None,
+                             stream: Optional[str] = None, **kwargs) -> Consumer:
+        return self.nc.consumer(stream, durable)
+
+    async def get_msg(self, stream_name: str, seq: int, **kwargs):
+        stored = self.nc.streams[stream_name].messages[seq - 1]
+        return SimpleNamespace(subject=stored.subject, seq=stored.seq, data=stored.data,
+                               headers=stored.headers)
+
+class StandInNATS:
+    """In-process NATS connection with JetStream streams
+
+    `streams` maps stream names to the subjects they capture. Core
+    publishes to captured subjects are stored too, as with a real server,
+    and publishes to other subjects are dropped.
+    """
+
+    def __init__(self, streams: dict[str, list[str]]):
+        self.streams = {name: Stream(name, subjects) for name, subjects in streams.items()}
+        self.dropped = 0
+
+    async def connect(self, *args, **kwargs) -> "StandInNATS":
+        """Stand-in for nats.connect(), returning this connection"""
+        return self
+
+    def stream_for(self, subject: str) -> Optional[Stream]:
+        for stream in self.streams.values():
+            if stream.captures(subject):
+                return stream
+        return None
+
+    def consumer(self, stream: str, durable: str) -> Consumer:
+        consumers = self.streams[stream].consumers
+        if durable not in consumers:
+            consumers[durable] = Consumer(self.streams[stream], durable)
+        return consumers[durable]
+
+    def jetstream(self, **kwargs) -> JetStream:
+        return JetStream(self)
+
+    async def publish(self, subject: str, payload: bytes = b"",
+                      headers: Optional[dict] = None, **kwargs):
+        stream = self.stream_for(subject)
+        if stream is None:
+            self.dropped += 1
+        else:
+            stream.store(subject, payload, headers)
+
+    async def flush(self, *args, **kwargs):
+        pass
+
+    async def drain(self):
+        pass
+
+    async def close(self):
+        pass
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+
+# End-to-end benchmark of the pipeline: archiving, header analysis, full
+# analysis and reminders, run in-process against a NATS stand-in with a fake
+# model that answers deterministically after a configurable latency. Reports
+# the throughput, p50/p99 latency of each stage and the peak RSS, and can
+# compare them with the results of an earlier run to catch regressions.
+
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from email.message import EmailMessage
+from email.utils import format_datetime
+import hashlib
+import importlib
+import json
+import logging
+import os
+from pathlib import Path
+import random
+import resource
+import sys
+import tempfile
+import time
+from typing import Any, Optional
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+sys.path.append(str(Path(__file__).resolve().parent))
+
+import llm
+import nats
+import yaml
+
+from archiver import PARSERS, archive
+from metrics import REGISTRY
+from model_server import schema_instance
+from models import EmailData
+from nats_stand_in import StandInNATS
+
+DATA_DIR = ROOT / "tests" / "data"
+
+FAKE_MODEL = "bench-fake"
+
+# Streams as set up in the README
+STREAMS = {
+    "emails": ["email.parsed"],
+    "emails_for_analysis": ["email.analyse"],
+    "email_actions": ["email.action"],
+    "email_errors": ["email.error"],
+    "tasks": ["tasks.>"],
+    "notifications": ["notifications.>"],
+    "email_header_analysis": ["email.header_analysis"],
+}
+
+# Stages, with the stream and durable consumer they fetch from
+STAGES = {
+    "archive": None,
+    "header-analysis": ("emails", "email-analyser"),
+    "analysis": ("emails_for_analysis", "email-analyser"),
+    "reminders": ("tasks", "task-reminder"),
+}
+
+FILLER = ["invoice", "payment", "due", "meeting", "report", "account", "statement",
+          "delivery", "order", "reminder", "update", "please", "booking", "ticket",
+          "newsletter", "offer", "review", "schedule", "confirm", "details"]
+
+def fraction(text: str, salt: str) -> float:
+    """Deterministic number in [0, 1) for a text"""
+    digest = hashlib.sha256(f"{salt}:{text}".encode()).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+class FakeBehaviour:
+    """How the fake model responds
+
+    Each response takes `latency` seconds, give or take `jitter` of it.
+    `escalate` is the share of header analyses asking for the full
+    analysis, and `tasks` the share of analyses with a due date.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0,
+                 escalate: float = 0.3, tasks: float = 0.3):
+        self.latency = latency
+        self.jitter = jitter
+        self.escalate = escalate
+        self.tasks = tasks
+
+    def delay(self, prompt: str) -> float:
+        return self.latency * (1 + self.jitter * (2 * fraction(prompt, "delay") - 1))
+
+    def respond(self, prompt: str, schema: Optional[dict]) -> str:
+        due_date = "2025-03-01" if fraction(prompt, "task") < self.tasks else None
+        if schema is None:
+            # The full analysis prompts without a schema, for an EmailAction
+            return json.dumps({"action": "Review the email", "due_date": due_date,
+                               "is_important": fraction(prompt, "important") < 0.2,
+                               "notify": fraction(prompt, "notify") < 0.2})
+
+        data = schema_instance(schema)
+        if isinstance(data, dict) and "needs_analysis" in data:
+            data.update(clean_subject="Benchmark email", due_date=due_date,
+                        is_transactional=due_date is not None,
+                        needs_analysis=fraction(prompt, "escalate") < self.escalate)
+        return json.dumps(data)
+
+class FakeModel(llm.Model):
+    model_id = FAKE_MODEL
+    supports_schema = True
+
+    def __init__(self, behaviour: FakeBehaviour):
+        self.behaviour = behaviour
+
+    def execute(self, prompt, stream, response, conversation):
+        time.sleep(self.behaviour.delay(prompt.prompt))
+        text = self.behaviour.respond(prompt.prompt, prompt.schema)
+        response.set_usage(input=len(prompt.prompt) // 4, output=len(text) // 4)
+        yield text
+
+class FakeAsyncModel(llm.AsyncModel):
+    model_id = FAKE_MODEL
+    supports_schema = True
+
+    def __init__(self, behaviour: FakeBehaviour):
+        self.behaviour = behaviour
+
+    async def execute(self, prompt, stream, response, conversation):
+        await asyncio.sleep(self.behaviour.delay(prompt.prompt))
+        text = self.behaviour.respond(prompt.prompt, prompt.schema)
+        response.set_usage(input=len(prompt.prompt) // 4, output=len(text) // 4)
+        yield text
+
+class FakeModelPlugin:
+    """llm plugin registering the fake model"""
+
+    def __init__(self, behaviour: FakeBehaviour):
+        self.behaviour = behaviour
+
+    @llm.hookimpl
+    def register_models(self, register):
+        register(FakeModel(self.behaviour), FakeAsyncModel(self.behaviour))
+
+def register_fake_model(behaviour: FakeBehaviour):
+    """Make the fake model available to llm.get_model() as FAKE_MODEL"""
+    from llm.plugins import pm
+    if pm.get_plugin(FAKE_MODEL) is not None:
+        pm.unregister(name=FAKE_MODEL)
+    pm.register(FakeModelPlugin(behaviour), name=FAKE_MODEL)
+
+def load_fixtures() -> list[EmailData]:
+    fixtures = []
+    for path in sorted(DATA_DIR.glob("*.yaml")):
+        with open(path) as f:
+            fixtures.append(EmailData.model_validate(yaml.safe_load(f)["email"]))
+    return fixtures
+
+def body_words(rng: random.Random, median: int, sigma: float, maximum: int) -> int:
+    """Draw a body length from a log-normal distribution around `median` words"""
+    return min(maximum, max(1, round(rng.lognormvariate(0, sigma) * median)))
+
+def raw_email(email: EmailData, i: int, words: int, rng: random.Random) -> bytes:
+    """Generate a raw email from a fixture, with its body padded to `words` words"""
+    msg = EmailMessage()
+    msg["From"] = email.from_[0] if email.from_ else "sender@example.com"
+    msg["To"] = ", ".join(email.to) or "me@example.com"
+    msg["Subject"] = email.subject
+    try:
+        msg["Date"] = format_datetime(datetime.fromisoformat(email.date))
+    except ValueError:
+        msg["Date"] = format_datetime(datetime(2025, 2, 22, 9, 7, 27))
+    msg["Message-ID"] = f"<bench-{i}@example.com>"
+    for name, value in email.headers.items():
+        msg[name] = value
+
+    vocabulary = email.body.split() + FILLER
+    body = email.body.split()
+    paragraphs = [email.body.strip()]
+    while len(body) < words:
+        paragraph = rng.choices(vocabulary, k=min(80, words - len(body)))
+        body.extend(paragraph)
+        paragraphs.append(" ".join(paragraph))
+    msg.set_content("\n\n".join(paragraphs))
+    return msg.as_bytes()
+
+def make_corpus(args) -> list[bytes]:
+    rng = random.Random(args.seed)
+    fixtures = load_fixtures()
+    return [raw_email(fixtures[i % len(fixtures)], i,
+                      body_words(rng, args.body_words, args.body_sigma, args.max_body_words),
+                      rng)
+            for i in range(args.count)]
+
+def percentile(values: list[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def peak_rss() -> int:
+    """Peak resident set size of the process in bytes"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def stage_result(latencies: list[float], seconds: float) -> dict[str, Any]:
+    return {
+        "messages": len(latencies),
+        "seconds": round(seconds, 4),
+        "throughput": round(len(latencies) / seconds, 2) if seconds else None,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "peak_rss": peak_rss(),
+    }
+
+async def run_archive(nc: StandInNATS, corpus: list[bytes], args) -> dict[str, Any]:
+    """Archive the corpus as the archiver daemon does, `workers` at a time"""
+    pool = ThreadPoolExecutor(max_workers=args.archive_workers)
+    semaphore = asyncio.Semaphore(args.archive_workers)
+    latencies = []
+
+    async def archive_one(email: bytes):
+        async with semaphore:
+            start = time.perf_counter()
+            await archive(nc, email, "bench@example.com", "email.parsed", "email.error",
+                          executor=pool, parser=args.parser)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(archive_one(email) for email in corpus))
+    seconds = time.perf_counter() - start
+    pool.shutdown()
+    return stage_result(latencies, seconds)
+
+async def run_script(nc: StandInNATS, stage: str, script: str,
+                     argv: list[str]) -> dict[str, Any]:
+    """Run a consumer script until its stream is empty"""
+    module = importlib.import_module(script)
+    if hasattr(module, "logger"):
+        module.logger.setLevel(logging.getLogger().level)
+
+    sys.argv = [f"{script}.py", *argv]
+    start = time.perf_counter()
+    await module.main()
+    seconds = time.perf_counter() - start
+
+    stream, durable = STAGES[stage]
+    consumer = nc.consumer(stream, durable)
+    return stage_result(consumer.latencies, seconds)
+
+def fake_reminders_command(directory: str):
+    """Put a `reminders` command that does nothing on the PATH"""
+    path = Path(directory) / "reminders"
+    path.write_text("#!/bin/sh\nexit 0\n")
+    path.chmod(0o755)
+    os.environ["PATH"] = f"{directory}{os.pathsep}{os.environ['PATH']}"
+
+async def run_pipeline(args) -> dict[str, Any]:
+    register_fake_model(FakeBehaviour(latency=args.latency, jitter=args.jitter,
+                                      escalate=args.escalate, tasks=args.tasks))
+    corpus = make_corpus(args)
+    nc = StandInNATS(STREAMS)
+
+    fetch = ["--fetch-batch", str(args.fetch_batch), "--limit", "-1"]
+    results: dict[str, Any] = {}
+    connect, argv = nats.connect, sys.argv
+    nats.connect = nc.connect
+    try:
+        results["archive"] = await run_archive(nc, corpus, args)
+        header_argv = ["--model", FAKE_MODEL, "--workers", str(args.workers), *fetch]
+        if not args.preclassify:
+            header_argv.append("--no-preclassify")
+        results["header-analysis"] = await run_script(
+            nc, "header-analysis", "mail-headers-analyse", header_argv)
+        results["analysis"] = await run_script(
+            nc, "analysis", "mail-analyse", ["--model", FAKE_MODEL, *fetch])
+        with tempfile.TemporaryDirectory() as directory:
+            fake_reminders_command(directory)
+            results["reminders"] = await run_script(nc, "reminders", "add-reminders", fetch)
+    finally:
+        nats.connect, sys.argv = connect, argv
+
+    return {
+        "corpus": {"emails": len(corpus),
+                   "bytes": sum(len(email) for email in corpus)},
+        "stages": results,
+        "steps": REGISTRY.summary().get("mail_step_seconds", []),
+        "peak_rss": peak_rss(),
+    }
+
+def regressions(results: dict[str, Any], baseline: dict[str, Any],
+                tolerance: float) -> list[str]:
+    """Compare the throughput and p99 latency of each stage with a baseline"""
+    found = []
+    for stage, base in baseline["stages"].items():
+        current = results["stages"].get(stage)
+        if current is None:
+            continue
+        if base["throughput"] and current["throughput"] is not None \
+                and current["throughput"] < base["throughput"] * (1 - tolerance):
+            found.append(f"{stage}: throughput {current['throughput']}/s, "
+                         f"baseline {base['throughput']}/s")
+        if base["p99"] and current["p99"] is not None \
+                and current["p99"] > base["p99"] * (1 + tolerance):
+            found.append(f"{stage}: p99 {current['p99'] * 1000:.1f}ms, "
+                         f"baseline {base['p99'] * 1000:.1f}ms")
+    return found
+
+def format_ms(seconds: Optional[float]) -> str:
+    return f"{seconds * 1000:9.1f}ms" if seconds is not None else f"{'-':>11}"
+
+def print_results(results: dict[str, Any]):
+    corpus = results["corpus"]
+    print(f"Corpus: {corpus['emails']} emails, {corpus['bytes'] / 1024 / 1024:.1f} MiB")
+    for stage, result in results["stages"].items():
+        throughput = result["throughput"] or 0
+        print(f"{stage:>16}: {result['messages']:6d} messages in {result['seconds']:7.2f}s "
+              f"{throughput:9.1f}/s  p50 {format_ms(result['p50'])}  "
+              f"p99 {format_ms(result['p99'])}  "
+              f"peak RSS {result['peak_rss'] / 1024 / 1024:7.1f} MiB")
+    for step in results["steps"]:
+        if not step["count"]:
+            continue
+        print(f"{step['stage']:>24} {step['step']:<9} {step['count']:6d}  "
+              f"p50 <= {step['p50']}s  p99 <= {step['p99']}s")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline end to end with a fake model",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--count", type=int, default=500,
+                        help="Number of emails to generate from the test fixtures")
+    parser.add_argument("--body-words", type=int, default=300,
+                        help="Median number of words in a body")
+    parser.add_argument("--body-sigma", type=float, default=1.0,
+                        help="Spread of the log-normal distribution of body lengths")
+    parser.add_argument("--max-body-words", type=int, default=20000,
+                        help="Maximum number of words in a body")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for generating the corpus")
+    parser.add_argument("--parser", choices=PARSERS, default="fast",
+                        help="Email parser for the archiver")
+    parser.add_argument("--archive-workers", type=int, default=4,
+                        help="Number of emails to archive concurrently")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Number of emails to analyse headers of concurrently")
+    parser.add_argument("--fetch-batch", type=int, default=50,
+                        help="Number of messages the consumers fetch at a time")
+    parser.add_argument("--preclassify", action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help="Classify obvious bulk email using rules instead of the model")
+    parser.add_argument("--latency", type=float, default=0.01,
+                        help="Seconds the fake model takes to respond")
+    parser.add_argument("--jitter", type=float, default=0.5,
+                        help="Variation of the fake model latency, as a fraction of it")
+    parser.add_argument("--escalate", type=float, default=0.3,
+                        help="Share of header analyses that ask for the full analysis")
+    parser.add_argument("--tasks", type=float, default=0.3,
+                        help="Share of analyses with a due date, which become reminders")
+    parser.add_argument("--output", type=Path,
+                        help="JSON file to write the results to")
+    parser.add_argument("--baseline", type=Path,
+                        help="JSON results of an earlier run to check for regressions")
+    parser.add_argument("--max-regression", type=float, default=0.25,
+                        help="Fraction by which throughput may drop or p99 latency may "
+                             "grow from the baseline")
+    parser.add_argument("--debug", action=argparse.BooleanOptionalAction,
+                        help="Enable debug logging")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.WARNING,
+        format="%(asctime)s [%(levelname)s] %(message)s")
+
+    results = asyncio.run(run_pipeline(args))
+    print_results(results)
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+    if args.baseline:
+        found = regressions(results, json.loads(args.baseline.read_text()),
+                            args.max_regression)
+        for regression in found:
+            print(f"Regression: {regression}")
+        if found:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# Compares the wire encodings of emails published on NATS with plain JSON:
+# serialisation and deserialisation time, and bytes on the wire with and
+# without storing large bodies in the Object Store.
+
+import argparse
+from pathlib import Path
+import random
+import statistics
+import sys
+import time
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import yaml
+
+from fast_parser import email_data, html_to_text, parse_message
+from models import EmailData
+from wire import ENCODINGS, WireFormatError, decode_payload, encode_payload
+
+DATA_DIR = Path(__file__).resolve().parents[1] / "tests" / "data"
+
+def make_email(i: int, paragraphs: int) -> EmailData:
+    """Generate an email with the body of an HTML-heavy newsletter"""
+    rng = random.Random(i)
+    words = ["invoice", "payment", "due", "meeting", "report", "account",
+             "statement", "delivery", "order", "reminder", "update", "please",
+             "https://example.com/track?id=" + str(rng.randrange(10 ** 9))]
+    html = "".join(
+        f"<table><tr><td><a href='https://example.com/{j}'>"
+        f"{' '.join(rng.choices(words, k=rng.randrange(20, 120)))}</a></td></tr></table>"
+        for j in range(paragraphs))
+    return EmailData(
+        from_=[f"News <news{i % 5}@example.com>"],
+        to=["me@example.com"],
+        subject=f"Benchmark newsletter {i}",
+        date="2025-02-22T09:07:27+00:00",
+        message_id=f"<bench{i}@example.com>",
+        body=html_to_text(html),
+        headers={"List-Id": "<news.example.com>",
+                 "List-Unsubscribe": "<https://example.com/unsubscribe>"},
+    )
+
+def load_corpus(args) -> list[EmailData]:
+    if args.corpus:
+        return [email_data(parse_message(p.read_bytes()))
+                for p in sorted(args.corpus.glob("*.eml"))]
+    corpus = []
+    for path in sorted(DATA_DIR.glob("*.yaml")):
+        with open(path) as f:
+            corpus.append(EmailData.model_validate(yaml.safe_load(f)["email"]))
+    corpus.extend(make_email(i, args.paragraphs) for i in range(args.count))
+    return corpus
+
+def bench(encoding: str, corpus: list[dict], rounds: int, claim_check_bytes: int,
+          baseline: float | None) -> float:
+    encode_times, decode_times = [], []
+    sizes = []
+    for _ in range(rounds):
+        sizes = []
+        for data in corpus:
+            if claim_check_bytes and len(data["body"].encode()) > claim_check_bytes:
+                data = {**data, "body": ""}
+            start = time.perf_counter()
+            payload = encode_payload(data, encoding)
+            encode_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            decode_payload(payload, encoding)
+            decode_times.append(time.perf_counter() - start)
+            sizes.append(len(payload))
+
+    total = sum(sizes)
+    ratio = f"{total / baseline:6.1%}" if baseline else "      "
+    print(f"{encoding:>14}: encode {statistics.mean(encode_times) * 1e6:8.1f}us  "
+          f"decode {statistics.mean(decode_times) * 1e6:8.1f}us  "
+          f"{total / len(sizes) / 1024:8.2f} KiB/email  {ratio} of JSON  "
+          f"max {max(sizes) / 1024:8.1f} KiB")
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the wire encodings of emails",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--corpus", type=Path,
+                        help="Directory of .eml files to use instead of the test data "
+                             "and generated emails")
+    parser.add_argument("--count", type=int, default=50,
+                        help="Number of emails to generate")
+    parser.add_argument("--paragraphs", type=int, default=60,
+                        help="Paragraphs in the body of each generated email")
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="Number of times to encode the corpus")
+    parser.add_argument("--claim-check-bytes", type=int, default=16 * 1024,
+                        help="Body size above which bodies are left out of the message "
+                             "in the claim check comparison")
+    args = parser.parse_args()
+
+    corpus = [email.model_dump(mode="json") for email in load_corpus(args)]
+    bodies = [len(data["body"].encode()) for data in corpus]
+    print(f"Corpus: {len(corpus)} emails, bodies {statistics.mean(bodies) / 1024:.1f} KiB "
+          f"on average, {max(bodies) / 1024:.1f} KiB at most")
+
+    for claim_check_bytes in (0, args.claim_check_bytes):
+        if claim_check_bytes:
+            stored = sum(size > claim_check_bytes for size in bodies)
+            print(f"\nWith bodies over {claim_check_bytes} bytes in the Object Store "
+                  f"({stored} of {len(corpus)} emails):")
+        baseline = None
+        for encoding in ENCODINGS:
+            try:
+                total = bench(encoding, corpus, args.rounds, claim_check_bytes, baseline)
+            except WireFormatError as e:
+                print(f"{encoding:>14}: skipped, {e}")
+                continue
+            if encoding == "json":
+                baseline = total
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# Reduction of email bodies before full-email analysis. Strips quoted replies,
+# signatures and boilerplate, drops repeated paragraphs and, if the body is
+# still over its token budget, keeps the sentences most likely to matter.
+
+import logging
+import re
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Token budgets for the email body, per model
+TOKEN_BUDGETS = {
+    "mlx-community/Llama-3.2-3B-Instruct-4bit": 1000,
+}
+DEFAULT_TOKEN_BUDGET = 2000
+
+# Approximate characters per token, for models without a known tokenizer
+CHARS_PER_TOKEN = 4
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Lines that start a quoted reply or forwarded message
+QUOTE_HEADER = re.compile(
+    r"^\s*(On .{5,200} wrote:|-{2,}\s*Original Message\s*-{2,}|"
+    r"-{2,}\s*Forwarded message\s*-{2,}|From: .+\n\s*(Sent|Date): .+)\s*$",
+    re.IGNORECASE | re.MULTILINE)
+
+# Lines and sentences that are boilerplate rather than content
+BOILERPLATE = re.compile(
+    r"unsubscribe|copyright|\u00a9|manage (your )?(email )?preferences|view (this email )?in (your )?browser|"
+    r"privacy policy|all rights reserved|this (e-?mail|message) (and any attachments )?"
+    r"(is|may be) confidential|intended (solely )?for the (named )?recipient|"
+    r"this email was sent to|you are receiving this|sent from my (iphone|ipad|android)",
+    re.IGNORECASE)
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+")
+
+# Signals that a sentence mentions a date or asks for something to be done
+DATE_PATTERN = re.compile(
+    r"\b(\d{1,4}[-/.]\d{1,2}([-/.]\d{1,4})?|\d{1,2}(st|nd|rd|th)?\s+"
+    r"(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*|"
+    r"(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\s+\d{1,2}|"
+    r"(mon|tues|wednes|thurs|fri|satur|sun)day|today|tomorrow|tonight|next week|"
+    r"\d{1,2}(:\d{2})?\s*(am|pm))\b",
+    re.IGNORECASE)
+ACTION_PATTERN = re.compile(
+    r"\b(please|due|deadline|pay(ment)?|overdue|expires?|renew|confirm|reply|respond|"
+    r"submit|register|book|sign|action required|required|must|remind(er)?|"
+    r"appointment|meeting|invoice|by (the )?end of)\b",
+    re.IGNORECASE)
+
+def token_budget(model_id: str) -> int:
+    """Return the body token budget for the model"""
+    return TOKEN_BUDGETS.get(model_id, DEFAULT_TOKEN_BUDGET)
+
+def estimate_tokens(text: str, model_id: Optional[str] = None) -> int:
+    """Estimate the number of tokens in the text
+
+    Uses tiktoken for OpenAI models when it is installed, and the number of
+    characters otherwise.
+    """
+    if tiktoken is not None and model_id is not None:
+        try:
+            return len(tiktoken.encoding_for_model(model_id).encode(text))
+        except KeyError:
+            pass
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def strip_quoted(text: str) -> str:
+    """Remove quoted replies and forwarded history"""
+    m = QUOTE_HEADER.search(text)
+    if m:
+        text = text[:m.start()]
+    return "\n".join(line for line in text.splitlines()
+                     if not line.lstrip().startswith(">"))
+
+def strip_signature(text: str) -> str:
+    """Remove the signature, which follows the standard "-- " separator"""
+    m = re.search(r"^-- ?$", text, re.MULTILINE)
+    return text[:m.start()] if m else text
+
+def strip_boilerplate(paragraph: str) -> str:
+    """Remove the sentences of a paragraph that are boilerplate"""
+    lines = []
+    for line in paragraph.splitlines():
+        if BOILERPLATE.search(line):
+            line = " ".join(sentence for sentence in SENTENCE_BREAK.split(line)
+                            if not BOILERPLATE.search(sentence))
+        if line.strip():
+            lines.append(line.strip())
+    return "\n".join(lines)
+
+def clean_paragraphs(text: str) -> list[str]:
+    """Split the text into paragraphs, dropping boilerplate and duplicates"""
+    seen = set()
+    paragraphs = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = strip_boilerplate(paragraph.strip())
+        key = " ".join(paragraph.lower().split())
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        paragraphs.append(paragraph)
+    return paragraphs
+
+def sentence_score(sentence: str) -> int:
+    """Score how likely a sentence is to contain dates or calls to action"""
+    return 2 * len(DATE_PATTERN.findall(sentence)) + len(ACTION_PATTERN.findall(sentence))
+
+def select_sentences(paragraphs: list[str], budget: int, model_id: Optional[str]) -> str:
+    """Keep the opening sentence and the highest scoring sentences within budget
+
+    Sentences are kept in their original order.
+    """
+    sentences = [s.strip() for p in paragraphs for s in SENTENCE_END.split(p) if s.strip()]
+    if not sentences:
+        return ""
+
+    # The opening sentence usually says what the email is about
+    ranked = sorted(range(1, len(sentences)),
+                    key=lambda i: (-sentence_score(sentences[i]), i))
+    keep = []
+    used = 0
+    for i in [0] + ranked:
+        tokens = estimate_tokens(sentences[i], model_id) + 1
+        if used + tokens > budget:
+            continue
+        keep.append(i)
+        used += tokens
+    return " ".join(sentences[i] for i in sorted(keep))
+
+def reduce_body(body: str, budget: int, model_id: Optional[str] = None) -> str:
+    """Reduce an email body to the content relevant for analysis
+
+    The result is only empty if the body is.
+    """
+    text = strip_signature(strip_quoted(body))
+    paragraphs = clean_paragraphs(text)
+    if not paragraphs:
+        # Everything looked like quoted history or boilerplate, so keep it
+        paragraphs = clean_paragraphs(body) or [body.strip()]
+    reduced = "\n\n".join(paragraphs)
+    if estimate_tokens(reduced, model_id) > budget:
+        # Sentences that are each over budget are kept rather than dropping them all
+        reduced = select_sentences(paragraphs, budget, model_id) or reduced
+    return reduced
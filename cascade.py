@@ -0,0 +1,223 @@
+import logging
+from pathlib import Path
+import pydantic
+import threading
+import time
+from typing import Any, Callable, Optional
+import yaml
+
+from mail_analysis import MailAnalyserBase, merge_repair_stats
+from models import EmailData
+from preclassifier import PreClassifier
+
+logger = logging.getLogger(__name__)
+
+# Returns why a response should be escalated to the next tier, or None
+Check = Callable[[EmailData, Any], Optional[str]]
+
+# Fields compared with the verdict of a matching rule
+RULE_FIELDS = ("is_important", "is_transactional", "notify")
+
+def rules_check(preclassifier: PreClassifier, fields=RULE_FIELDS) -> Check:
+    """Escalate responses that disagree with the rule matching the email"""
+    def check(email: EmailData, response: Any) -> Optional[str]:
+        rule = preclassifier.matching_rule(email)
+        if rule is None:
+            return None
+        for field in fields:
+            if field not in type(response).model_fields:
+                continue
+            if getattr(response, field) != getattr(rule.analysis, field):
+                return f"disagrees with rule {rule.name} on {field}"
+        return None
+    return check
+
+def flag_check(fields: list[str]) -> Check:
+    """Escalate responses with any of the boolean fields set"""
+    def check(email: EmailData, response: Any) -> Optional[str]:
+        for field in fields:
+            if getattr(response, field, False):
+                return f"{field} is set"
+        return None
+    return check
+
+class Tier:
+    """A tier of a cascade, and when to escalate past it
+
+    A response is escalated to the next tier when it fails validation (or
+    the model times out), when its `confidence` is below `min_confidence`,
+    or when one of the `checks` gives a reason to. Responses without a
+    confidence are not escalated for it.
+    """
+
+    def __init__(self, name: str, analyser: MailAnalyserBase,
+                 min_confidence: Optional[float] = None,
+                 checks: list[Check] = [], cost_per_call: float = 0):
+        self.name = name
+        self.analyser = analyser
+        self.min_confidence = min_confidence
+        self.checks = list(checks)
+        self.cost_per_call = cost_per_call
+
+    def escalation_reason(self, email: EmailData, response: Any) -> Optional[str]:
+        """Return why the response should be escalated, if it should be"""
+        confidence = getattr(response, "confidence", None)
+        if (self.min_confidence is not None and confidence is not None
+                and confidence < self.min_confidence):
+            return f"confidence {confidence:.2f} below {self.min_confidence:.2f}"
+        for check in self.checks:
+            reason = check(email, response)
+            if reason is not None:
+                return reason
+        return None
+
+class TierStats:
+    def __init__(self):
+        self.calls = 0
+        self.escalated = 0
+        self.failed = 0
+        self.latency = 0.0
+        self.cost = 0.0
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "escalated": self.escalated,
+            "escalation_rate": self.escalated / self.calls if self.calls else 0.0,
+            "failed": self.failed,
+            "mean_latency": self.latency / self.calls if self.calls else 0.0,
+            "cost": self.cost,
+        }
+
+class Cascade:
+    """Analyse emails with a cheap model first, escalating to larger models
+
+    Each email is analysed by the first tier, and escalated to the next tier
+    for the reasons configured on the tier. The last tier's response is
+    always used, and its errors are raised. Has the same process() and
+    aprocess() interface as the analysers of the tiers.
+    """
+
+    def __init__(self, tiers: list[Tier]):
+        if not tiers:
+            raise ValueError("A cascade needs at least one tier")
+        self.tiers = tiers
+        self.tier_stats = {tier.name: TierStats() for tier in tiers}
+        self.reasons: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def add_sample(self, email: EmailData, response: Any):
+        """Add a sample to the prompts of all the tiers"""
+        for tier in self.tiers:
+            tier.analyser.add_sample(email, response)
+
+    def record(self, tier: Tier, started: float, reason: Optional[str] = None,
+               failed: bool = False):
+        with self.lock:
+            stats = self.tier_stats[tier.name]
+            stats.calls += 1
+            stats.latency += time.monotonic() - started
+            stats.cost += tier.cost_per_call
+            if failed:
+                stats.failed += 1
+            if reason is not None:
+                stats.escalated += 1
+                kind = reason.split(" ", 1)[0]
+                self.reasons[kind] = self.reasons.get(kind, 0) + 1
+
+    def outcome(self, tier: Tier, email: EmailData, started: float,
+                response: Any = None, error: Optional[Exception] = None) -> bool:
+        """Record the outcome of a tier, returning whether to escalate"""
+        last = tier is self.tiers[-1]
+        if error is not None:
+            if last:
+                reason = None
+            elif isinstance(error, TimeoutError):
+                reason = "timeout waiting for the model"
+            else:
+                reason = f"invalid response: {error}"
+            self.record(tier, started, reason, failed=True)
+            if last:
+                raise error
+        else:
+            reason = None if last else tier.escalation_reason(email, response)
+            self.record(tier, started, reason)
+        if reason is not None:
+            logger.info("Escalating %s from %s: %s", email.message_id, tier.name, reason)
+        return reason is not None
+
+    def process(self, email: EmailData) -> Any:
+        """Analyse the email, escalating through the tiers as needed"""
+        for tier in self.tiers:
+            started = time.monotonic()
+            try:
+                response = tier.analyser.process(email)
+            except (pydantic.ValidationError, ValueError) as e:
+                self.outcome(tier, email, started, error=e)
+                continue
+            if not self.outcome(tier, email, started, response):
+                return response
+
+    async def aprocess(self, email: EmailData, timeout: Optional[float] = None) -> Any:
+        """Analyse the email without blocking the event loop
+
+        Each tier gets up to `timeout` seconds, and a tier that times out is
+        escalated.
+        """
+        for tier in self.tiers:
+            started = time.monotonic()
+            try:
+                response = await tier.analyser.aprocess(email, timeout)
+            except (pydantic.ValidationError, ValueError, TimeoutError) as e:
+                self.outcome(tier, email, started, error=e)
+                continue
+            if not self.outcome(tier, email, started, response):
+                return response
+
+    def repair_stats(self) -> dict[str, int]:
+        """Return the repair statistics of all the tiers"""
+        return merge_repair_stats([tier.analyser for tier in self.tiers])
+
+    def stats(self) -> dict[str, Any]:
+        """Return the calls, escalation rate, latency and cost of each tier"""
+        with self.lock:
+            stats = {name: s.as_dict() for name, s in self.tier_stats.items()}
+            stats["escalation_reasons"] = dict(self.reasons)
+        return stats
+
+class TierConfig(pydantic.BaseModel):
+    """Configuration of a cascade tier"""
+    model: str
+    name: str = ""
+    model_supports_schemas: bool = True
+    min_confidence: Optional[float] = None
+    check_rules: bool = False
+    escalate_if: list[str] = []
+    cost_per_call: float = 0
+
+def load_cascade(path: str | Path, analyser_class: type[MailAnalyserBase],
+                 preclassifier: Optional[PreClassifier] = None,
+                 **kwargs) -> Cascade:
+    """Create a cascade of analysers from the tiers in a YAML file
+
+    `kwargs` are passed to the analyser of each tier.
+    """
+    with open(path, "r") as f:
+        data = yaml.safe_load(f) or {}
+    tiers = []
+    for config in (TierConfig.model_validate(t) for t in data.get("tiers", [])):
+        checks = []
+        if config.check_rules:
+            if preclassifier is None:
+                raise ValueError(f"Tier {config.name or config.model} checks rules, "
+                                 "but no rules are loaded")
+            checks.append(rules_check(preclassifier))
+        if config.escalate_if:
+            checks.append(flag_check(config.escalate_if))
+        analyser = analyser_class(model=config.model,
+                                  model_supports_schemas=config.model_supports_schemas,
+                                  **kwargs)
+        tiers.append(Tier(config.name or config.model, analyser,
+                          min_confidence=config.min_confidence, checks=checks,
+                          cost_per_call=config.cost_per_call))
+    return Cascade(tiers)
@@ -0,0 +1,122 @@
+import argparse
+import asyncio
+import logging
+import nats
+import signal
+import time
+from typing import AsyncIterator, Optional
+
+from metrics import QUEUE_LAG, queue_lag
+
+logger = logging.getLogger(__name__)
+
+def add_follow_arguments(parser: argparse.ArgumentParser):
+    """Add the command line arguments for following a stream"""
+    parser.add_argument("--follow", action=argparse.BooleanOptionalAction,
+                        help="Keep consuming messages as they arrive, ignoring --limit")
+    parser.add_argument("--max-fetch-batch", type=int, default=0,
+                        help="Grow fetches up to this many messages while busy (0 to not grow)")
+    parser.add_argument("--max-idle", type=float, default=5,
+                        help="Maximum seconds to wait between fetches when idle")
+
+class PullConsumer:
+    """Fetch batches of messages from a JetStream pull subscription
+
+    By default, stops once `limit` messages have been fetched (-1 for no
+    limit) or when no messages arrive within `timeout` seconds. With
+    `follow`, keeps fetching until stopped, backing off exponentially up to
+    `max_idle` seconds between fetches while the stream is idle.
+
+    While messages keep arriving, the fetch size doubles each time a fetch
+    comes back full, up to `max_batch`, and shrinks back once fetches come
+    back short.
+
+    With a `stage` name, the queue lag of each message fetched is recorded
+    in the metrics for the stage.
+    """
+
+    def __init__(self, psub, batch: int = 1, timeout: float = 10, limit: int = -1,
+                 follow: bool = False, max_batch: int = 0,
+                 min_idle: float = 0.1, max_idle: float = 5,
+                 stage: Optional[str] = None):
+        self.psub = psub
+        self.batch = batch
+        self.max_batch = max(max_batch, batch)
+        self.timeout = timeout
+        self.remaining = -1 if follow else limit
+        self.follow = follow
+        self.min_idle = min_idle
+        self.max_idle = max_idle
+        self.stopping = asyncio.Event()
+        self.lag = QUEUE_LAG.labels(stage) if stage else None
+
+    def stop(self):
+        """Stop fetching, letting the caller finish the current batch"""
+        if not self.stopping.is_set():
+            logger.info("Stopping after the current batch")
+            self.stopping.set()
+
+    def stop_on_signals(self, signals=(signal.SIGTERM, signal.SIGINT)):
+        """Stop gracefully when the process receives one of the signals"""
+        loop = asyncio.get_running_loop()
+        for sig in signals:
+            loop.add_signal_handler(sig, self.stop)
+
+    async def fetch(self, size: int) -> list:
+        """Fetch up to `size` messages, returning early if stopped"""
+        fetch = asyncio.ensure_future(self.psub.fetch(batch=size, timeout=self.timeout))
+        stop = asyncio.ensure_future(self.stopping.wait())
+        done, _ = await asyncio.wait([fetch, stop], return_when=asyncio.FIRST_COMPLETED)
+        stop.cancel()
+        if fetch not in done:
+            fetch.cancel()
+            return []
+        try:
+            return fetch.result()
+        except nats.errors.TimeoutError:
+            return []
+
+    async def idle(self, seconds: float):
+        """Wait before the next fetch, returning early if stopped"""
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except TimeoutError:
+            pass
+
+    def record_lag(self, msgs: list):
+        now = time.time()
+        for msg in msgs:
+            lag = queue_lag(msg, now)
+            if lag is not None:
+                self.lag.observe(lag)
+
+    async def batches(self) -> AsyncIterator[list]:
+        """Yield batches of messages until done or stopped"""
+        size = self.batch
+        idle = self.min_idle
+        while self.remaining != 0 and not self.stopping.is_set():
+            fetch_size = size if self.remaining < 0 else min(size, self.remaining)
+            logger.debug("Fetching up to %d messages", fetch_size)
+            msgs = await self.fetch(fetch_size)
+
+            if not msgs:
+                if not self.follow:
+                    logger.debug("No messages received, exiting")
+                    return
+                logger.debug("No messages received, waiting %.1fs", idle)
+                size = self.batch
+                await self.idle(idle)
+                idle = min(idle * 2, self.max_idle)
+                continue
+
+            idle = self.min_idle
+            if len(msgs) == fetch_size:
+                size = min(size * 2, self.max_batch)
+            else:
+                size = max(len(msgs), self.batch)
+            if self.remaining > 0:
+                self.remaining -= len(msgs)
+            if self.lag is not None:
+                self.record_lag(msgs)
+
+            yield msgs
@@ -0,0 +1,208 @@
+# Idempotency for the pipeline stages. Redeliveries, getmail re-fetches and
+# replays can bring the same email through a stage several times, so each
+# stage records the emails it has handled and drops the ones it has seen.
+
+import asyncio
+import hashlib
+import logging
+import math
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEEN_DB = "~/.cache/mail-assistant/seen.db"
+
+# The keys of a stage are pruned to the maximum when the database row ID of
+# a new key is a multiple of this, so that processes handling a single email
+# don't count the keys each time
+PRUNE_INTERVAL = 1000
+
+# JetStream drops publishes repeating the ID of a message published within
+# the stream's duplicate window
+MSG_ID_HEADER = "Nats-Msg-Id"
+
+def msg_id_headers(subject: str, message_id: str, headers: Optional[dict] = None) -> Optional[dict]:
+    """Add a JetStream message ID for the email's output on the subject to the headers"""
+    if not message_id:
+        return headers
+    return {**(headers or {}), MSG_ID_HEADER: f"{subject}:{message_id}"}
+
+def email_key(email) -> str:
+    """Return the key of an email for deduplication
+
+    Emails with attachments only enter the pipeline once the OCR stage has
+    enriched them, so an email has the same key in every stage.
+    """
+    return email.message_id
+
+def message_key(msg) -> str:
+    """Return the key of a NATS message for deduplication
+
+    Uses the JetStream message ID it was published with, or the hash of its
+    data if it has none.
+    """
+    msg_id = (msg.headers or {}).get(MSG_ID_HEADER)
+    if msg_id:
+        return msg_id
+    return hashlib.sha256(msg.data).hexdigest()
+
+class BloomFilter:
+    """Set of keys that can have false positives but no false negatives"""
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key: str) -> list[int]:
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8])
+        h2 = int.from_bytes(digest[8:]) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for pos in self.positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(key))
+
+class SeenSet:
+    """Persistent set of the keys a pipeline stage has handled
+
+    Keys are stored per `stage` in an SQLite database, which is in memory
+    unless a path is given. A Bloom filter in front of it answers most
+    lookups of new keys without reading the database. It is loaded from the
+    database on start, so only one process should use it for a stage at a
+    time; processes that only check a few keys can do without it.
+
+    A key is claimed while it is being handled, so that a duplicate arriving
+    meanwhile is dropped too, and only added once it has been handled. Up to
+    `max_entries` keys are kept per stage, with the oldest dropped first
+    about every `prune_interval` keys added to the database. Empty keys are
+    never treated as duplicates.
+    """
+
+    def __init__(self, path: str | Path = ":memory:", stage: str = "default",
+                 max_entries: int = 1000000, error_rate: float = 0.001,
+                 bloom: bool = True, prune_interval: int = PRUNE_INTERVAL):
+        self.stage = stage
+        self.max_entries = max_entries
+        self.prune_interval = prune_interval
+        self.lock = threading.Lock()
+        self.in_flight: set[str] = set()
+
+        if str(path) != ":memory:":
+            path = Path(path).expanduser()
+            path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS seen (
+                               stage TEXT NOT NULL,
+                               key TEXT NOT NULL,
+                               added REAL NOT NULL,
+                               PRIMARY KEY (stage, key))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS seen_added ON seen (stage, added)")
+
+        self.bloom = None
+        if bloom:
+            self.bloom = BloomFilter(max_entries, error_rate)
+            for (key,) in self.db.execute("SELECT key FROM seen WHERE stage = ?", (stage,)):
+                self.bloom.add(key)
+
+        self.checked = 0
+        self.duplicates = 0
+        self.lookups = 0
+
+    def prune(self):
+        """Drop the oldest keys of the stage beyond the maximum"""
+        (count,) = self.db.execute("SELECT COUNT(*) FROM seen WHERE stage = ?",
+                                   (self.stage,)).fetchone()
+        if count <= self.max_entries:
+            return
+        self.db.execute("""DELETE FROM seen WHERE rowid IN (
+                               SELECT rowid FROM seen WHERE stage = ?
+                               ORDER BY added LIMIT ?)""",
+                        (self.stage, count - self.max_entries))
+
+    def seen(self, key: str) -> bool:
+        if self.bloom is not None and key not in self.bloom:
+            return False
+        self.lookups += 1
+        row = self.db.execute("SELECT 1 FROM seen WHERE stage = ? AND key = ?",
+                              (self.stage, key)).fetchone()
+        return row is not None
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            return bool(key) and self.seen(key)
+
+    def claim(self, key: str) -> bool:
+        """Claim a key for handling, returning False if it is a duplicate"""
+        if not key:
+            return True
+        with self.lock:
+            self.checked += 1
+            if key in self.in_flight or self.seen(key):
+                self.duplicates += 1
+                return False
+            self.in_flight.add(key)
+            return True
+
+    def release(self, key: str):
+        """Release a claimed key that could not be handled, so it can be retried"""
+        with self.lock:
+            self.in_flight.discard(key)
+
+    def add(self, key: str):
+        """Record a key as handled"""
+        if not key:
+            return
+        with self.lock:
+            self.in_flight.discard(key)
+            cursor = self.db.execute(
+                "INSERT OR REPLACE INTO seen (stage, key, added) VALUES (?, ?, ?)",
+                (self.stage, key, time.time()))
+            if self.bloom is not None:
+                self.bloom.add(key)
+            if cursor.lastrowid % self.prune_interval == 0:
+                self.prune()
+
+    def add_when_confirmed(self, key: str, outputs: list[asyncio.Future]):
+        """Record a key as handled once all its outputs are confirmed
+
+        The key is released instead if any of them fail, as the message is
+        then redelivered.
+        """
+        if not outputs:
+            self.add(key)
+            return
+        pending = set(outputs)
+        failed = False
+
+        def done(future: asyncio.Future):
+            nonlocal failed
+            pending.discard(future)
+            if future.cancelled() or future.exception() is not None:
+                failed = True
+            if not pending:
+                if failed:
+                    self.release(key)
+                else:
+                    self.add(key)
+
+        for future in outputs:
+            future.add_done_callback(done)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def stats(self) -> dict[str, int]:
+        """Return the keys checked, the duplicates dropped and the database lookups"""
+        return {"checked": self.checked, "duplicates": self.duplicates, "lookups": self.lookups}
@@ -5,6 +5,10 @@ import asyncio
 import logging
 import nats
 import os
+import sys
+
+from consumer import PullConsumer, add_follow_arguments
+from metrics import MESSAGES, add_metrics_arguments, metrics_exporter
 
 async def main():
     default_nats = os.environ.get("NATS", "nats://localhost:4222")
@@ -22,9 +26,11 @@ async def main():
     parser.add_argument("--timeout", type=int, default=2,
                         help="Timeout for message fetch")
     parser.add_argument("--limit", type=int, default=50,
-                        help="Number of messages to process")
+                        help="Number of messages to fetch at a time")
     parser.add_argument("--debug", action=argparse.BooleanOptionalAction,
                         help="Enable debug logging")
+    add_metrics_arguments(parser)
+    add_follow_arguments(parser)
     args = parser.parse_args()
 
     log_level = logging.DEBUG if args.debug else logging.INFO
@@ -43,16 +49,18 @@ async def main():
     psub = await js.pull_subscribe("", stream=args.nats_stream,
                                    durable=args.nats_consumer)
 
-    while True:
+    consumer = PullConsumer(psub, batch=args.limit, timeout=args.timeout,
+                            follow=args.follow, max_batch=args.max_fetch_batch,
+                            max_idle=args.max_idle, stage="expenses")
+    consumer.stop_on_signals()
+
+    exporter = metrics_exporter(args, nc)
+    processed = MESSAGES.labels("expenses", "processed")
+    skipped = MESSAGES.labels("expenses", "dropped")
+
+    async for msgs in consumer.batches():
         acks = []
         try:
-            logging.debug("Fetching %d messages with timeout %d",
-                          args.limit, args.timeout)
-            msgs = await psub.fetch(batch=args.limit, timeout=args.timeout)
-            if not msgs:
-                logging.debug("No messages to process")
-                break
-
             with open(args.expenses_file, "a") as f:
                 for msg in msgs:
                     acks.append(msg.ack())
@@ -61,22 +69,22 @@ async def main():
                     logging.debug("Processing message %s", raw_data)
                     if "Expense:" not in raw_data:
                         logging.debug("Skipping message %s", msg)
+                        skipped.inc()
                         continue
 
                     # Process the message
                     logging.debug("Writing message to %s", args.expenses_file)
                     f.write(raw_data)
                     f.write("\n")
+                    processed.inc()
 
-        except nats.errors.TimeoutError:
-            logging.debug("Timeout waiting for messages")
-            break
         finally:
             # Acknowledge all messages
             if acks:
                 logging.debug("Waiting for message acknowledgements")
                 await asyncio.gather(*acks)
 
+    await exporter.close()
     logging.debug("Closing NATS connection")
     await nc.close()
 
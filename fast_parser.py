@@ -0,0 +1,189 @@
+# Lightweight email parser using only the standard library. Handles plain text
+# and simple HTML email without importing `unstructured`.
+
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesHeaderParser, BytesParser
+from email.utils import parsedate_to_datetime
+from html.parser import HTMLParser
+import re
+from typing import Any
+
+from models import EmailData
+
+# Headers carried through to EmailData to help classify bulk email
+LIST_HEADERS = ("List-Id", "List-Unsubscribe", "Precedence", "Auto-Submitted")
+
+# Content types whose text can only be extracted by unstructured
+DOCUMENT_TYPES = {
+    "application/pdf",
+    "application/msword",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "application/vnd.ms-excel",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "application/vnd.ms-powerpoint",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+}
+
+# Images smaller than this are icons, spacers and tracking pixels, not scans
+MIN_IMAGE_BYTES = 4096
+
+def parse_headers(email: bytes) -> EmailMessage:
+    """Parse the headers of a raw email, without its body"""
+    return BytesHeaderParser(policy=policy.default).parsebytes(email)
+
+def normalise_message_id(value) -> str:
+    """Return a Message-ID without surrounding whitespace and angle brackets"""
+    return str(value or "").strip().strip("<>").strip()
+
+def message_id(email: bytes) -> str:
+    """Extract the Message-ID of a raw email without parsing its body"""
+    return normalise_message_id(parse_headers(email).get("Message-ID"))
+
+def message_list_headers(message: EmailMessage) -> dict[str, str]:
+    """Extract the mailing list and automation headers from a parsed email"""
+    return {name: str(message[name]) for name in LIST_HEADERS if name in message}
+
+def parse_message(email: bytes) -> EmailMessage:
+    """Parse a raw email into a MIME tree"""
+    return BytesParser(policy=policy.default).parsebytes(email)
+
+def is_extractable(part: EmailMessage) -> bool:
+    """Check whether a MIME part is an image or document worth extracting text from
+
+    Images referenced from the HTML body by Content-ID, such as the logos in
+    multipart/related parts, and images smaller than MIN_IMAGE_BYTES, such
+    as icons and tracking pixels, are decoration rather than content.
+    """
+    content_type = part.get_content_type()
+    if content_type in DOCUMENT_TYPES:
+        return True
+    if not content_type.startswith("image/"):
+        return False
+    if "Content-ID" in part and part.get_content_disposition() != "attachment":
+        return False
+    return len(part.get_payload(decode=True) or b"") >= MIN_IMAGE_BYTES
+
+def needs_unstructured(message: EmailMessage) -> bool:
+    """Check whether the email has content that the fast parser cannot handle
+
+    This is the case for images that need OCR, office documents and PDFs,
+    and emails without a text or HTML body.
+    """
+    has_text = False
+    for part in message.walk():
+        if is_extractable(part):
+            return True
+        content_type = part.get_content_type()
+        if content_type in ("text/plain", "text/html") and not part.is_attachment():
+            has_text = True
+    return not has_text
+
+def message_attachments(message: EmailMessage) -> list[tuple[str, str, bytes]]:
+    """Return the filename, content type and content of the images and documents"""
+    attachments = []
+    for part in message.walk():
+        if is_extractable(part):
+            attachments.append((part.get_filename() or "", part.get_content_type(),
+                                part.get_payload(decode=True) or b""))
+    return attachments
+
+class HTMLTextExtractor(HTMLParser):
+    """Extract the text of an HTML document, keeping paragraph breaks"""
+
+    BLOCK_TAGS = {
+        "address", "article", "aside", "blockquote", "dd", "div", "dl", "dt",
+        "footer", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li",
+        "main", "nav", "ol", "p", "pre", "section", "table", "tr", "ul",
+    }
+    SKIP_TAGS = {"head", "script", "style", "title", "template"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: list[str] = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip += 1
+        elif tag == "br":
+            self.parts.append("\n")
+        elif tag in ("td", "th"):
+            self.parts.append(" ")
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append("\n\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip = max(self.skip - 1, 0)
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append("\n\n")
+
+    def handle_data(self, data):
+        if not self.skip:
+            # Line breaks in HTML source are just whitespace
+            self.parts.append(data.replace("\n", " "))
+
+    def text(self) -> str:
+        return "".join(self.parts)
+
+def html_to_text(html: str) -> str:
+    """Convert HTML to plain text paragraphs"""
+    extractor = HTMLTextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return normalise_paragraphs(extractor.text())
+
+def normalise_paragraphs(text: str) -> str:
+    """Collapse whitespace, separating paragraphs with a single blank line"""
+    paragraphs = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        lines = [" ".join(line.split()) for line in paragraph.splitlines()]
+        paragraph = "\n".join(line for line in lines if line)
+        if paragraph:
+            paragraphs.append(paragraph)
+    return "\n\n".join(paragraphs)
+
+def message_body(message: EmailMessage) -> str:
+    """Extract the text body of the email, preferring plain text over HTML"""
+    part = message.get_body(preferencelist=("plain", "html"))
+    if part is None:
+        return ""
+    content = part.get_content()
+    if part.get_content_subtype() == "html":
+        return html_to_text(content)
+    return normalise_paragraphs(content)
+
+def addresses(message: EmailMessage, header: str) -> list[str]:
+    """Return the addresses in an address header"""
+    value = message.get(header)
+    if value is None:
+        return []
+    return [str(address) for address in value.addresses]
+
+def message_date(message: EmailMessage) -> str:
+    """Return the date of the email in ISO 8601 format"""
+    date = message.get("Date", "")
+    try:
+        return parsedate_to_datetime(str(date)).isoformat()
+    except (TypeError, ValueError):
+        return str(date)
+
+def header_fields(message: EmailMessage) -> dict[str, Any]:
+    """Return the fields of the parsed email data that come from its headers
+
+    These are shared by the parser backends, so that the message_id used for
+    deduplication doesn't depend on which of them parsed the email.
+    """
+    return dict(
+        from_=addresses(message, "From"),
+        to=addresses(message, "To"),
+        subject=str(message.get("Subject", "")),
+        date=message_date(message),
+        message_id=normalise_message_id(message.get("Message-ID")),
+        headers=message_list_headers(message),
+    )
+
+def email_data(message: EmailMessage) -> EmailData:
+    """Create the parsed email data from a MIME tree"""
+    return EmailData(**header_fields(message), body=message_body(message))
@@ -0,0 +1,131 @@
+# Tolerant extraction of JSON responses from models that don't support
+# schemas. Pulls the first JSON object out of chatty output and fixes the
+# defects small models commonly produce, so that a response only has to be
+# re-requested when it cannot be repaired.
+
+import json
+import pydantic
+import re
+import typing
+from typing import Any, Optional
+
+CODE_FENCE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+def first_object(text: str) -> Optional[str]:
+    """Return the first balanced {...} in the text, ignoring braces in strings"""
+    start = text.find("{")
+    while start >= 0:
+        depth = 0
+        quote = None
+        escaped = False
+        for i in range(start, len(text)):
+            c = text[i]
+            if quote:
+                if escaped:
+                    escaped = False
+                elif c == "\\":
+                    escaped = True
+                elif c == quote:
+                    quote = None
+            elif c in "\"'":
+                quote = c
+            elif c == "{":
+                depth += 1
+            elif c == "}":
+                depth -= 1
+                if depth == 0:
+                    return text[start:i + 1]
+        # Unbalanced, so try from the next opening brace
+        start = text.find("{", start + 1)
+    return None
+
+def fix_quotes(text: str) -> str:
+    """Convert single-quoted strings to double-quoted ones"""
+    out = []
+    quote = None
+    escaped = False
+    for c in text:
+        if quote:
+            if escaped:
+                escaped = False
+                if quote == "'" and c == "'":
+                    # \' is not a valid JSON escape
+                    out[-1] = "'"
+                    continue
+            elif c == "\\":
+                escaped = True
+            elif c == quote:
+                quote = None
+                c = '"'
+            elif c == '"' and quote == "'":
+                c = '\\"'
+        elif c in "\"'":
+            quote = c
+            c = '"'
+        out.append(c)
+    return "".join(out)
+
+def fix_literals(text: str) -> str:
+    """Convert Python literals outside strings to JSON literals"""
+    return re.sub(r'("(?:[^"\\]|\\.)*")|\b(True|False|None)\b',
+                  lambda m: m.group(1) or PYTHON_LITERALS[m.group(2)], text)
+
+def extract_json(text: str) -> Optional[Any]:
+    """Extract and parse the first JSON object in a model response
+
+    Returns None if no object can be parsed, even after repairs.
+    """
+    m = CODE_FENCE.search(text)
+    if m:
+        text = m.group(1)
+    candidate = first_object(text)
+    if candidate is None:
+        return None
+
+    repairs = [
+        lambda s: s,
+        lambda s: TRAILING_COMMA.sub(r"\1", s),
+        lambda s: fix_literals(TRAILING_COMMA.sub(r"\1", fix_quotes(s))),
+    ]
+    for repair in repairs:
+        try:
+            return json.loads(repair(candidate))
+        except json.JSONDecodeError:
+            continue
+    return None
+
+def coerce_fields(data: Any, schema: type[pydantic.BaseModel]) -> Any:
+    """Coerce field values that pydantic would reject into the expected types
+
+    Drops nulls for fields with defaults, and wraps single values in a list
+    for list fields. Other conversions, such as "true" to True, are left to
+    pydantic.
+    """
+    if not isinstance(data, dict):
+        return data
+    data = dict(data)
+    for name, field in schema.model_fields.items():
+        key = field.alias or name
+        if key not in data:
+            continue
+        value = data[key]
+        if value is None and not field.is_required():
+            del data[key]
+        elif typing.get_origin(field.annotation) is list and not isinstance(value, list):
+            data[key] = [value]
+    return data
+
+def repair_response(text: str, schema: type[pydantic.BaseModel]) -> Optional[pydantic.BaseModel]:
+    """Try to repair a response that failed validation
+
+    Returns None if the response cannot be repaired.
+    """
+    data = extract_json(text)
+    if data is None:
+        return None
+    try:
+        return schema.model_validate(coerce_fields(data, schema))
+    except pydantic.ValidationError:
+        return None
@@ -14,7 +14,17 @@ import sys
 from typing import Any
 import yaml
 
+from analysis_cache import SQLiteCache
+from cascade import load_cascade
 from mail_analysis import MailAnalyse, MailAnalyseHeaders
+from consumer import PullConsumer, add_follow_arguments
+from dedupe import DEFAULT_SEEN_DB, SeenSet, email_key, msg_id_headers
+from metrics import MESSAGES, add_metrics_arguments, metrics_exporter
+from publisher import BatchPublisher
+from near_duplicates import DEFAULT_SIMILARITY_DB, SimilarityIndex
+from preclassifier import DEFAULT_RULES_FILE, PreClassifier
+from sample_store import SampleStore
+from wire import BodyUnavailableError, WireFormat
 from models import EmailData, HeaderAnalysis, EmailAction, Notification, Task
 
 sample_email_data = EmailData(
@@ -60,7 +70,7 @@ def get_destinations(action: EmailAction) -> list[Destination]:
             Destination(
                 type=DestinationType.TASK,
                 action=action.action,
-                due_date=action.due_date,
+                due_date=str(action.due_date),
             ))
 
     return destinations
@@ -69,6 +79,9 @@ async def main():
     default_model = os.environ.get("MODEL",
                                    "mlx-community/Llama-3.2-3B-Instruct-4bit")
     default_nats = os.environ.get("NATS", "nats://localhost:4222")
+    default_cache = os.environ.get("ANALYSIS_CACHE")
+    default_similarity_db = os.environ.get("SIMILARITY_DB", DEFAULT_SIMILARITY_DB)
+    default_seen_db = os.environ.get("SEEN_DB", DEFAULT_SEEN_DB)
 
     parser = argparse.ArgumentParser(
         description="Analyse emails",
@@ -88,12 +101,70 @@ async def main():
     parser.add_argument("--nats-notification-subject",
                         default="notifications.email.action",
                         help="NATS subject to publish notifications to")
+    parser.add_argument("--cache", default=default_cache,
+                        help="SQLite file to cache analysis results in")
+    parser.add_argument("--cache-ttl", type=float, default=30 * 24 * 3600,
+                        help="Seconds to keep cached analysis results")
+    parser.add_argument("--cache-max-entries", type=int, default=100000,
+                        help="Maximum number of cached analysis results")
+    parser.add_argument("--reduce-body", action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help="Strip quoted history and boilerplate from email bodies")
+    parser.add_argument("--body-token-budget", type=int,
+                        help="Maximum tokens of email body to analyse (default depends on the model)")
+    parser.add_argument("--cascade",
+                        help="YAML file with model tiers to escalate analysis through "
+                             "(overrides --model)")
+    parser.add_argument("--rules", default=str(DEFAULT_RULES_FILE),
+                        help="YAML file with the pre-classification rules for cascade tiers "
+                             "with check_rules")
+    parser.add_argument("--reuse-similar", action=argparse.BooleanOptionalAction,
+                        help="Reuse the analysis of near-duplicate emails, such as ones "
+                             "generated from the same template")
+    parser.add_argument("--similarity-db", default=default_similarity_db,
+                        help="SQLite file to store analysed emails in for near-duplicate detection")
+    parser.add_argument("--similarity-distance", type=int, default=3,
+                        help="Maximum number of differing fingerprint bits for near-duplicates")
+    parser.add_argument("--similarity-max-entries", type=int, default=100000,
+                        help="Maximum number of analysed emails to keep for near-duplicate detection")
+    parser.add_argument("--samples", action="append", default=[],
+                        help="YAML file or directory of labelled emails to pick the most "
+                             "relevant prompt samples from (can be repeated)")
+    parser.add_argument("--sample-count", type=int, default=3,
+                        help="Maximum number of samples to add to each prompt")
+    parser.add_argument("--sample-token-budget", type=int,
+                        help="Maximum tokens of samples to add to each prompt")
+    parser.add_argument("--retry-invalid", action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help="Ask the model to fix responses that are invalid and can't be repaired")
+    parser.add_argument("--dedupe", action=argparse.BooleanOptionalAction,
+                        help="Skip emails that have already been analysed")
+    parser.add_argument("--seen-db", default=default_seen_db,
+                        help="SQLite file to record analysed emails in for --dedupe")
+    parser.add_argument("--model-timeout", type=float, default=300,
+                        help="Seconds to wait for the model to analyse an email")
+    parser.add_argument("--fetch-batch", type=int, default=1,
+                        help="Number of messages to fetch at a time")
+    parser.add_argument("--publish-batch", type=int, default=50,
+                        help="Maximum number of publishes and acks to send together")
+    parser.add_argument("--publish-delay", type=float, default=0.05,
+                        help="Seconds to wait for more publishes and acks to batch")
+    parser.add_argument("--durable-outputs", action=argparse.BooleanOptionalAction,
+                        help="Publish tasks and notifications through JetStream, and ack "
+                        "emails only once they are stored (needs their streams)")
+    parser.add_argument("--nak-delay", type=float, default=30,
+                        help="Seconds before an email whose outputs failed is redelivered")
+    parser.add_argument("--max-deliveries", type=int, default=5,
+                        help="Stop redelivering an email whose outputs keep failing after "
+                        "this many deliveries (0 for no limit)")
     parser.add_argument("--limit", type=int, default=50,
                         help="Number of messages to process (-1 for all)")
     parser.add_argument("--debug", action=argparse.BooleanOptionalAction,
                         help="Enable debug logging")
     parser.add_argument("--debug-skip-ack", action=argparse.BooleanOptionalAction,
                         help="Skip acking messages for debugging")
+    add_metrics_arguments(parser)
+    add_follow_arguments(parser)
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -115,57 +186,161 @@ async def main():
                                    durable=args.nats_consumer)
 
     logging.debug(f"Creating mail analyser with model %s", args.model)
-    analyser = MailAnalyse(model=args.model, model_supports_schemas=False)
+    cache = None
+    if args.cache:
+        logging.debug("Using analysis cache %s", args.cache)
+        cache = SQLiteCache(args.cache, ttl=args.cache_ttl,
+                            max_entries=args.cache_max_entries)
+
+    similar = None
+    if args.reuse_similar:
+        logging.debug("Using similarity index %s", args.similarity_db)
+        similar = SimilarityIndex(args.similarity_db,
+                                  max_entries=args.similarity_max_entries,
+                                  max_distance=args.similarity_distance)
+
+    seen = None
+    if args.dedupe:
+        logging.debug("Recording analysed emails in %s", args.seen_db)
+        seen = SeenSet(args.seen_db, stage="analysis")
+
+    sample_store = None
+    if args.samples:
+        sample_store = SampleStore.from_yaml(args.samples, "action", EmailAction,
+                                             k=args.sample_count,
+                                             token_budget=args.sample_token_budget)
+        logging.debug("Loaded %d samples from %s", len(sample_store), args.samples)
+
+    cascade = None
+    if args.cascade:
+        logging.debug("Loading model cascade from %s", args.cascade)
+        cascade = load_cascade(args.cascade, MailAnalyse, PreClassifier.from_yaml(args.rules),
+                               cache=cache, retry_invalid=args.retry_invalid, similar=similar,
+                               sample_store=sample_store, reduce_body=args.reduce_body,
+                               body_token_budget=args.body_token_budget)
+        analyser = cascade
+    else:
+        analyser = MailAnalyse(model=args.model, model_supports_schemas=False, cache=cache,
+                               retry_invalid=args.retry_invalid, similar=similar,
+                               sample_store=sample_store, reduce_body=args.reduce_body,
+                               body_token_budget=args.body_token_budget)
     analyser.add_sample(sample_email_data, sample_email_action)
 
-    count = args.limit
-    while count > 0:
-        count -= 1
-
-        try:
-            msgs = await psub.fetch(batch=1, timeout=10)
-            if not msgs:
-                logging.debug("No messages received, exiting")
-                break
-
-            for msg in msgs:
-                if not args.debug_skip_ack:
-                    await msg.ack()
-
-                raw_data = msg.data.decode()
-                logging.debug("Received message: %s", raw_data)
-
-                try:
-                    email = EmailData.model_validate_json(raw_data)
-                except pydantic.ValidationError as e:
-                    logging.error("Error validating email: %s: %s", e, raw_data)
-                    continue
-
-                try:
-                    action = analyser.process(email)
-                    logging.info(action)
-
-                    destinations = get_destinations(action)
-                    for destination in destinations:
-                        if destination.type == DestinationType.TASK:
-                            subject = args.nats_task_subject
-                            body = action.model_dump_json()
-                        elif destination.type == DestinationType.NOTIFICATION:
-                            subject = args.nats_notification_subject
-                            body = Notification(
-                                title=destination.type.value,
-                                message=destination.action).model_dump_json()
-
-                        logging.debug("Publishing action to %s (%s)", subject, body)
-                        await nc.publish(subject, body.encode())
-                except pydantic.ValidationError as e:
-                    logging.error("Error analysing email: %s: %s", e, email.model_dump_json())
-                    continue
-
-        except nats.errors.TimeoutError:
-            logging.debug("Timeout waiting for messages, exiting")
-            break
+    # Emails are decoded from any encoding the archiver publishes them in
+    wire = WireFormat(js)
+
+    exporter = metrics_exporter(args, nc)
+    processed = MESSAGES.labels("analysis", "processed")
+    duplicates = MESSAGES.labels("analysis", "duplicate")
+    failed = MESSAGES.labels("analysis", "error")
+
+    publisher = BatchPublisher(nc, max_batch=args.publish_batch,
+                               max_delay=args.publish_delay, stage="analysis",
+                               nak_delay=args.nak_delay, max_deliveries=args.max_deliveries)
+
+    async def ack(msg, after=[]):
+        if not args.debug_skip_ack:
+            await publisher.ack(msg, after)
+
+    consumer = PullConsumer(psub, batch=args.fetch_batch, timeout=10,
+                            limit=args.limit, follow=args.follow,
+                            max_batch=args.max_fetch_batch, max_idle=args.max_idle,
+                            stage="analysis")
+    consumer.stop_on_signals()
+
+    async for msgs in consumer.batches():
+        for msg in msgs:
+            logging.debug("Received message: %s", msg.data)
+
+            try:
+                email = await wire.decode(msg.data, msg.headers)
+            except BodyUnavailableError as e:
+                # Redelivered after a delay, in case the fetch failed temporarily
+                logging.error("Error fetching email body: %s", e)
+                failed.inc()
+                await publisher.reject(msg)
+                continue
+            except ValueError as e:
+                logging.error("Error validating email: %s: %s", e, msg.data)
+                failed.inc()
+                await ack(msg)
+                continue
+
+            if seen is not None and not seen.claim(email_key(email)):
+                logging.info("Skipping duplicate email %s", email.message_id)
+                duplicates.inc()
+                await ack(msg)
+                continue
+
+            try:
+                action = await analyser.aprocess(email, timeout=args.model_timeout)
+                logging.info(action)
+
+                # The email is only acked once everything published for
+                # it has been confirmed, or sent with --no-durable-outputs
+                outputs = []
+                destinations = get_destinations(action)
+                for destination in destinations:
+                    if destination.type == DestinationType.TASK:
+                        subject = args.nats_task_subject
+                        body = action.model_dump_json()
+                    elif destination.type == DestinationType.NOTIFICATION:
+                        subject = args.nats_notification_subject
+                        body = Notification(
+                            title=destination.type.value,
+                            message=destination.action).model_dump_json()
+
+                    logging.debug("Publishing action to %s (%s)", subject, body)
+                    outputs.append(await publisher.publish(
+                        subject, body.encode(),
+                        headers=msg_id_headers(subject, email_key(email)),
+                        durable=args.durable_outputs))
+                await ack(msg, outputs)
+                processed.inc()
+                if seen is not None:
+                    seen.add_when_confirmed(email_key(email), outputs)
+            except pydantic.ValidationError as e:
+                logging.error("Error analysing email: %s: %s", e, email.model_dump_json())
+                failed.inc()
+                await ack(msg)
+                if seen is not None:
+                    seen.release(email_key(email))
+                continue
+            except TimeoutError:
+                logging.error("Timeout analysing email: %s", email.message_id)
+                failed.inc()
+                await ack(msg)
+                if seen is not None:
+                    seen.release(email_key(email))
+                continue
+
+    await publisher.close()
+    logging.info("Published %(published)d messages, acked %(acked)d, nak'd %(nakd)d, "
+                 "terminated %(terminated)d",
+                 publisher.stats())
+
+    logging.info("Model responses: %(valid)d valid, %(repaired)d repaired, "
+                 "%(retried)d retried, %(invalid)d invalid", analyser.repair_stats())
+
+    if cascade is not None:
+        for tier, stats in cascade.stats().items():
+            logging.info("Cascade %s: %s", tier, stats)
+
+    if seen is not None:
+        logging.info("Dedupe: %(duplicates)d of %(checked)d emails skipped as duplicates",
+                     seen.stats())
+        seen.close()
+
+    if similar is not None:
+        logging.info("Similarity index: %(hits)d near-duplicates found, %(misses)d not found, "
+                     "%(entries)d emails indexed", similar.stats())
+        similar.close()
+
+    if cache is not None:
+        logging.info("Analysis cache: %(hits)d hits, %(misses)d misses", cache.stats())
+        cache.close()
 
+    await exporter.close()
     await nc.close()
 
 if __name__ == '__main__':
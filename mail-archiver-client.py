@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+# Thin MDA that gets invoked by getmail. It streams the email to
+# mail-archiver-daemon.py over a Unix socket and reports the delivery status
+# back to getmail. Only uses the standard library so that it starts quickly.
+
+import argparse
+import os
+import socket
+import sys
+
+DEFAULT_SOCKET = "~/.cache/mail-assistant/archiver.sock"
+
+# Exit status telling getmail to retry delivery later (EX_TEMPFAIL)
+EXIT_TEMPFAIL = 75
+
+def main() -> int:
+    default_socket = os.environ.get("ARCHIVER_SOCKET", DEFAULT_SOCKET)
+
+    parser = argparse.ArgumentParser(
+        description="Send email messages to the archiver daemon",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--socket", default=default_socket, help="Unix socket of the archiver daemon")
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="Seconds to wait for the daemon to archive the email")
+    parser.add_argument("sender", help="Email sender")
+    args = parser.parse_args()
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(args.timeout)
+            sock.connect(os.path.expanduser(args.socket))
+
+            sock.sendall(args.sender.replace("\n", " ").encode() + b"\n")
+            while chunk := sys.stdin.buffer.read(65536):
+                sock.sendall(chunk)
+            sock.shutdown(socket.SHUT_WR)
+
+            reply = sock.makefile("rb").readline().decode().strip()
+    except OSError as e:
+        print(f"Error talking to archiver daemon: {e}", file=sys.stderr)
+        return EXIT_TEMPFAIL
+
+    if reply != "OK":
+        print(f"Archiver daemon failed: {reply}", file=sys.stderr)
+        return EXIT_TEMPFAIL
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+# Resident archiver service. Keeps `unstructured` loaded and a NATS connection
+# open, and archives emails streamed to it over a Unix socket by
+# mail-archiver-client.py.
+#
+# Protocol: the client sends the sender on a single line followed by the raw
+# email, then closes its side of the connection. The daemon replies with a
+# single line, either "OK" or "ERROR <reason>".
+
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import nats
+import os
+from pathlib import Path
+import signal
+import sys
+
+from archiver import PARSERS, archive, load_unstructured
+from dedupe import DEFAULT_SEEN_DB, SeenSet
+from metrics import add_metrics_arguments, metrics_exporter
+from ocr import DEFAULT_ATTACHMENT_DIR, AttachmentStore
+from wire import add_wire_arguments, wire_format
+
+DEFAULT_SOCKET = "~/.cache/mail-assistant/archiver.sock"
+
+async def main():
+    default_nats = os.environ.get("NATS", "nats://localhost:4222")
+    default_socket = os.environ.get("ARCHIVER_SOCKET", DEFAULT_SOCKET)
+    default_seen_db = os.environ.get("SEEN_DB", DEFAULT_SEEN_DB)
+    default_attachment_dir = os.environ.get("ATTACHMENT_DIR", DEFAULT_ATTACHMENT_DIR)
+
+    parser = argparse.ArgumentParser(
+        description="Archive email messages received over a Unix socket",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--nats-server", "-s", default=default_nats, help="NATS server URL")
+    parser.add_argument("--nats-subject", default="email.parsed", help="NATS subject to publish to")
+    parser.add_argument("--nats-error-subject", default="email.error", help="NATS subject to publish errors to")
+    parser.add_argument("--socket", default=default_socket, help="Unix socket to listen on")
+    parser.add_argument("--parser", choices=PARSERS, default="unstructured",
+                        help="Email parser to use (auto picks per email)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of emails to parse concurrently")
+    parser.add_argument("--defer-attachments", action=argparse.BooleanOptionalAction,
+                        help="Leave the text of images and documents to be extracted by ocr-worker.py")
+    parser.add_argument("--attachment-dir", default=default_attachment_dir,
+                        help="Directory to store attachments in for ocr-worker.py")
+    parser.add_argument("--nats-attachment-subject", default="email.attachments",
+                        help="NATS subject to publish emails with attachments to for ocr-worker.py")
+    parser.add_argument("--nats-headers-subject",
+                        help="NATS subject to also publish header records of emails to, for "
+                             "the header analysis")
+    parser.add_argument("--dedupe", action=argparse.BooleanOptionalAction,
+                        help="Skip emails that have already been archived")
+    parser.add_argument("--seen-db", default=default_seen_db,
+                        help="SQLite file to record archived emails in for --dedupe")
+    add_wire_arguments(parser)
+    add_metrics_arguments(parser)
+    parser.add_argument("--debug", action=argparse.BooleanOptionalAction,
+                        help="Enable debug logging")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s")
+
+    logging.debug("Connecting to NATS server at %s", args.nats_server)
+    nc = await nats.connect(args.nats_server)
+    wire = wire_format(args, nc.jetstream())
+    exporter = metrics_exporter(args, nc)
+
+    if args.parser != "fast" and not args.defer_attachments:
+        logging.debug("Loading unstructured")
+        load_unstructured()
+
+    seen = None
+    if args.dedupe:
+        logging.debug("Recording archived emails in %s", args.seen_db)
+        seen = SeenSet(args.seen_db, stage="archive")
+
+    attachments = AttachmentStore(args.attachment_dir) if args.defer_attachments else None
+
+    pool = ThreadPoolExecutor(max_workers=args.workers)
+
+    async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            sender = (await reader.readline()).decode().strip()
+            email = await reader.read()
+            logging.info("Archiving %d byte email from %s", len(email), sender)
+
+            await archive(nc, email, sender, args.nats_subject,
+                          args.nats_error_subject, executor=pool,
+                          parser=args.parser, seen=seen, attachments=attachments,
+                          attachment_subject=args.nats_attachment_subject, wire=wire,
+                          header_subject=args.nats_headers_subject)
+            await nc.flush()
+            writer.write(b"OK\n")
+        except Exception as e:
+            logging.error("Error handling client: %s", e)
+            writer.write(f"ERROR {e}\n".encode())
+        finally:
+            await writer.drain()
+            writer.close()
+
+    socket_path = Path(args.socket).expanduser()
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    socket_path.unlink(missing_ok=True)
+
+    server = await asyncio.start_unix_server(handle_client, path=socket_path)
+    socket_path.chmod(0o600)
+    logging.info("Listening on %s", socket_path)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with server:
+        await stop.wait()
+
+        # Stop accepting new emails, and finish archiving the ones received
+        logging.info("Shutting down")
+        server.close()
+        await server.wait_closed()
+
+    socket_path.unlink(missing_ok=True)
+    pool.shutdown()
+    await exporter.close()
+    await nc.drain()
+
+    if seen is not None:
+        logging.info("Dedupe: %(duplicates)d of %(checked)d emails skipped as duplicates",
+                     seen.stats())
+        seen.close()
+
+if __name__ == '__main__':
+    asyncio.run(main())
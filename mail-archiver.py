@@ -5,16 +5,20 @@
 
 import argparse
 import asyncio
-from datetime import datetime
 import nats
-import pydantic
+import os
 import sys
-from tempfile import NamedTemporaryFile
-from unstructured.partition.email import partition_email
 
-from models import EmailData, EmailParseError
+from archiver import PARSERS, archive
+from dedupe import DEFAULT_SEEN_DB, SeenSet
+from metrics import add_metrics_arguments, metrics_exporter
+from ocr import DEFAULT_ATTACHMENT_DIR, AttachmentStore
+from wire import add_wire_arguments, wire_format
 
 async def main():
+    default_seen_db = os.environ.get("SEEN_DB", DEFAULT_SEEN_DB)
+    default_attachment_dir = os.environ.get("ATTACHMENT_DIR", DEFAULT_ATTACHMENT_DIR)
+
     parser = argparse.ArgumentParser(
         description="Archive email messages",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -22,39 +26,45 @@ async def main():
     parser.add_argument("--nats-server", "-s", default="nats://localhost:4222", help="NATS server URL")
     parser.add_argument("--nats-subject", default="email.parsed", help="NATS subject to publish to")
     parser.add_argument("--nats-error-subject", default="email.error", help="NATS subject to publish errors to")
+    parser.add_argument("--parser", choices=PARSERS, default="unstructured",
+                        help="Email parser to use (auto picks per email)")
+    parser.add_argument("--defer-attachments", action=argparse.BooleanOptionalAction,
+                        help="Leave the text of images and documents to be extracted by ocr-worker.py")
+    parser.add_argument("--attachment-dir", default=default_attachment_dir,
+                        help="Directory to store attachments in for ocr-worker.py")
+    parser.add_argument("--nats-attachment-subject", default="email.attachments",
+                        help="NATS subject to publish emails with attachments to for ocr-worker.py")
+    parser.add_argument("--nats-headers-subject",
+                        help="NATS subject to also publish header records of emails to, for "
+                             "the header analysis")
+    parser.add_argument("--dedupe", action=argparse.BooleanOptionalAction,
+                        help="Skip emails that have already been archived")
+    parser.add_argument("--seen-db", default=default_seen_db,
+                        help="SQLite file to record archived emails in for --dedupe")
+    add_wire_arguments(parser)
+    add_metrics_arguments(parser)
     parser.add_argument("sender", help="Email sender")
     args = parser.parse_args()
 
+    # Only one email is checked, so skip loading the Bloom filter
+    seen = SeenSet(args.seen_db, stage="archive", bloom=False) if args.dedupe else None
+
+    attachments = AttachmentStore(args.attachment_dir) if args.defer_attachments else None
+
     nc = await nats.connect(args.nats_server)
+    wire = wire_format(args, nc.jetstream())
+    exporter = metrics_exporter(args, nc)
+
+    email = sys.stdin.buffer.read()
+    await archive(nc, email, args.sender, args.nats_subject, args.nats_error_subject,
+                  parser=args.parser, seen=seen, attachments=attachments,
+                  attachment_subject=args.nats_attachment_subject, wire=wire,
+                  header_subject=args.nats_headers_subject)
 
-    try:
-        email = sys.stdin.buffer.read()
-
-        with NamedTemporaryFile(delete_on_close=False) as f:
-            f.write(email)
-            f.close()
-
-            # Parse email using unstructured
-            elements = partition_email(filename=f.name)
-
-        # Parsed email data
-        data = EmailData(
-            from_=elements[0].metadata.sent_from,
-            to=elements[0].metadata.sent_to,
-            subject=elements[0].metadata.subject,
-            date=elements[0].metadata.last_modified,
-            message_id=elements[0].metadata.email_message_id,
-            body="\n\n".join([str(el) for el in elements]),
-        )
-
-        # Publish parsed email data to NATS
-        await nc.publish(args.nats_subject, data.model_dump_json().encode())
-
-    except Exception as e:
-        # Publish error to NATS
-        error = EmailParseError(sender=args.sender, date=str(datetime.now()), error=str(e))
-        await nc.publish(args.nats_error_subject, error.model_dump_json().encode())
-        return
+    await exporter.close()
+    await nc.close()
+    if seen is not None:
+        seen.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -2,6 +2,7 @@ import abc
 import argparse
 import asyncio
 from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 import json
 import llm
@@ -14,8 +15,21 @@ import sys
 from typing import Any
 import yaml
 
-from mail_analysis import MailAnalyse, MailAnalyseHeaders
-from models import EmailData, HeaderAnalysis, EmailAction, Notification, Task
+from analysis_cache import SQLiteCache
+from cascade import Cascade, load_cascade
+from consumer import PullConsumer, add_follow_arguments
+from dedupe import DEFAULT_SEEN_DB, SeenSet, email_key, msg_id_headers
+from metrics import MESSAGES, add_metrics_arguments, metrics_exporter
+from mail_analysis import (MailAnalyse, MailAnalyseHeaders, MailAnalyseHeadersBatch,
+                           merge_repair_stats)
+from preclassifier import DEFAULT_RULES_FILE, PreClassifier
+from sender_reputation import DEFAULT_REPUTATION_DB, SenderReputation
+from publisher import BatchPublisher
+from near_duplicates import DEFAULT_SIMILARITY_DB, SimilarityIndex
+from sample_store import SampleStore
+from wire import (BodyUnavailableError, WireFormat, fetch_email, header_email,
+                  is_header_record, wire_headers)
+from models import EmailData, EmailHeaders, HeaderAnalysis, EmailAction, Notification, Task
 
 sample_email_data = EmailData(
     from_=[ "someone@somwehere.com" ],
@@ -60,14 +74,196 @@ def get_destinations(action: EmailAction) -> list[Destination]:
             Destination(
                 type=DestinationType.TASK,
                 action=action.action,
-                due_date=action.due_date,
+                due_date=str(action.due_date),
             ))
 
     return destinations
 
+# Seconds between progress acks for messages that are still being analysed
+IN_PROGRESS_INTERVAL = 10
+
+async def analyse_after(previous: list[asyncio.Future],
+                        pool: ThreadPoolExecutor,
+                        analyse: Callable[[Any], Any],
+                        data: Any) -> Any:
+    """Run the analysis on the worker pool once `previous` have completed"""
+    if previous:
+        await asyncio.wait(previous)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, analyse, data)
+
+async def batch_result(analyses: asyncio.Future, index: int) -> HeaderAnalysis:
+    """Return the result for one email of a batched analysis"""
+    return (await analyses)[index]
+
+def analyse_batch(pool: ThreadPoolExecutor,
+                  header_analyser: MailAnalyseHeaders | Cascade,
+                  emails: list[EmailData],
+                  preclassifier: PreClassifier | None = None,
+                  reputation: SenderReputation | None = None,
+                  batch_analyser: MailAnalyseHeadersBatch | None = None,
+                  batch_size: int = 1,
+                  ) -> list[tuple[str, asyncio.Future]]:
+    """Dispatch header analysis for a batch of emails to the worker pool
+
+    Emails matched by the pre-classifier rules or from senders with a
+    trusted reputation are not sent to the model. If a batch analyser is
+    given, the remaining emails are sent to the model `batch_size` at a
+    time in a single prompt. Emails sharing a message_id are chained so
+    that they are analysed one after the other in the order they were
+    fetched.
+
+    Returns the source of each analysis ("rules", "reputation" or "model")
+    along with a future for its result.
+    """
+    loop = asyncio.get_running_loop()
+    analyses: list[tuple[str, asyncio.Future] | None] = []
+    to_model = []
+    for email in emails:
+        source, header_analysis = "model", None
+        if preclassifier is not None:
+            source, header_analysis = "rules", preclassifier.classify(email)
+        if header_analysis is None and reputation is not None:
+            source, header_analysis = "reputation", reputation.classify(email)
+        if header_analysis is None:
+            to_model.append((len(analyses), email))
+            analyses.append(None)
+            continue
+
+        analysis = loop.create_future()
+        analysis.set_result(header_analysis)
+        analyses.append((source, analysis))
+
+    if batch_analyser is None:
+        batch_size = 1
+
+    chains: dict[str, asyncio.Future] = {}
+    for start in range(0, len(to_model), batch_size):
+        chunk = to_model[start:start + batch_size]
+        previous = [chains[email.message_id] for _, email in chunk
+                    if email.message_id in chains]
+        if batch_analyser is None:
+            _, email = chunk[0]
+            unit = asyncio.ensure_future(analyse_after(
+                previous, pool, header_analyser.process, email))
+            results = [unit]
+        else:
+            unit = asyncio.ensure_future(analyse_after(
+                previous, pool, batch_analyser.process_batch,
+                [email for _, email in chunk]))
+            results = [asyncio.ensure_future(batch_result(unit, i))
+                       for i in range(len(chunk))]
+
+        for (index, email), analysis in zip(chunk, results):
+            chains[email.message_id] = unit
+            analyses[index] = ("model", analysis)
+
+    return analyses
+
+async def keep_in_progress(pending: set, interval: float = IN_PROGRESS_INTERVAL):
+    """Periodically extend the ack deadline of messages still being worked on"""
+    while True:
+        await asyncio.sleep(interval)
+        for msg in list(pending):
+            logging.debug("Extending ack deadline for %s", msg.reply)
+            await msg.in_progress()
+
+async def handle_header_analysis(publisher: BatchPublisher, args, msg, email: EmailData,
+                                 header_analysis: HeaderAnalysis,
+                                 source: str, js=None) -> list[asyncio.Future]:
+    """Publish the results of the header analysis and ack the message
+
+    The message is acked once the results have been confirmed, and the
+    futures of the confirmations are returned. Tasks and notifications go
+    through JetStream only with --durable-outputs, as their streams are
+    optional. Results are published with a JetStream message ID derived
+    from the email's message_id, so that JetStream drops repeated results.
+    If the message is a header record, the full email is fetched from
+    JetStream through `js` when it needs further analysis, before anything
+    is published, and BodyUnavailableError is raised if it can't be
+    fetched.
+    """
+    logging.info("Header analysis (%s): %s", source, header_analysis)
+    if header_analysis.needs_analysis:
+        # The email is forwarded as received, in its encoding and with the
+        # reference to its body if that is in the Object Store
+        if is_header_record(msg.headers):
+            payload, forward_headers = await fetch_email(js, msg.headers)
+        else:
+            payload, forward_headers = msg.data, wire_headers(msg.headers)
+    header_analysis_data = header_analysis.model_dump_json().encode()
+
+    # Publish the header analysis result, with the sender for building
+    # sender reputation. The stream for these is optional, so they are not
+    # published through JetStream.
+    headers = {
+        "Analysis-Source": source,
+        "Email-Message-Id": email.message_id,
+    }
+    if email.from_:
+        headers["Email-From"] = email.from_[0]
+    subject = args.nats_email_header_analysis_subject
+    await publisher.publish(subject, header_analysis_data,
+                            headers=msg_id_headers(subject, email_key(email), headers),
+                            durable=False)
+
+    outputs = []
+
+    # Check if we need to analyse the full email
+    if header_analysis.needs_analysis:
+        logging.info(f"Further analysis needed: {header_analysis.analysis_reason}")
+        subject = args.nats_email_analyse_subject
+        outputs.append(await publisher.publish(
+            subject, payload,
+            headers=msg_id_headers(subject, email_key(email), forward_headers)))
+
+    else:
+        # Check if we need to notify the user
+        if header_analysis.notify:
+            logging.debug("Header analysis indicates notification needed")
+            message = ""
+            if header_analysis.is_important:
+                message = "Important email"
+            elif header_analysis.is_transactional:
+                message = "Transactional email"
+            else:
+                message = "Email"
+            if header_analysis.due_date:
+                message += f" with due date {header_analysis.due_date}"
+            notification = Notification(
+                title=header_analysis.clean_subject,
+                message=message,
+            )
+            subject = args.nats_notification_subject
+            outputs.append(await publisher.publish(
+                subject, notification.model_dump_json().encode(),
+                headers=msg_id_headers(subject, email_key(email)),
+                durable=args.durable_outputs))
+
+        # Check if we need to create a task
+        if header_analysis.is_important or header_analysis.is_transactional:
+            logging.debug("Header analysis indicates task needed")
+            task = Task(
+                action=header_analysis.clean_subject,
+                due_date=str(header_analysis.due_date or ""),
+            )
+            subject = args.nats_task_subject
+            outputs.append(await publisher.publish(
+                subject, task.model_dump_json().encode(),
+                headers=msg_id_headers(subject, email_key(email)),
+                durable=args.durable_outputs))
+
+    if not args.debug_skip_ack:
+        await publisher.ack(msg, outputs)
+    return outputs
+
 async def main():
     default_model = os.environ.get("REMOTE_MODEL", "4o-mini")
     default_nats = os.environ.get("NATS", "nats://localhost:4222")
+    default_cache = os.environ.get("ANALYSIS_CACHE")
+    default_similarity_db = os.environ.get("SIMILARITY_DB", DEFAULT_SIMILARITY_DB)
+    default_seen_db = os.environ.get("SEEN_DB", DEFAULT_SEEN_DB)
+    default_reputation_db = os.environ.get("SENDER_REPUTATION", DEFAULT_REPUTATION_DB)
 
     parser = argparse.ArgumentParser(
         description="Analyse email headers",
@@ -77,7 +273,8 @@ async def main():
     parser.add_argument("--nats", default=default_nats,
                         help="NATS server URL")
     parser.add_argument("--nats-stream", default="emails",
-                        help="NATS stream to subscribe to")
+                        help="NATS stream to subscribe to (emails, or header records "
+                             "published with mail-archiver.py --nats-headers-subject)")
     parser.add_argument("--nats-consumer", default="email-analyser",
                         help="NATS consumer name")
     parser.add_argument("--nats-subject", default="email.action",
@@ -92,13 +289,76 @@ async def main():
     parser.add_argument("--nats-email-header-analysis-subject",
                         default="email.header_analysis",
                         help="NATS subject to publish email header analysis results")
+    parser.add_argument("--cache", default=default_cache,
+                        help="SQLite file to cache analysis results in")
+    parser.add_argument("--cache-ttl", type=float, default=30 * 24 * 3600,
+                        help="Seconds to keep cached analysis results")
+    parser.add_argument("--cache-max-entries", type=int, default=100000,
+                        help="Maximum number of cached analysis results")
     parser.add_argument("--limit", type=int, default=50,
                         help="Number of messages to process (-1 for all)")
+    parser.add_argument("--preclassify", action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help="Classify obvious bulk email using rules instead of the model")
+    parser.add_argument("--rules", default=str(DEFAULT_RULES_FILE),
+                        help="YAML file with the pre-classification rules")
+    parser.add_argument("--trust-reputation", action=argparse.BooleanOptionalAction,
+                        help="Skip the model for senders with a stable verdict history")
+    parser.add_argument("--reputation-db", default=default_reputation_db,
+                        help="SQLite file with sender reputation")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="Number of emails to analyse in a single prompt")
+    parser.add_argument("--cascade",
+                        help="YAML file with model tiers to escalate header analysis through "
+                             "(overrides --model)")
+    parser.add_argument("--reuse-similar", action=argparse.BooleanOptionalAction,
+                        help="Reuse the analysis of near-duplicate emails, such as ones "
+                             "generated from the same template")
+    parser.add_argument("--similarity-db", default=default_similarity_db,
+                        help="SQLite file to store analysed emails in for near-duplicate detection")
+    parser.add_argument("--similarity-distance", type=int, default=3,
+                        help="Maximum number of differing fingerprint bits for near-duplicates")
+    parser.add_argument("--similarity-max-entries", type=int, default=100000,
+                        help="Maximum number of analysed emails to keep for near-duplicate detection")
+    parser.add_argument("--samples", action="append", default=[],
+                        help="YAML file or directory of labelled emails to pick the most "
+                             "relevant prompt samples from (can be repeated)")
+    parser.add_argument("--sample-count", type=int, default=3,
+                        help="Maximum number of samples to add to each prompt")
+    parser.add_argument("--sample-token-budget", type=int,
+                        help="Maximum tokens of samples to add to each prompt")
+    parser.add_argument("--retry-invalid", action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help="Ask the model to fix responses that are invalid and can't be repaired")
+    parser.add_argument("--dedupe", action=argparse.BooleanOptionalAction,
+                        help="Skip emails that have already been analysed")
+    parser.add_argument("--seen-db", default=default_seen_db,
+                        help="SQLite file to record analysed emails in for --dedupe")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of emails to analyse concurrently")
+    parser.add_argument("--fetch-batch", type=int, default=1,
+                        help="Number of messages to fetch at a time")
+    parser.add_argument("--publish-batch", type=int, default=50,
+                        help="Maximum number of publishes and acks to send together")
+    parser.add_argument("--publish-delay", type=float, default=0.05,
+                        help="Seconds to wait for more publishes and acks to batch")
+    parser.add_argument("--durable-outputs", action=argparse.BooleanOptionalAction,
+                        help="Publish tasks and notifications through JetStream, and ack "
+                        "emails only once they are stored (needs their streams)")
+    parser.add_argument("--nak-delay", type=float, default=30,
+                        help="Seconds before an email whose outputs failed is redelivered")
+    parser.add_argument("--max-deliveries", type=int, default=5,
+                        help="Stop redelivering an email whose outputs keep failing after "
+                        "this many deliveries (0 for no limit)")
     parser.add_argument("--debug", action=argparse.BooleanOptionalAction,
                         help="Enable debug logging")
     parser.add_argument("--debug-skip-ack", action=argparse.BooleanOptionalAction,
                         help="Skip acking messages for debugging")
+    add_metrics_arguments(parser)
+    add_follow_arguments(parser)
     args = parser.parse_args()
+    if args.cascade and args.batch_size > 1:
+        parser.error("--cascade cannot be used with --batch-size")
 
     logging.basicConfig(
         level=logging.DEBUG if args.debug else logging.INFO,
@@ -119,79 +379,197 @@ async def main():
                                    durable=args.nats_consumer)
 
     logging.debug(f"Creating mail analyser with model %s", args.model)
-    header_analyser = MailAnalyseHeaders(model=args.model)
+    cache = None
+    if args.cache:
+        logging.debug("Using analysis cache %s", args.cache)
+        cache = SQLiteCache(args.cache, ttl=args.cache_ttl,
+                            max_entries=args.cache_max_entries)
 
-    count = args.limit
-    while count > 0:
-        count -= 1
+    similar = None
+    if args.reuse_similar:
+        logging.debug("Using similarity index %s", args.similarity_db)
+        similar = SimilarityIndex(args.similarity_db,
+                                  max_entries=args.similarity_max_entries,
+                                  max_distance=args.similarity_distance)
 
-        try:
-            msgs = await psub.fetch(batch=1, timeout=10)
-            if not msgs:
-                logging.debug("No messages received, exiting")
-                break
+    batch_analyser = None
+    if args.batch_size > 1:
+        batch_analyser = MailAnalyseHeadersBatch(model=args.model, cache=cache,
+                                                 retry_invalid=args.retry_invalid)
 
-            for msg in msgs:
-                raw_data = msg.data.decode()
-                logging.debug("Received message: %s", raw_data)
+    preclassifier = None
+    if args.preclassify:
+        logging.debug("Loading pre-classification rules from %s", args.rules)
+        preclassifier = PreClassifier.from_yaml(args.rules)
 
-                try:
-                    email = EmailData.model_validate_json(raw_data)
-                except pydantic.ValidationError as e:
-                    logging.error("Error validating email: %s: %s", e, raw_data)
-                    continue
+    seen = None
+    if args.dedupe:
+        logging.debug("Recording analysed emails in %s", args.seen_db)
+        seen = SeenSet(args.seen_db, stage="header-analysis")
 
-                header_analysis = header_analyser.process(email)
-                logging.info("Header analysis: %s", header_analysis)
-                header_analysis_data = header_analysis.model_dump_json().encode()
+    sample_store = None
+    if args.samples:
+        sample_store = SampleStore.from_yaml(args.samples, "header_analysis",
+                                             HeaderAnalysis, k=args.sample_count,
+                                             token_budget=args.sample_token_budget)
+        logging.debug("Loaded %d samples from %s", len(sample_store), args.samples)
 
+    cascade = None
+    if args.cascade:
+        logging.debug("Loading model cascade from %s", args.cascade)
+        cascade = load_cascade(args.cascade, MailAnalyseHeaders,
+                               preclassifier or PreClassifier.from_yaml(args.rules),
+                               cache=cache, retry_invalid=args.retry_invalid,
+                               similar=similar, sample_store=sample_store)
+        header_analyser = cascade
+    else:
+        header_analyser = MailAnalyseHeaders(model=args.model, cache=cache,
+                                             retry_invalid=args.retry_invalid,
+                                             similar=similar, sample_store=sample_store)
+
+    reputation = None
+    if args.trust_reputation:
+        logging.debug("Loading sender reputation from %s", args.reputation_db)
+        reputation = SenderReputation(args.reputation_db)
+
+    # Emails are decoded from any encoding the archiver publishes them in
+    wire = WireFormat(js)
+
+    exporter = metrics_exporter(args, nc)
+    processed = MESSAGES.labels("header-analysis", "processed")
+    duplicates = MESSAGES.labels("header-analysis", "duplicate")
+    failed = MESSAGES.labels("header-analysis", "error")
+
+    publisher = BatchPublisher(nc, max_batch=args.publish_batch,
+                               max_delay=args.publish_delay, stage="header-analysis",
+                               nak_delay=args.nak_delay, max_deliveries=args.max_deliveries)
+
+    logging.debug("Starting worker pool with %d workers", args.workers)
+    pool = ThreadPoolExecutor(max_workers=args.workers)
+
+    consumer = PullConsumer(psub, batch=args.fetch_batch, timeout=10,
+                            limit=args.limit, follow=args.follow,
+                            max_batch=args.max_fetch_batch, max_idle=args.max_idle,
+                            stage="header-analysis")
+    consumer.stop_on_signals()
+
+    async for msgs in consumer.batches():
+        received = []
+        for msg in msgs:
+            logging.debug("Received message: %s", msg.data)
+
+            try:
+                # Header records are analysed without the body, which is
+                # only fetched for emails that need further analysis
+                if is_header_record(msg.headers):
+                    email = header_email(EmailHeaders.model_validate_json(msg.data))
+                else:
+                    email = await wire.decode(msg.data, msg.headers)
+            except BodyUnavailableError as e:
+                # Redelivered after a delay, in case the fetch failed temporarily
+                logging.error("Error fetching email body: %s", e)
+                failed.inc()
+                await publisher.reject(msg)
+                continue
+            except ValueError as e:
+                logging.error("Error validating email: %s: %s", e, msg.data)
+                failed.inc()
                 if not args.debug_skip_ack:
-                    await msg.ack()
+                    await publisher.ack(msg)
+                continue
+
+            # Duplicates are dropped before any analysis, including ones of
+            # emails earlier in the same batch
+            if seen is not None and not seen.claim(email_key(email)):
+                logging.info("Skipping duplicate email %s", email.message_id)
+                duplicates.inc()
+                if not args.debug_skip_ack:
+                    await publisher.ack(msg)
+                continue
+
+            received.append((msg, email))
 
-                # Publish the header analysis result
-                await nc.publish(args.nats_email_header_analysis_subject,
-                                 header_analysis_data)
+        analyses = analyse_batch(pool, header_analyser,
+                                 [email for _, email in received],
+                                 preclassifier, reputation,
+                                 batch_analyser, args.batch_size)
 
-                # Check if we need to analyse the full email
-                if header_analysis.needs_analysis:
-                    logging.info(f"Further analysis needed: {header_analysis.analysis_reason}")
-                    await nc.publish(args.nats_email_analyse_subject,
-                                     msg.data)
+        # Keep JetStream from redelivering messages still being analysed
+        pending = {msg for msg, _ in received}
+        heartbeat = asyncio.create_task(keep_in_progress(pending))
+        try:
+            # Results are handled in the order the messages were fetched
+            for (msg, email), (source, analysis) in zip(received, analyses):
+                try:
+                    header_analysis = await analysis
+                except (pydantic.ValidationError, ValueError) as e:
+                    # Including batch responses with the wrong email IDs
+                    logging.error("Error analysing email: %s: %s", e, email.model_dump_json())
+                    failed.inc()
+                    pending.discard(msg)
+                    if not args.debug_skip_ack:
+                        await publisher.ack(msg)
+                    if seen is not None:
+                        seen.release(email_key(email))
+                    continue
+                pending.discard(msg)
+                try:
+                    outputs = await handle_header_analysis(publisher, args, msg, email,
+                                                           header_analysis, source, js)
+                except BodyUnavailableError as e:
+                    # The full email was purged or fetching it failed, so
+                    # retry after a delay, a bounded number of times
+                    logging.error("Error fetching email %s: %s", email.message_id, e)
+                    failed.inc()
+                    await publisher.reject(msg)
+                    if seen is not None:
+                        seen.release(email_key(email))
                     continue
+                processed.inc()
+                if seen is not None:
+                    seen.add_when_confirmed(email_key(email), outputs)
+        finally:
+            heartbeat.cancel()
+
+    pool.shutdown()
+    await publisher.close()
+    logging.info("Published %(published)d messages, acked %(acked)d, nak'd %(nakd)d, "
+                 "terminated %(terminated)d",
+                 publisher.stats())
+
+    if preclassifier is not None:
+        logging.info("Pre-classifier: %(matched)d model calls saved, "
+                     "%(fallthrough)d sent to the model", preclassifier.stats())
+
+    analysers = [header_analyser] + ([batch_analyser] if batch_analyser else [])
+    logging.info("Model responses: %(valid)d valid, %(repaired)d repaired, "
+                 "%(retried)d retried, %(invalid)d invalid",
+                 merge_repair_stats(analysers))
+
+    if cascade is not None:
+        for tier, stats in cascade.stats().items():
+            logging.info("Cascade %s: %s", tier, stats)
+
+    if reputation is not None:
+        logging.info("Sender reputation: %(trusted)d model calls saved, "
+                     "%(untrusted)d sent to the model", reputation.stats())
+        reputation.close()
+
+    if seen is not None:
+        logging.info("Dedupe: %(duplicates)d of %(checked)d emails skipped as duplicates",
+                     seen.stats())
+        seen.close()
+
+    if similar is not None:
+        logging.info("Similarity index: %(hits)d near-duplicates found, %(misses)d not found, "
+                     "%(entries)d emails indexed", similar.stats())
+        similar.close()
 
-                # Check if we need to notify the user
-                if header_analysis.notify:
-                    logging.debug("Header analysis indicates notification needed")
-                    message = ""
-                    if header_analysis.is_important:
-                        message = "Important email"
-                    elif header_analysis.is_transactional:
-                        message = "Transactional email"
-                    else:
-                        message = "Email"
-                    if header_analysis.due_date:
-                        message += f" with due date {header_analysis.due_date}"
-                    notification = Notification(
-                        title=header_analysis.clean_subject,
-                        message=message,
-                    )
-                    await nc.publish(args.nats_notification_subject,
-                                     notification.model_dump_json().encode())
-
-                # Check if we need to create a task
-                if header_analysis.is_important or header_analysis.is_transactional:
-                    logging.debug("Header analysis indicates task needed")
-                    task = Task(
-                        action=header_analysis.clean_subject,
-                        due_date=header_analysis.due_date,
-                    )
-                    await nc.publish(args.nats_task_subject,
-                                     task.model_dump_json().encode())
-
-        except nats.errors.TimeoutError:
-            logging.debug("Timeout waiting for messages, exiting")
-            break
+    if cache is not None:
+        logging.info("Analysis cache: %(hits)d hits, %(misses)d misses", cache.stats())
+        cache.close()
 
+    await exporter.close()
     await nc.close()
 
 if __name__ == '__main__':
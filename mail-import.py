@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# Bulk import of an mbox file or Maildir directory. Emails are parsed across a
+# pool of processes and published to NATS, for backfilling the archive.
+
+import argparse
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import datetime
+import logging
+import mailbox
+import nats
+import os
+from pathlib import Path
+import sys
+import time
+from typing import Optional
+
+from archiver import PARSERS, parse_email_timed
+from dedupe import msg_id_headers
+from wire import WireFormat, add_wire_arguments, wire_format
+from models import EmailParseError
+
+class StageTimes:
+    """Total time spent in each stage of the import"""
+
+    def __init__(self, stages: list[str]):
+        self.totals = {stage: 0.0 for stage in stages}
+
+    def add(self, stage: str, seconds: float):
+        self.totals[stage] += seconds
+
+    def summary(self, count: int) -> str:
+        return ", ".join(f"{stage} {total / max(count, 1) * 1000:.1f}ms"
+                         for stage, total in self.totals.items())
+
+def open_mailbox(path: Path) -> mailbox.Mailbox:
+    """Open an mbox file or Maildir directory"""
+    if path.is_dir():
+        return mailbox.Maildir(path, factory=None, create=False)
+    return mailbox.mbox(path, factory=None, create=False)
+
+class MailboxImport:
+    """Import of the emails of a mailbox
+
+    Emails are parsed on `pool` and published with `publish`, with at most
+    `max_in_flight` of them being parsed or published at once. Emails that
+    can't be parsed are published to `error_subject` instead. Emails that
+    fail to parse or to publish are counted as failed, and the import
+    carries on with the next ones.
+    """
+
+    def __init__(self, pool: Executor, publish, wire: WireFormat, parser: str,
+                 subject: str, error_subject: str, source: str, max_in_flight: int):
+        self.pool = pool
+        self.publish = publish
+        self.wire = wire
+        self.parser = parser
+        self.subject = subject
+        self.error_subject = error_subject
+        self.source = source
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.times = StageTimes(["read", "parse", "publish"])
+        self.imported = 0
+        self.failed = 0
+
+    async def publish_email(self, key: str, email: bytes) -> bool:
+        """Parse and publish an email, returning whether it could be parsed"""
+        loop = asyncio.get_running_loop()
+        try:
+            data, parse_time = await loop.run_in_executor(
+                self.pool, parse_email_timed, email, self.parser)
+            self.times.add("parse", parse_time)
+        except Exception as e:
+            logging.error("Error parsing %s: %s", key, e)
+            error = EmailParseError(sender=f"{self.source}:{key}",
+                                    date=str(datetime.now()), error=str(e))
+            await self.publish(self.error_subject, error.model_dump_json().encode())
+            return False
+
+        start = time.perf_counter()
+        # Emails imported again within the stream's duplicate window are
+        # dropped by JetStream
+        payload, headers = await self.wire.encode(data)
+        await self.publish(self.subject, payload,
+                           headers=msg_id_headers(self.subject, data.message_id, headers))
+        self.times.add("publish", time.perf_counter() - start)
+        return True
+
+    async def import_email(self, key: str, email: bytes):
+        try:
+            if await self.publish_email(key, email):
+                self.imported += 1
+            else:
+                self.failed += 1
+        except Exception as e:
+            logging.error("Error publishing %s: %s", key, e)
+            self.failed += 1
+        finally:
+            self.in_flight.release()
+
+    async def run(self, box: mailbox.Mailbox):
+        """Import all the emails of the mailbox"""
+        tasks = set()
+        for key in box.iterkeys():
+            await self.in_flight.acquire()
+
+            start = time.perf_counter()
+            email = box.get_bytes(key)
+            self.times.add("read", time.perf_counter() - start)
+
+            task = asyncio.create_task(self.import_email(key, email))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        await asyncio.gather(*tasks)
+
+async def main():
+    default_nats = os.environ.get("NATS", "nats://localhost:4222")
+
+    parser = argparse.ArgumentParser(
+        description="Import emails from an mbox file or Maildir directory",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--nats-server", "-s", default=default_nats, help="NATS server URL")
+    parser.add_argument("--nats-subject", default="email.parsed", help="NATS subject to publish to")
+    parser.add_argument("--nats-error-subject", default="email.error", help="NATS subject to publish errors to")
+    parser.add_argument("--jetstream", action=argparse.BooleanOptionalAction, default=True,
+                        help="Wait for JetStream to acknowledge each published email")
+    parser.add_argument("--parser", choices=PARSERS, default="unstructured",
+                        help="Email parser to use (auto picks per email)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes to parse emails with")
+    parser.add_argument("--max-in-flight", type=int, default=0,
+                        help="Maximum number of emails being parsed or published (0 for 4 per worker)")
+    parser.add_argument("--report-interval", type=float, default=10,
+                        help="Seconds between progress reports")
+    add_wire_arguments(parser)
+    parser.add_argument("--debug", action=argparse.BooleanOptionalAction,
+                        help="Enable debug logging")
+    parser.add_argument("mailbox", type=Path, help="mbox file or Maildir directory to import")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s")
+
+    async def error_handler(e):
+        logging.error("Error: %s", e)
+        sys.exit(1)
+
+    logging.debug("Connecting to NATS server at %s", args.nats_server)
+    nc = await nats.connect(args.nats_server, error_cb=error_handler)
+    js = nc.jetstream()
+    wire = wire_format(args, js)
+
+    async def publish(subject: str, data: bytes, headers: Optional[dict] = None):
+        if args.jetstream:
+            # Waiting for the acknowledgement applies back-pressure when
+            # JetStream falls behind
+            await js.publish(subject, data, headers=headers)
+        else:
+            await nc.publish(subject, data, headers=headers)
+
+    logging.info("Importing %s with %d workers", args.mailbox, args.workers)
+    started = time.perf_counter()
+
+    def log_progress():
+        done = importer.imported + importer.failed
+        elapsed = time.perf_counter() - started
+        logging.info("Imported %d emails (%d failed) in %.1fs, %.1f emails/s; per email: %s",
+                     importer.imported, importer.failed, elapsed, done / elapsed,
+                     importer.times.summary(done))
+
+    async def report():
+        while True:
+            await asyncio.sleep(args.report_interval)
+            log_progress()
+
+    box = open_mailbox(args.mailbox)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        importer = MailboxImport(pool, publish, wire, args.parser, args.nats_subject,
+                                 args.nats_error_subject, str(args.mailbox),
+                                 args.max_in_flight or 4 * args.workers)
+        reporter = asyncio.create_task(report())
+        await importer.run(box)
+
+    reporter.cancel()
+    box.close()
+    log_progress()
+
+    await nc.drain()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,103 +1,503 @@
 import abc
-import llm
+import asyncio
+from concurrent.futures import Executor
+import functools
+import json
 import logging
-from typing import Any
+from pathlib import Path
+import pydantic
+import string
+import threading
+from typing import Any, Optional
 import yaml
 
-from models import EmailData, HeaderAnalysis, EmailAction, Notification, Task
+from analysis_cache import ResultCache, cache_key
+from body_reduction import estimate_tokens, reduce_body, token_budget
+from json_repair import repair_response
+from metrics import ERRORS, STEP_SECONDS, record_tokens
+from model_server import get_models
+from near_duplicates import SimilarityIndex, adapt_response
+from sample_store import SampleStore
+from models import (EmailData, HeaderAnalysis, EmailAction, EmailHeaderAnalysis,
+                    HeaderAnalysisBatch, Notification, Task)
 
 logger = logging.getLogger(__name__)
 
+PROMPTS_FILE = Path(__file__).parent / "prompts.yaml"
+
+@functools.cache
+def load_prompts(path: Path = PROMPTS_FILE) -> dict[str, str]:
+    """Load the prompt templates, once per process"""
+    with open(path, "r") as f:
+        return yaml.safe_load(f)
+
+def split_template(template: str) -> tuple[str, str]:
+    """Split a prompt template into the templates before and after {prompt_data}"""
+    prefix: list[str] = []
+    suffix: list[str] = []
+    target = prefix
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        target.append(literal.replace("{", "{{").replace("}", "}}"))
+        if field == "prompt_data":
+            target = suffix
+        elif field is not None:
+            conversion = f"!{conversion}" if conversion else ""
+            spec = f":{spec}" if spec else ""
+            target.append(f"{{{field}{conversion}{spec}}}")
+    return "".join(prefix), "".join(suffix)
+
 class MailAnalyserBase(abc.ABC):
-    """Base class for mail analyser"""
+    """Base class for mail analyser
+
+    Responses that fail validation are repaired if possible, and otherwise
+    the model is asked once to fix its response (unless `retry_invalid` is
+    False), without sending the email again.
+
+    With a similarity index, the response for a near-duplicate of an email
+    that was already analysed is reused instead of prompting the model.
 
-    def __init__(self, model, prompt_tag, response_schema, model_supports_schemas=True):
-        self.model = llm.get_model(model)
+    With a sample store, the samples most relevant to each email are added
+    to its prompt, after the samples added with add_sample().
+    """
+
+    def __init__(self, model, prompt_tag, response_schema, model_supports_schemas=True,
+                 cache: Optional[ResultCache] = None,
+                 executor: Optional[Executor] = None,
+                 retry_invalid: bool = True,
+                 similar: Optional[SimilarityIndex] = None,
+                 sample_store: Optional[SampleStore] = None):
+        self.model, self.async_model = get_models(model)
+        self.retry_invalid = retry_invalid
+        self.similar = similar
+        self.sample_store = sample_store
+        self.executor = executor
         self.prompt_tag = prompt_tag
         self.response_schema = response_schema
         self.model_supports_schemas = model_supports_schemas
+        self.cache = cache
         self.samples = []
 
-        with open("prompts.yaml", "r") as f:
-            prompts = yaml.safe_load(f)
+        prompts = load_prompts()
         if prompt_tag not in prompts:
             raise ValueError(f"Prompt tag '{prompt_tag}' not found in prompts.yml")
         self.prompt = prompts[prompt_tag]
         self.no_schema_instructions = prompts.get("no_schema_instructions", "")
+        self.repair_template = prompts["repair_json"]
+
+        self.lock = threading.Lock()
+        self.valid = 0
+        self.repaired = 0
+        self.retried = 0
+        self.invalid = 0
+
+        self.prompt_seconds = STEP_SECONDS.labels(prompt_tag, "prompt")
+        self.model_seconds = STEP_SECONDS.labels(prompt_tag, "model")
+        self.validate_seconds = STEP_SECONDS.labels(prompt_tag, "validate")
+        self.validation_errors = ERRORS.labels(prompt_tag, "validate")
+
+        # Everything before the email data is rendered once and reused, so
+        # that it is also a stable prefix for providers that cache prompts
+        self.prefix_template, self.suffix_template = split_template(self.prompt)
+        self._prompt_parts: Optional[tuple[str, str]] = None
 
     def add_sample(self, email: EmailData, response: Any):
         """Add a sample to the prompt"""
         self.samples.append((email, response))
+        self._prompt_parts = None
 
     @abc.abstractmethod
     def prompt_data(self, email: EmailData) -> str:
         """Generate the prompt data for the email"""
         pass
 
+    def render_samples(self, samples: Optional[list[tuple[Any, Any]]] = None) -> str:
+        """Render the samples for the prompt"""
+        if samples is None:
+            samples = self.samples
+        return "".join(
+            f"user: {self.prompt_data(email)}\nassistant: {response.model_dump_json()}\n"
+            for email, response in samples)
+
+    def render_parts(self, samples: list[tuple[Any, Any]]) -> tuple[str, str]:
+        """Render the parts of the prompt before and after the email data"""
+        rendered = self.render_samples(samples)
+        prefix = self.prefix_template.format(samples=rendered)
+        suffix = self.suffix_template.format(samples=rendered)
+        if not self.model_supports_schemas:
+            suffix = f"{suffix}\n\n{self.no_schema_instructions}"
+        return prefix, suffix
+
+    def prompt_parts(self) -> tuple[str, str]:
+        """Return the rendered parts of the prompt before and after the email data"""
+        if self._prompt_parts is None:
+            self._prompt_parts = self.render_parts(self.samples)
+        return self._prompt_parts
+
+    def select_samples(self, email: EmailData) -> list[tuple[EmailData, Any]]:
+        """Select the samples from the sample store that are relevant to the email"""
+        if self.sample_store is None or not isinstance(email, EmailData):
+            return []
+        model_id = self.model.model_id
+        return self.sample_store.select(
+            email, cost=lambda sample: estimate_tokens(self.render_samples([sample]), model_id))
+
     def get_prompt(self, email: EmailData) -> str:
         """Generate the prompt for the email"""
-        if not self.model_supports_schemas and not self.samples:
+        selected = self.select_samples(email)
+        if not self.model_supports_schemas and not self.samples and not selected:
             raise ValueError("Need at least one sample as the model does not support schemas")
 
         prompt_data = self.prompt_data(email)
         if not self.model_supports_schemas:
             prompt_data = f"user: {prompt_data}"
 
-        samples = ""
-        for email, response in self.samples:
-            samples += f"user: {self.prompt_data(email)}\nassistant: {response.model_dump_json()}\n"
-
-        prompt = self.prompt.format(prompt_data=prompt_data, samples=samples)
-
-        if not self.model_supports_schemas:
-            prompt = f"{prompt}\n\n{self.no_schema_instructions}"
+        if selected:
+            prefix, suffix = self.render_parts(self.samples + selected)
+        else:
+            prefix, suffix = self.prompt_parts()
+        prompt = "".join((prefix, prompt_data, suffix))
 
         logger.debug("Prompt: %s", prompt)
 
         return prompt
 
-    def process(self, email: EmailData) -> Any:
-        """Process the email data and generate a response of the specified type"""
+    def cached_response(self, prompt: str) -> tuple[Optional[str], Any]:
+        """Look up the response to the prompt in the cache
 
-        # Generate the prompt for the email
-        prompt = self.get_prompt(email)
+        Returns the cache key for the prompt (None without a cache) and the
+        cached response, if any.
+        """
+        if self.cache is None:
+            return None, None
+
+        key = cache_key(self.model.model_id, self.prompt_tag, prompt,
+                        self.response_schema)
+        cached = self.cache.get(key)
+        if cached is None:
+            return key, None
+        logger.debug("Cached response: %s", cached)
+        return key, self.response_schema.model_validate_json(cached)
 
+    def prompt_kwargs(self) -> dict[str, Any]:
+        """Keyword arguments for prompting the model"""
         kwargs = {}
         if self.model_supports_schemas:
             kwargs["schema"] = self.response_schema
-        response_data = self.model.prompt(prompt, **kwargs).text()
+        return kwargs
+
+    def count(self, outcome: str):
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def validate_response(self, response_data: str) -> Any:
+        """Validate the model response, repairing it if needed"""
         logger.debug("Response data: %s", response_data)
-        response = self.response_schema.model_validate_json(response_data)
+        try:
+            with self.validate_seconds.time():
+                response = self.response_schema.model_validate_json(response_data)
+            self.count("valid")
+        except pydantic.ValidationError:
+            response = repair_response(response_data, self.response_schema)
+            if response is None:
+                self.validation_errors.inc()
+                raise
+            logger.debug("Repaired response")
+            self.count("repaired")
         logger.debug("Response: %s", response)
+        return response
 
+    def repair_prompt(self, response_data: str, error: pydantic.ValidationError) -> str:
+        """Generate a short prompt asking the model to fix its response"""
+        return self.repair_template.format(
+            schema=json.dumps(self.response_schema.model_json_schema()),
+            errors="\n".join(f"- {'.'.join(map(str, e['loc']))}: {e['msg']}"
+                             for e in error.errors()),
+            response=response_data)
+
+    def retry_prompt(self, response_data: str, error: pydantic.ValidationError) -> str:
+        """Return the prompt to retry an invalid response with
+
+        Re-raises the validation error if invalid responses are not retried.
+        """
+        if not self.retry_invalid:
+            self.count("invalid")
+            raise error
+        logger.info("Invalid response, asking the model to fix it: %s", error)
+        self.count("retried")
+        return self.repair_prompt(response_data, error)
+
+    def validate_retry(self, response_data: str) -> Any:
+        """Validate the response to a retry, which is not retried again"""
+        try:
+            return self.validate_response(response_data)
+        except pydantic.ValidationError:
+            self.count("invalid")
+            raise
+
+    def cache_response(self, key: Optional[str], response: Any) -> Any:
+        """Cache the validated response"""
+        if key is not None:
+            self.cache.put(key, response.model_dump_json())
         return response
 
+    def similarity_text(self, email: EmailData) -> Optional[str]:
+        """Return the text near-duplicates are detected on, or None to not look"""
+        return f"{email.subject}\n{email.body}"
+
+    # Maximum distance of near-duplicates, if stricter than the index's
+    similarity_distance: Optional[int] = None
+
+    def similar_response(self, email: EmailData) -> Any:
+        """Return the response adapted from a near-duplicate of the email, if any"""
+        if self.similar is None:
+            return None
+        text = self.similarity_text(email)
+        if text is None:
+            return None
+        match = self.similar.lookup(self.prompt_tag, email, text, self.similarity_distance)
+        if match is None:
+            return None
+
+        old_text, old_response = match
+        response = adapt_response(self.response_schema.model_validate_json(old_response),
+                                  old_text, text)
+        if response is not None:
+            logger.debug("Reusing the response for a near-duplicate: %s", response)
+        return response
+
+    def remember(self, email: EmailData, response: Any) -> Any:
+        """Index the response, for reuse with near-duplicates of the email"""
+        if self.similar is not None:
+            text = self.similarity_text(email)
+            if text is not None:
+                self.similar.add(self.prompt_tag, email, text, response.model_dump_json())
+        return response
+
+    def prompt_model(self, prompt: str) -> str:
+        """Prompt the model and return the text of its response"""
+        with self.model_seconds.time():
+            response = self.model.prompt(prompt, **self.prompt_kwargs())
+            text = response.text()
+        record_tokens(self.model.model_id, response)
+        return text
+
+    async def aprompt_model(self, prompt: str, timeout: Optional[float] = None) -> str:
+        """Prompt the model without blocking the event loop"""
+        if self.async_model is not None:
+            response = self.async_model.prompt(prompt, **self.prompt_kwargs())
+            with self.model_seconds.time():
+                text = await asyncio.wait_for(response.text(), timeout)
+            record_tokens(self.async_model.model_id, response)
+            return text
+
+        # The time and tokens are recorded by prompt_model()
+        loop = asyncio.get_running_loop()
+        call = loop.run_in_executor(self.executor, self.prompt_model, prompt)
+        return await asyncio.wait_for(call, timeout)
+
+    def process(self, email: EmailData) -> Any:
+        """Process the email data and generate a response of the specified type"""
+
+        # Generate the prompt for the email
+        with self.prompt_seconds.time():
+            prompt = self.get_prompt(email)
+
+        key, cached = self.cached_response(prompt)
+        if cached is not None:
+            return cached
+
+        similar = self.similar_response(email)
+        if similar is not None:
+            return similar
+
+        response_data = self.prompt_model(prompt)
+        try:
+            response = self.validate_response(response_data)
+        except pydantic.ValidationError as e:
+            retry = self.retry_prompt(response_data, e)
+            response = self.validate_retry(self.prompt_model(retry))
+        return self.remember(email, self.cache_response(key, response))
+
+    async def aprocess(self, email: EmailData, timeout: Optional[float] = None) -> Any:
+        """Process the email data without blocking the event loop
+
+        Uses the async version of the model if there is one, and otherwise
+        prompts the model on the executor. Raises TimeoutError if the model
+        takes longer than `timeout` seconds. A model call running on the
+        executor cannot be interrupted, so its result is discarded instead.
+        """
+
+        # Generate the prompt for the email
+        with self.prompt_seconds.time():
+            prompt = self.get_prompt(email)
+
+        key, cached = self.cached_response(prompt)
+        if cached is not None:
+            return cached
+
+        similar = self.similar_response(email)
+        if similar is not None:
+            return similar
+
+        response_data = await self.aprompt_model(prompt, timeout)
+        try:
+            response = self.validate_response(response_data)
+        except pydantic.ValidationError as e:
+            retry = self.retry_prompt(response_data, e)
+            response = self.validate_retry(await self.aprompt_model(retry, timeout))
+        return self.remember(email, self.cache_response(key, response))
+
+    def repair_stats(self) -> dict[str, int]:
+        """Return how many responses were valid, repaired, retried or invalid"""
+        with self.lock:
+            return {"valid": self.valid, "repaired": self.repaired,
+                    "retried": self.retried, "invalid": self.invalid}
+
+    async def aprocess_many(self, emails: list[EmailData], concurrency: int = 4,
+                            timeout: Optional[float] = None,
+                            return_exceptions: bool = False) -> list[Any]:
+        """Process several emails, at most `concurrency` at a time
+
+        Results are returned in the order of the emails. With
+        `return_exceptions`, failures are returned in place of their results
+        instead of being raised.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def process(email: EmailData) -> Any:
+            async with semaphore:
+                return await self.aprocess(email, timeout)
+
+        return await asyncio.gather(*(process(email) for email in emails),
+                                    return_exceptions=return_exceptions)
+
+def merge_repair_stats(analysers: list) -> dict[str, int]:
+    """Add up the repair statistics of several analysers"""
+    totals = {"valid": 0, "repaired": 0, "retried": 0, "invalid": 0}
+    for analyser in analysers:
+        for outcome, count in analyser.repair_stats().items():
+            totals[outcome] += count
+    return totals
+
 class MailAnalyseHeaders(MailAnalyserBase):
     """Analyse mail using only email headers"""
 
-    def __init__(self, model, model_supports_schemas=True):
+    def __init__(self, model, model_supports_schemas=True, cache=None, executor=None,
+                 retry_invalid=True, similar=None, sample_store=None):
         super().__init__(
             model=model,
             prompt_tag="email_headers",
             response_schema=HeaderAnalysis,
             model_supports_schemas=model_supports_schemas,
+            cache=cache,
+            executor=executor,
+            retry_invalid=retry_invalid,
+            similar=similar,
+            sample_store=sample_store,
         )
 
     def prompt_data(self, email: EmailData) -> str:
         """Generate the prompt data for the email headers"""
         return email.model_dump_json(exclude={"body"})
 
+    # A word like "shipped" or "cancelled" in a short subject decides the
+    # analysis, so only subjects differing in numbers and dates are reused
+    similarity_distance = 0
+
+    def similarity_text(self, email: EmailData) -> Optional[str]:
+        """Detect near-duplicates on the subject and the list and automation headers"""
+        headers = "".join(f"\n{name}: {value}" for name, value in sorted(email.headers.items()))
+        return f"{email.subject}{headers}"
+
+class MailAnalyseHeadersBatch(MailAnalyserBase):
+    """Analyse the headers of several emails in a single prompt"""
+
+    def __init__(self, model, model_supports_schemas=True, cache=None, executor=None,
+                 retry_invalid=True, similar=None, sample_store=None):
+        super().__init__(
+            model=model,
+            prompt_tag="email_headers_batch",
+            response_schema=HeaderAnalysisBatch,
+            model_supports_schemas=model_supports_schemas,
+            cache=cache,
+            executor=executor,
+            retry_invalid=retry_invalid,
+            similar=similar,
+            sample_store=sample_store,
+        )
+
+    def add_sample(self, email: EmailData, response: HeaderAnalysis):
+        """Add a sample to the prompt, as a batch of one email"""
+        super().add_sample([email], HeaderAnalysisBatch(analyses=[
+            EmailHeaderAnalysis(email_id=0, **response.model_dump())]))
+
+    def prompt_data(self, emails: list[EmailData]) -> str:
+        """Generate the prompt data for the headers of a batch of emails"""
+        return json.dumps([
+            {"email_id": i, **email.model_dump(mode="json", exclude={"body"})}
+            for i, email in enumerate(emails)
+        ])
+
+    def similarity_text(self, emails: list[EmailData]) -> Optional[str]:
+        """Batches are not checked for near-duplicates"""
+        return None
+
+    def process_batch(self, emails: list[EmailData]) -> list[HeaderAnalysis]:
+        """Analyse the headers of a batch of emails
+
+        If the response for the batch fails validation, the batch is split
+        in two and each half is analysed separately.
+        """
+        try:
+            batch = self.process(emails)
+            analyses = {a.email_id: a for a in batch.analyses}
+            if sorted(analyses) != list(range(len(emails))):
+                raise ValueError(f"Expected {len(emails)} analyses, got "
+                                 f"email IDs {sorted(analyses)}")
+        except (pydantic.ValidationError, ValueError) as e:
+            if len(emails) == 1:
+                raise
+            logger.warning("Splitting batch of %d emails: %s", len(emails), e)
+            half = len(emails) // 2
+            return self.process_batch(emails[:half]) + self.process_batch(emails[half:])
+
+        return [HeaderAnalysis.model_validate(analyses[i].model_dump(exclude={"email_id"}))
+                for i in range(len(emails))]
+
 class MailAnalyse(MailAnalyserBase):
-    """Analyse mail using the full email data"""
+    """Analyse mail using the full email data
 
-    def __init__(self, model, model_supports_schemas=True):
+    Unless `reduce_body` is False, the body is stripped of quoted history and
+    boilerplate and cut down to `body_token_budget` tokens (by default, the
+    budget for the model) before it is added to the prompt.
+    """
+
+    def __init__(self, model, model_supports_schemas=True, cache=None, executor=None,
+                 retry_invalid=True, similar=None, sample_store=None, reduce_body=True,
+                 body_token_budget: Optional[int] = None):
         super().__init__(
             model=model,
             prompt_tag="email_full",
             response_schema=EmailAction,
             model_supports_schemas=model_supports_schemas,
+            cache=cache,
+            executor=executor,
+            retry_invalid=retry_invalid,
+            similar=similar,
+            sample_store=sample_store,
         )
+        self.reduce_body = reduce_body
+        self.body_token_budget = body_token_budget or token_budget(self.model.model_id)
 
     def prompt_data(self, email: EmailData) -> str:
         """Generate the prompt data for the full email"""
-        return email.model_dump_json()
+        if not self.reduce_body:
+            return email.model_dump_json()
+
+        model_id = self.model.model_id
+        body = reduce_body(email.body, self.body_token_budget, model_id)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Reduced body of %s from %d to %d tokens", email.message_id,
+                        estimate_tokens(email.body, model_id),
+                        estimate_tokens(body, model_id))
+        return email.model_copy(update={"body": body}).model_dump_json()
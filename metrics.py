@@ -0,0 +1,331 @@
+# Instrumentation of the pipeline: histograms of the time spent in each step
+# of a stage, model token counts, queue lag and message and error counters.
+# Metrics are exposed in the Prometheus text format on a local HTTP endpoint,
+# and can also be published as periodic JSON summaries on a NATS subject.
+#
+# Metrics are recorded on children bound to their labels ahead of time, so
+# recording one is a lock and an addition, with no formatting until the
+# metrics are rendered.
+
+import asyncio
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+from pathlib import Path
+import sys
+import threading
+import time
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Bucket upper bounds in seconds, for steps and for queue lag
+STEP_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                1, 2.5, 5, 10, 30, 60, 120, 300)
+LAG_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 4 * 3600, 24 * 3600)
+
+# Percentiles estimated from the buckets for the NATS summaries
+PERCENTILES = (0.5, 0.95, 0.99)
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Counter:
+    """Counter for one combination of label values"""
+
+    __slots__ = ("lock", "value")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+class Timer:
+    """Context manager observing the time spent in its block"""
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: "Histogram"):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class Histogram:
+    """Histogram for one combination of label values"""
+
+    __slots__ = ("lock", "buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        # The last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> Timer:
+        """Observe the time spent in a `with` block"""
+        return Timer(self)
+
+    def snapshot(self) -> tuple[list[int], float, int]:
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+    def percentile(self, counts: list[int], count: int, q: float) -> float:
+        """Estimate a percentile as the upper bound of the bucket it falls in"""
+        rank = q * count
+        seen = 0
+        for bound, n in zip(self.buckets, counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class Metric:
+    """A named metric, with a child per combination of label values"""
+
+    def __init__(self, name: str, help: str, kind: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = STEP_BUCKETS):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label_names = labels
+        self.buckets = buckets
+        self.children: dict[tuple[str, ...], Any] = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values: str):
+        """Return the child for the label values, to record metrics on"""
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} has labels {self.label_names}, got {values}")
+            with self.lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = Histogram(self.buckets) if self.kind == "histogram" else Counter()
+                    self.children[values] = child
+        return child
+
+    def items(self) -> list[tuple[tuple[str, ...], Any]]:
+        with self.lock:
+            return sorted(self.children.items())
+
+    def render(self) -> list[str]:
+        """Render the metric in the Prometheus text format"""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in self.items():
+            if self.kind == "counter":
+                labels = format_labels(self.label_names, values)
+                lines.append(f"{self.name}{labels} {format_value(child.value)}")
+                continue
+            counts, total, count = child.snapshot()
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                labels = format_labels(self.label_names, values, f'le="{format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, values)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+    def summary(self) -> list[dict[str, Any]]:
+        """Summarise the metric, with estimated percentiles for histograms"""
+        summary = []
+        for values, child in self.items():
+            entry: dict[str, Any] = dict(zip(self.label_names, values))
+            if self.kind == "counter":
+                entry["value"] = child.value
+            else:
+                counts, total, count = child.snapshot()
+                entry.update(count=count, sum=round(total, 6))
+                for q in PERCENTILES:
+                    entry[f"p{round(q * 100)}"] = (child.percentile(counts, count, q)
+                                                   if count else None)
+            summary.append(entry)
+        return summary
+
+class Registry:
+    """Collection of the metrics of a process"""
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Metric:
+        return self.register(Metric(name, help, "counter", labels))
+
+    def histogram(self, name: str, help: str, labels: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = STEP_BUCKETS) -> Metric:
+        return self.register(Metric(name, help, "histogram", labels, buckets))
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text format"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict[str, list[dict[str, Any]]]:
+        return {name: metric.summary() for name, metric in self.metrics.items()
+                if metric.children}
+
+REGISTRY = Registry()
+
+STEP_SECONDS = REGISTRY.histogram(
+    "mail_step_seconds", "Time spent in each step of a pipeline stage", ("stage", "step"))
+MODEL_TOKENS = REGISTRY.counter(
+    "mail_model_tokens_total", "Tokens sent to and received from each model",
+    ("model", "direction"))
+QUEUE_LAG = REGISTRY.histogram(
+    "mail_queue_lag_seconds", "Time between a message being stored in JetStream and "
+    "being fetched by a stage", ("stage",), buckets=LAG_BUCKETS)
+MESSAGES = REGISTRY.counter(
+    "mail_messages_total", "Messages handled by each stage, by outcome",
+    ("stage", "outcome"))
+ERRORS = REGISTRY.counter(
+    "mail_errors_total", "Errors in each step of a pipeline stage", ("stage", "step"))
+
+def record_tokens(model_id: str, response):
+    """Count the tokens of a completed llm response, if the model reports them"""
+    input_tokens = getattr(response, "input_tokens", None)
+    output_tokens = getattr(response, "output_tokens", None)
+    if input_tokens:
+        MODEL_TOKENS.labels(model_id, "input").inc(input_tokens)
+    if output_tokens:
+        MODEL_TOKENS.labels(model_id, "output").inc(output_tokens)
+
+def queue_lag(msg, now: Optional[float] = None) -> Optional[float]:
+    """Return the seconds since a JetStream message was stored, if known"""
+    try:
+        stored = msg.metadata.timestamp
+    except Exception:
+        return None
+    if stored is None:
+        return None
+    return (now if now is not None else time.time()) - stored.timestamp()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics request: " + format, *args)
+
+class MetricsExporter:
+    """Expose the metrics over HTTP and publish summaries to NATS
+
+    Serves the metrics on `host`:`port` if a port is given, and publishes a
+    JSON summary to `subject` every `interval` seconds and on close if a
+    subject is given.
+    """
+
+    def __init__(self, registry: Registry = REGISTRY, nc=None, subject: Optional[str] = None,
+                 interval: float = 60, port: Optional[int] = None,
+                 host: str = "127.0.0.1", source: Optional[str] = None):
+        self.registry = registry
+        self.nc = nc
+        self.subject = subject
+        self.interval = interval
+        self.port = port
+        self.host = host
+        self.source = source or Path(sys.argv[0]).stem
+        self.server: Optional[ThreadingHTTPServer] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.port is not None:
+            handler = type("Handler", (MetricsHandler,), {"registry": self.registry})
+            self.server = ThreadingHTTPServer((self.host, self.port), handler)
+            self.port = self.server.server_address[1]
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logger.info("Serving metrics on http://%s:%d/metrics", self.host, self.port)
+        if self.subject and self.interval > 0:
+            self.task = asyncio.create_task(self.publish_periodically())
+
+    def summary(self) -> dict[str, Any]:
+        return {"source": self.source, "time": time.time(),
+                "metrics": self.registry.summary()}
+
+    async def publish_summary(self):
+        await self.nc.publish(self.subject, json.dumps(self.summary()).encode())
+
+    async def publish_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.publish_summary()
+            except Exception as e:
+                logger.error("Error publishing metrics: %s", e)
+
+    async def close(self):
+        """Stop serving, and publish a final summary"""
+        if self.task is not None:
+            self.task.cancel()
+        if self.subject:
+            await self.publish_summary()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+def add_metrics_arguments(parser):
+    """Add the options for exporting metrics"""
+    parser.add_argument("--metrics-port", type=int,
+                        help="Port to serve Prometheus metrics on at /metrics")
+    parser.add_argument("--metrics-host", default="127.0.0.1",
+                        help="Address to serve metrics on")
+    parser.add_argument("--metrics-subject",
+                        help="NATS subject to publish summaries of the metrics to")
+    parser.add_argument("--metrics-interval", type=float, default=60,
+                        help="Seconds between metrics summaries published to NATS")
+
+def metrics_exporter(args, nc) -> MetricsExporter:
+    """Create and start the metrics exporter from the options"""
+    exporter = MetricsExporter(nc=nc, subject=args.metrics_subject,
+                               interval=args.metrics_interval, port=args.metrics_port,
+                               host=args.metrics_host)
+    exporter.start()
+    return exporter
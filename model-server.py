@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# Resident model service. Keeps models loaded and serves prompts from the
+# analysers over a Unix socket, batching prompts from all clients. Analysers
+# use a served model with `--model server:<alias>`.
+
+import argparse
+import asyncio
+import logging
+import os
+from pathlib import Path
+import signal
+
+from model_server import DEFAULT_MODEL_SOCKET, ModelServer, load_model
+
+def model_alias(spec: str) -> tuple[str, str]:
+    """Parse a model spec, either a model ID or ALIAS=MODEL_ID"""
+    alias, _, model_id = spec.rpartition("=")
+    return alias or model_id, model_id
+
+async def main():
+    default_socket = os.environ.get("MODEL_SERVER_SOCKET", DEFAULT_MODEL_SOCKET)
+
+    parser = argparse.ArgumentParser(
+        description="Serve prompts for resident models over a Unix socket",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--model", "-m", action="append", type=model_alias,
+                        help="Model to serve, as MODEL_ID or ALIAS=MODEL_ID "
+                             "(use 'stand-in' for the local stand-in backend); may be repeated")
+    parser.add_argument("--socket", default=default_socket, help="Unix socket to listen on")
+    parser.add_argument("--batch-size", type=int, default=8,
+                        help="Maximum number of prompts to batch for a model")
+    parser.add_argument("--batch-delay", type=float, default=0.01,
+                        help="Seconds to wait for more prompts to batch")
+    parser.add_argument("--warmup", action=argparse.BooleanOptionalAction, default=True,
+                        help="Prompt each model once on startup to load it")
+    parser.add_argument("--debug", action=argparse.BooleanOptionalAction,
+                        help="Enable debug logging")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s")
+
+    specs = args.model or [model_alias("mlx-community/Llama-3.2-3B-Instruct-4bit")]
+    models = {}
+    for alias, model_id in specs:
+        logging.info("Loading %s as %s", model_id, alias)
+        models[alias] = load_model(model_id)
+
+    server = ModelServer(models, max_batch=args.batch_size, max_delay=args.batch_delay)
+    if args.warmup:
+        await asyncio.to_thread(server.warm_up)
+    server.start()
+
+    socket_path = Path(args.socket).expanduser()
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    socket_path.unlink(missing_ok=True)
+
+    unix_server = await asyncio.start_unix_server(server.handle_client, path=socket_path)
+    socket_path.chmod(0o600)
+    logging.info("Serving %s on %s", ", ".join(models), socket_path)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with unix_server:
+        await stop.wait()
+
+        logging.info("Shutting down")
+        unix_server.close()
+        await server.stop()
+
+    logging.info("Stats: %s", server.stats())
+    socket_path.unlink(missing_ok=True)
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,296 @@
+# Client and server for a resident model service. model-server.py keeps models
+# loaded and serves prompts from any number of clients over a Unix socket, so
+# that local models are not reloaded by every run of the analysers.
+#
+# Analysers use a served model by passing "server:<alias>" as the model.
+#
+# Protocol: each request is a single line of JSON with the model alias, the
+# prompt and optionally a JSON schema for the response. Each reply is a single
+# line of JSON with either the response text or an error. Replies are sent in
+# the order of the requests on a connection.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import llm
+import logging
+import os
+from pathlib import Path
+import socket
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_SOCKET = "~/.cache/mail-assistant/model.sock"
+SERVER_PREFIX = "server:"
+
+# Model ID of the stand-in backend, for running without local models
+STAND_IN_MODEL = "stand-in"
+
+WARMUP_PROMPT = "Reply with OK."
+
+class ModelServerError(Exception):
+    """Error reported by the model server"""
+
+def model_socket() -> Path:
+    """Return the path of the model server socket"""
+    return Path(os.environ.get("MODEL_SERVER_SOCKET", DEFAULT_MODEL_SOCKET)).expanduser()
+
+def json_schema(schema: Any) -> Optional[dict]:
+    """Return the JSON schema for a pydantic model or schema dict"""
+    if schema is None or isinstance(schema, dict):
+        return schema
+    return schema.model_json_schema()
+
+def encode_request(alias: str, prompt: str, schema: Any = None) -> bytes:
+    request = {"model": alias, "prompt": prompt}
+    if schema is not None:
+        request["schema"] = json_schema(schema)
+    return json.dumps(request).encode() + b"\n"
+
+def decode_reply(line: bytes) -> str:
+    if not line:
+        raise ModelServerError("Model server closed the connection")
+    reply = json.loads(line)
+    if "error" in reply:
+        raise ModelServerError(reply["error"])
+    return reply["text"]
+
+class ServedResponse:
+    def __init__(self, text: str):
+        self._text = text
+
+    def text(self) -> str:
+        return self._text
+
+class ServedModel:
+    """Model served by model-server.py, with the interface of an llm model"""
+
+    def __init__(self, alias: str, path: Optional[Path] = None):
+        self.model_id = alias
+        self.path = path or model_socket()
+
+    def prompt(self, prompt: str, schema: Any = None, **kwargs) -> ServedResponse:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(self.path))
+            sock.sendall(encode_request(self.model_id, prompt, schema))
+            with sock.makefile("rb") as f:
+                return ServedResponse(decode_reply(f.readline()))
+
+class AsyncServedResponse:
+    def __init__(self, model: "AsyncServedModel", prompt: str, schema: Any):
+        self.model = model
+        self.prompt = prompt
+        self.schema = schema
+
+    async def text(self) -> str:
+        reader, writer = await asyncio.open_unix_connection(self.model.path)
+        try:
+            writer.write(encode_request(self.model.model_id, self.prompt, self.schema))
+            await writer.drain()
+            return decode_reply(await reader.readline())
+        finally:
+            writer.close()
+
+class AsyncServedModel:
+    """Model served by model-server.py, with the interface of an llm async model"""
+
+    def __init__(self, alias: str, path: Optional[Path] = None):
+        self.model_id = alias
+        self.path = path or model_socket()
+
+    def prompt(self, prompt: str, schema: Any = None, **kwargs) -> AsyncServedResponse:
+        return AsyncServedResponse(self, prompt, schema)
+
+def get_models(model_id: str) -> tuple[Any, Any]:
+    """Return the model and async model (None if there isn't one) for a model ID
+
+    Model IDs starting with "server:" refer to models served by
+    model-server.py.
+    """
+    if model_id.startswith(SERVER_PREFIX):
+        alias = model_id.removeprefix(SERVER_PREFIX)
+        return ServedModel(alias), AsyncServedModel(alias)
+
+    model = llm.get_model(model_id)
+    try:
+        async_model = llm.get_async_model(model_id)
+    except llm.UnknownModelError:
+        async_model = None
+    return model, async_model
+
+def schema_instance(schema: dict, root: Optional[dict] = None) -> Any:
+    """Build the simplest value that is valid for a JSON schema"""
+    root = root or schema
+    if "$ref" in schema:
+        name = schema["$ref"].rsplit("/", 1)[-1]
+        return schema_instance(root["$defs"][name], root)
+    if "default" in schema:
+        return schema["default"]
+    if "enum" in schema:
+        return schema["enum"][0]
+    for key in ("anyOf", "oneOf", "allOf"):
+        if key in schema:
+            return schema_instance(schema[key][0], root)
+
+    kind = schema.get("type", "object")
+    if isinstance(kind, list):
+        kind = kind[0]
+    if kind == "object":
+        properties = schema.get("properties", {})
+        return {name: schema_instance(properties[name], root)
+                for name in schema.get("required", properties)}
+    return {"array": [], "string": "", "integer": 0, "number": 0,
+            "boolean": False, "null": None}[kind]
+
+class StandInModel:
+    """Local stand-in backend, for running and testing without local models
+
+    Responds instantly with the simplest response that matches the schema,
+    or echoes the prompt if there is no schema.
+    """
+
+    model_id = STAND_IN_MODEL
+
+    def prompt(self, prompt: str, schema: Optional[dict] = None, **kwargs) -> ServedResponse:
+        return self.prompt_batch([prompt], schema)[0]
+
+    def prompt_batch(self, prompts: list[str],
+                     schema: Optional[dict] = None) -> list[ServedResponse]:
+        if schema is None:
+            return [ServedResponse(prompt) for prompt in prompts]
+        text = json.dumps(schema_instance(schema))
+        return [ServedResponse(text) for _ in prompts]
+
+def load_model(model_id: str) -> Any:
+    """Load a model to be served"""
+    if model_id == STAND_IN_MODEL:
+        return StandInModel()
+    return llm.get_model(model_id)
+
+class ModelServer:
+    """Serve prompts for resident models, queued per model
+
+    Each model answers one batch of queued prompts at a time, on its own
+    thread. A batch collects up to `max_batch` prompts with the same schema,
+    waiting at most `max_delay` seconds for more prompts to arrive. Models
+    with a `prompt_batch` method answer a batch in a single call, and others
+    answer its prompts one after the other.
+    """
+
+    def __init__(self, models: dict[str, Any], max_batch: int = 8, max_delay: float = 0.01):
+        self.models = models
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queues: dict[str, asyncio.Queue] = {}
+        self.workers: list[asyncio.Task] = []
+        self.executors: dict[str, ThreadPoolExecutor] = {}
+        self.served = 0
+        self.batches = 0
+
+    def warm_up(self):
+        """Prompt each model once, so that their weights are loaded"""
+        for alias, model in self.models.items():
+            logger.info("Warming up %s", alias)
+            model.prompt(WARMUP_PROMPT).text()
+
+    def start(self):
+        for alias in self.models:
+            self.queues[alias] = asyncio.Queue()
+            self.executors[alias] = ThreadPoolExecutor(max_workers=1)
+            self.workers.append(asyncio.create_task(self.worker(alias)))
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        for executor in self.executors.values():
+            executor.shutdown(wait=False)
+
+    async def prompt(self, alias: str, prompt: str, schema: Optional[dict] = None) -> str:
+        """Queue a prompt for the model, and wait for its response"""
+        if alias not in self.queues:
+            raise ModelServerError(f"Unknown model {alias}")
+        future = asyncio.get_running_loop().create_future()
+        await self.queues[alias].put((prompt, schema, future))
+        return await future
+
+    async def next_batch(self, queue: asyncio.Queue) -> list[tuple[str, Optional[dict], asyncio.Future]]:
+        """Wait for queued prompts, and collect a batch with the same schema"""
+        batch = [await queue.get()]
+        schema = batch[0][1]
+        deadline = asyncio.get_running_loop().time() + self.max_delay
+        held = []
+        while len(batch) < self.max_batch:
+            timeout = deadline - asyncio.get_running_loop().time()
+            try:
+                request = await asyncio.wait_for(queue.get(), max(timeout, 0))
+            except TimeoutError:
+                break
+            (batch if request[1] == schema else held).append(request)
+        # Prompts with other schemas go back in the queue for the next batch
+        for request in held:
+            queue.put_nowait(request)
+        return batch
+
+    def run_batch(self, model: Any, prompts: list[str], schema: Optional[dict]) -> list[str]:
+        kwargs = {"schema": schema} if schema is not None else {}
+        if hasattr(model, "prompt_batch"):
+            return [r.text() for r in model.prompt_batch(prompts, **kwargs)]
+        return [model.prompt(prompt, **kwargs).text() for prompt in prompts]
+
+    async def worker(self, alias: str):
+        model = self.models[alias]
+        queue = self.queues[alias]
+        executor = self.executors[alias]
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                batch = await self.next_batch(queue)
+                prompts = [prompt for prompt, _, _ in batch]
+                logger.debug("Prompting %s with a batch of %d", alias, len(batch))
+                try:
+                    texts = await loop.run_in_executor(executor, self.run_batch, model,
+                                                       prompts, batch[0][1])
+                except Exception as e:
+                    logger.error("Error prompting %s: %s", alias, e)
+                    self.fail(batch, str(e))
+                    continue
+                for (_, _, future), text in zip(batch, texts):
+                    if not future.done():
+                        future.set_result(text)
+                self.served += len(batch)
+                self.batches += 1
+        except asyncio.CancelledError:
+            # Don't leave clients waiting for prompts that won't be answered
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            self.fail(batch, "Model server is shutting down")
+            raise
+
+    def fail(self, batch: list[tuple[str, Optional[dict], asyncio.Future]], error: str):
+        for _, _, future in batch:
+            if not future.done():
+                future.set_exception(ModelServerError(error))
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Answer the requests on a client connection"""
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    text = await self.prompt(request["model"], request["prompt"],
+                                             request.get("schema"))
+                    reply = {"text": text}
+                except (ModelServerError, ValueError, KeyError) as e:
+                    reply = {"error": str(e)}
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError as e:
+            logger.debug("Client disconnected: %s", e)
+        finally:
+            writer.close()
+
+    def stats(self) -> dict[str, int]:
+        return {"served": self.served, "batches": self.batches}
@@ -3,6 +3,14 @@ from enum import Enum
 from pydantic import BaseModel, Field, ValidationError, field_validator
 from typing import Any, Optional
 
+class Attachment(BaseModel):
+    filename: str = ""
+    content_type: str
+    size: int
+    sha256: str = Field(description="Content hash, under which the attachment is stored")
+    status: str = Field(default="",
+                        description="Outcome of extracting the text, once it has been attempted")
+
 class EmailData(BaseModel):
     from_: list[str] = Field(serialization_alias="from")
     to: list[str]
@@ -10,6 +18,23 @@ class EmailData(BaseModel):
     date: str
     message_id: str
     body: str
+    headers: dict[str, str] = Field(default={},
+                                    description="Mailing list and automation headers")
+    attachments: list[Attachment] = Field(default=[],
+                                          description="Attachments whose text is extracted separately")
+
+class EmailHeaders(BaseModel):
+    """Header record of an email, published for the header analysis"""
+    from_: list[str] = Field(serialization_alias="from")
+    to: list[str]
+    subject: str
+    date: str
+    message_id: str
+    headers: dict[str, str] = Field(default={},
+                                    description="Mailing list and automation headers")
+    attachments: list[Attachment] = Field(default=[],
+                                          description="Attachments whose text is extracted separately")
+    body_size: int = Field(default=0, description="Size of the body in bytes")
 
 class EmailParseError(BaseModel):
     sender: str
@@ -26,6 +51,8 @@ class HeaderAnalysis(BaseModel):
     notify: bool = Field(title="Should the user be notified?")
     needs_analysis: bool = Field(title="Does the email need further analysis as header data is not sufficient?")
     analysis_reason: str = Field(title="Reason why further analysis is needed", default="")
+    confidence: Optional[float] = Field(title="Confidence in the analysis, from 0 to 1",
+                                        default=None, ge=0, le=1)
 
     @field_validator("due_date", mode="before")
     @classmethod
@@ -34,11 +61,19 @@ class HeaderAnalysis(BaseModel):
             return None
         return str(value)
 
+class EmailHeaderAnalysis(HeaderAnalysis):
+    email_id: int = Field(title="ID of the email being analysed")
+
+class HeaderAnalysisBatch(BaseModel):
+    analyses: list[EmailHeaderAnalysis] = Field(title="Analysis of each email")
+
 class EmailAction(BaseModel):
     action: str = Field(title="Action to be taken on the email", default="")
     due_date: Optional[datetime.date] = Field(title="Optional due date for the action in YYYY-MM-DD format", default=None)
     is_important: bool = Field(title="Is the email important?", default=False)
     notify: bool = Field(title="Should the user be notified?", default=False)
+    confidence: Optional[float] = Field(title="Confidence in the analysis, from 0 to 1",
+                                        default=None, ge=0, le=1)
 
     @field_validator("action", mode="before")
     @classmethod
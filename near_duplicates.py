@@ -0,0 +1,291 @@
+# Detection of near-duplicate emails, such as shipping notifications or
+# statements generated from the same template, so that the analysis of an
+# earlier email can be reused with its variable fields re-extracted.
+
+from collections import OrderedDict
+import datetime
+import difflib
+import hashlib
+import logging
+from pathlib import Path
+import pydantic
+import re
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from models import EmailData
+from preclassifier import normalise_address
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIMILARITY_DB = "~/.cache/mail-assistant/similar.db"
+
+FINGERPRINT_BITS = 64
+SHINGLE_SIZE = 3
+MAX_TOKENS = 2000
+
+# Texts shorter than this are too short to tell templates apart
+MIN_TOKENS = 4
+
+# Words, numbers and identifiers, including dates like 2025-03-05
+TOKEN = re.compile(r"[^\W_]+(?:[.,:/-][^\W_]+)*")
+
+MONTHS = {month: i + 1 for i, month in enumerate(
+    ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"))}
+MONTH = r"(?P<{}>jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?"
+DATE = re.compile(
+    r"\b(?P<iso>(?P<y1>\d{4})-(?P<m1>\d{1,2})-(?P<d1>\d{1,2}))\b|"
+    r"\b(?P<d2>\d{1,2})(?:st|nd|rd|th)?\s+" + MONTH.format("n2") + r",?\s+(?P<y2>\d{4})\b|"
+    r"\b" + MONTH.format("n3") + r"\s+(?P<d3>\d{1,2})(?:st|nd|rd|th)?,?\s+(?P<y3>\d{4})\b",
+    re.IGNORECASE)
+
+def tokens(text: str) -> list[str]:
+    """Split the text into tokens"""
+    return TOKEN.findall(text)[:MAX_TOKENS]
+
+# Words that vary between emails from the same template, like digits do
+DATE_WORDS = {
+    "january", "february", "march", "april", "may", "june", "july", "august",
+    "september", "october", "november", "december", "monday", "tuesday",
+    "wednesday", "thursday", "friday", "saturday", "sunday",
+} | set(MONTHS) | {"sept", "mon", "tue", "wed", "thu", "fri", "sat", "sun"}
+
+def normalise_token(token: str) -> str:
+    """Normalise a token, replacing numbers, identifiers and dates by a placeholder"""
+    token = token.lower()
+    if token in DATE_WORDS or any(c.isdigit() for c in token):
+        return "#"
+    return token
+
+def normalise(text: str) -> list[str]:
+    """Return the normalised tokens of the text"""
+    return [normalise_token(t) for t in tokens(text)]
+
+def fingerprint(text: str) -> int:
+    """Return the SimHash of the text, over shingles of normalised tokens
+
+    Texts that only differ in numbers, dates and identifiers get the same
+    fingerprint, and texts that differ in a few words get fingerprints that
+    differ in a few bits.
+    """
+    words = normalise(text)
+    size = min(SHINGLE_SIZE, len(words)) or 1
+    shingles = {" ".join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+    # Each bit is set if it is set in the hashes of most of the shingles.
+    # Counting over the binary strings of the hashes is much faster than
+    # shifting and masking each bit.
+    hashes = [format(int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest()),
+                     f"0{FINGERPRINT_BITS}b") for s in shingles]
+    majority = "".join("1" if column.count("1") * 2 > len(hashes) else "0"
+                       for column in zip(*hashes))
+    return int(majority, 2)
+
+def find_dates(text: str) -> list[datetime.date]:
+    """Return the dates with a year in the text, in order"""
+    dates = []
+    for m in DATE.finditer(text):
+        try:
+            if m.group("iso"):
+                date = datetime.date(int(m.group("y1")), int(m.group("m1")), int(m.group("d1")))
+            elif m.group("d2"):
+                date = datetime.date(int(m.group("y2")), MONTHS[m.group("n2")[:3].lower()],
+                                     int(m.group("d2")))
+            else:
+                date = datetime.date(int(m.group("y3")), MONTHS[m.group("n3")[:3].lower()],
+                                     int(m.group("d3")))
+        except ValueError:
+            continue
+        dates.append(date)
+    return dates
+
+def substitutions(old_text: str, new_text: str) -> dict[str, str]:
+    """Map the variable tokens of the old text to those in the same place in the new one"""
+    old = tokens(old_text)
+    new = tokens(new_text)
+    matcher = difflib.SequenceMatcher(None, [normalise_token(t) for t in old],
+                                      [normalise_token(t) for t in new], autojunk=False)
+    subs = {}
+    for a, b, size in matcher.get_matching_blocks():
+        for old_token, new_token in zip(old[a:a + size], new[b:b + size]):
+            if old_token != new_token:
+                subs[old_token] = new_token
+    return subs
+
+def adapt_response(response: pydantic.BaseModel, old_text: str,
+                   new_text: str) -> Optional[pydantic.BaseModel]:
+    """Adapt the response for an email to a near-duplicate of it
+
+    Numbers and identifiers in text fields are replaced by the ones in the
+    same place in the new email, and the due date is re-extracted. Returns
+    None if the due date can't be re-extracted.
+    """
+    subs = substitutions(old_text, new_text)
+    update = {}
+    if subs:
+        pattern = re.compile("|".join(rf"\b{re.escape(s)}\b"
+                                      for s in sorted(subs, key=len, reverse=True)))
+        for name, value in response:
+            if isinstance(value, str) and value:
+                update[name] = pattern.sub(lambda m: subs[m.group(0)], value)
+
+    due_date = getattr(response, "due_date", None)
+    if due_date is not None:
+        old_dates = find_dates(old_text)
+        new_dates = find_dates(new_text)
+        if due_date in old_dates and len(old_dates) == len(new_dates):
+            update["due_date"] = new_dates[old_dates.index(due_date)]
+        elif len(new_dates) == 1:
+            update["due_date"] = new_dates[0]
+        else:
+            return None
+
+    return response.model_copy(update=update)
+
+def sender(email: EmailData) -> str:
+    """Return the sender address, which near-duplicates must share"""
+    if not email.from_:
+        return ""
+    return normalise_address(email.from_[0])
+
+def signed(value: int) -> int:
+    """Convert an unsigned 64-bit fingerprint to a signed one for SQLite"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+class SimilarityIndex:
+    """Index of analysed emails, for finding near-duplicates of new emails
+
+    Emails are indexed by the SimHash of their text. Two emails are
+    near-duplicates if they are from the same sender and their fingerprints
+    differ in at most `max_distance` bits. Texts of fewer than MIN_TOKENS
+    tokens are neither indexed nor looked up. Fingerprints are
+    split into `max_distance + 1` bands, one of which near-duplicates must
+    share, so a lookup checks only the emails in a few hash buckets.
+
+    Fingerprints are kept in memory, up to `max_entries` with the least
+    recently used evicted first. The texts and responses are stored in an
+    SQLite database, which is in memory unless a path is given.
+    """
+
+    def __init__(self, path: str | Path = ":memory:", max_entries: int = 100000,
+                 max_distance: int = 3):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.bands = max_distance + 1
+        self.band_bits = FINGERPRINT_BITS // self.bands
+        self.lock = threading.Lock()
+
+        if str(path) != ":memory:":
+            path = Path(path).expanduser()
+            path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS emails (
+                               id INTEGER PRIMARY KEY,
+                               kind TEXT NOT NULL,
+                               sender TEXT NOT NULL,
+                               fingerprint INTEGER NOT NULL,
+                               text TEXT NOT NULL,
+                               response TEXT NOT NULL,
+                               accessed REAL NOT NULL)""")
+
+        # id -> (kind, sender, fingerprint), least recently used first
+        self.entries: OrderedDict[int, tuple[str, str, int]] = OrderedDict()
+        self.buckets: dict[tuple[str, str, int, int], set[int]] = {}
+
+        # Keep the most recently used entries that fit
+        rows = self.db.execute("""SELECT id, kind, sender, fingerprint FROM emails
+                                  ORDER BY accessed DESC LIMIT ?""",
+                               (max_entries,)).fetchall()
+        for id, kind, sender, value in reversed(rows):
+            self.insert(id, kind, sender, value & ((1 << 64) - 1))
+        self.db.execute("DELETE FROM emails WHERE id NOT IN (SELECT id FROM emails "
+                        "ORDER BY accessed DESC LIMIT ?)", (max_entries,))
+
+        self.hits = 0
+        self.misses = 0
+
+    def band_keys(self, kind: str, sender: str, value: int) -> list[tuple[str, str, int, int]]:
+        mask = (1 << self.band_bits) - 1
+        return [(kind, sender, band, value >> (band * self.band_bits) & mask)
+                for band in range(self.bands)]
+
+    def insert(self, id: int, kind: str, sender: str, value: int):
+        self.entries[id] = (kind, sender, value)
+        for key in self.band_keys(kind, sender, value):
+            self.buckets.setdefault(key, set()).add(id)
+
+    def remove(self, id: int):
+        kind, sender, value = self.entries.pop(id)
+        for key in self.band_keys(kind, sender, value):
+            bucket = self.buckets[key]
+            bucket.discard(id)
+            if not bucket:
+                del self.buckets[key]
+
+    def nearest(self, kind: str, sender: str, value: int,
+                max_distance: Optional[int] = None) -> Optional[int]:
+        """Return the ID of the closest indexed email within the maximum distance"""
+        if max_distance is None:
+            max_distance = self.max_distance
+        best, best_distance = None, min(max_distance, self.max_distance) + 1
+        for key in self.band_keys(kind, sender, value):
+            for id in self.buckets.get(key, ()):
+                distance = (self.entries[id][2] ^ value).bit_count()
+                if distance < best_distance:
+                    best, best_distance = id, distance
+        return best
+
+    def lookup(self, kind: str, email: EmailData, text: str,
+               max_distance: Optional[int] = None) -> Optional[tuple[str, str]]:
+        """Return the text and response of a near-duplicate of the email, if any
+
+        `max_distance` makes the lookup stricter than the index's, for texts
+        where a single word can change the response. With a distance of 0,
+        the texts must only differ in numbers, dates and identifiers, which
+        is checked on the stored text as different texts can share a
+        fingerprint.
+        """
+        if len(tokens(text)) < MIN_TOKENS:
+            return None
+        value = fingerprint(text)
+        with self.lock:
+            id = self.nearest(kind, sender(email), value, max_distance)
+            if id is None:
+                self.misses += 1
+                return None
+            row = self.db.execute("SELECT text, response FROM emails WHERE id = ?",
+                                  (id,)).fetchone()
+            if max_distance == 0 and normalise(row[0]) != normalise(text):
+                self.misses += 1
+                return None
+            self.entries.move_to_end(id)
+            self.db.execute("UPDATE emails SET accessed = ? WHERE id = ?", (time.time(), id))
+            self.hits += 1
+            return row
+
+    def add(self, kind: str, email: EmailData, text: str, response: str):
+        """Index an analysed email"""
+        if len(tokens(text)) < MIN_TOKENS:
+            return
+        value = fingerprint(text)
+        address = sender(email)
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT INTO emails (kind, sender, fingerprint, text, response, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, address, signed(value), text, response, time.time()))
+            self.insert(cursor.lastrowid, kind, address, value)
+            while len(self.entries) > self.max_entries:
+                id = next(iter(self.entries))
+                self.remove(id)
+                self.db.execute("DELETE FROM emails WHERE id = ?", (id,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# Extracts the text of the images and documents attached to emails archived
+# with --defer-attachments, and publishes the emails with the text added to
+# their bodies.
+
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import nats
+import os
+import sys
+
+from analysis_cache import SQLiteCache
+from consumer import PullConsumer, add_follow_arguments
+from dedupe import msg_id_headers
+from ocr import DEFAULT_ATTACHMENT_DIR, AttachmentOCR, AttachmentStore
+from publisher import BatchPublisher
+from wire import BodyUnavailableError, add_wire_arguments, wire_format
+
+async def main():
+    default_nats = os.environ.get("NATS", "nats://localhost:4222")
+    default_attachment_dir = os.environ.get("ATTACHMENT_DIR", DEFAULT_ATTACHMENT_DIR)
+    default_cache = os.environ.get("OCR_CACHE")
+
+    parser = argparse.ArgumentParser(
+        description="Extract the text of email attachments",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--nats", default=default_nats,
+                        help="NATS server URL")
+    parser.add_argument("--nats-stream", default="email_attachments",
+                        help="NATS stream to subscribe to")
+    parser.add_argument("--nats-consumer", default="ocr-worker",
+                        help="NATS consumer name")
+    parser.add_argument("--nats-subject", default="email.enriched",
+                        help="NATS subject to publish emails with attachment text to")
+    parser.add_argument("--attachment-dir", default=default_attachment_dir,
+                        help="Directory the archiver stores attachments in")
+    parser.add_argument("--cache", default=default_cache,
+                        help="SQLite file to cache extracted text in by attachment content")
+    parser.add_argument("--cache-max-entries", type=int, default=100000,
+                        help="Maximum number of cached attachment texts")
+    parser.add_argument("--workers", type=int, default=2,
+                        help="Number of processes to extract text with")
+    parser.add_argument("--max-attachment-bytes", type=int, default=20 * 1024 * 1024,
+                        help="Skip attachments larger than this")
+    parser.add_argument("--max-pages", type=int, default=20,
+                        help="Skip PDFs with more pages than this")
+    parser.add_argument("--ocr-timeout", type=float, default=120,
+                        help="Seconds to wait for the text of an attachment")
+    parser.add_argument("--fetch-batch", type=int, default=10,
+                        help="Number of messages to fetch at a time")
+    parser.add_argument("--publish-batch", type=int, default=50,
+                        help="Maximum number of publishes and acks to send together")
+    parser.add_argument("--publish-delay", type=float, default=0.05,
+                        help="Seconds to wait for more publishes and acks to batch")
+    parser.add_argument("--limit", type=int, default=-1,
+                        help="Number of messages to process (-1 for all)")
+    add_wire_arguments(parser)
+    parser.add_argument("--debug", action=argparse.BooleanOptionalAction,
+                        help="Enable debug logging")
+    add_follow_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s")
+
+    async def error_handler(e):
+        logging.error("Error: %s", e)
+        sys.exit(1)
+
+    logging.debug("Connecting to NATS server at %s", args.nats)
+    nc = await nats.connect(args.nats, error_cb=error_handler)
+    js = nc.jetstream()
+
+    logging.debug("Subscribing to stream %s", args.nats_stream)
+    psub = await js.pull_subscribe("", stream=args.nats_stream,
+                                   durable=args.nats_consumer)
+
+    cache = None
+    if args.cache:
+        logging.debug("Using OCR cache %s", args.cache)
+        cache = SQLiteCache(args.cache, max_entries=args.cache_max_entries)
+
+    wire = wire_format(args, js)
+
+    pool = ProcessPoolExecutor(max_workers=args.workers)
+    ocr = AttachmentOCR(AttachmentStore(args.attachment_dir), executor=pool, cache=cache,
+                        max_bytes=args.max_attachment_bytes, max_pages=args.max_pages,
+                        timeout=args.ocr_timeout, workers=args.workers)
+
+    publisher = BatchPublisher(nc, max_batch=args.publish_batch,
+                               max_delay=args.publish_delay)
+
+    consumer = PullConsumer(psub, batch=args.fetch_batch, timeout=2,
+                            limit=args.limit, follow=args.follow,
+                            max_batch=args.max_fetch_batch, max_idle=args.max_idle)
+    consumer.stop_on_signals()
+
+    async for msgs in consumer.batches():
+        received = []
+        for msg in msgs:
+            try:
+                received.append((msg, await wire.decode(msg.data, msg.headers)))
+            except BodyUnavailableError as e:
+                # Redelivered after a delay, in case the fetch failed temporarily
+                logging.error("Error fetching email body: %s", e)
+                await publisher.reject(msg)
+            except ValueError as e:
+                logging.error("Error validating email: %s: %s", e, msg.data)
+                await publisher.ack(msg)
+
+        # The attachments of all the emails in the batch are extracted in
+        # parallel, up to the number of workers
+        enriched = await asyncio.gather(*(ocr.enrich(email) for _, email in received))
+        for (msg, _), email in zip(received, enriched):
+            logging.info("Extracted attachments of %s: %s", email.message_id,
+                         ", ".join(a.status for a in email.attachments))
+            payload, headers = await wire.encode(email)
+            output = await publisher.publish(
+                args.nats_subject, payload,
+                headers=msg_id_headers(args.nats_subject, email.message_id, headers))
+            await publisher.ack(msg, [output])
+
+    await publisher.close()
+    logging.info("Published %(published)d messages, acked %(acked)d, nak'd %(nakd)d",
+                 publisher.stats())
+    logging.info("Attachments: %(extracted)d extracted, %(cached)d cached, "
+                 "%(skipped)d skipped, %(failed)d failed; %(seconds).1fs extracting, "
+                 "slowest %(slowest).1fs", ocr.stats())
+
+    pool.shutdown()
+    if cache is not None:
+        logging.info("OCR cache: %(hits)d hits, %(misses)d misses", cache.stats())
+        cache.close()
+
+    await nc.close()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,208 @@
+# Text extraction for image and document attachments, run as its own stage so
+# that slow OCR doesn't hold up archiving. The archiver stores attachments by
+# content hash and publishes the email straight away, and the OCR stage
+# extracts their text in a pool of processes and publishes the enriched email.
+
+import asyncio
+from concurrent.futures import Executor
+import hashlib
+import io
+import logging
+import os
+from pathlib import Path
+import re
+import tempfile
+import time
+from typing import Callable, Optional
+import zlib
+
+from analysis_cache import ResultCache
+from models import Attachment, EmailData
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ATTACHMENT_DIR = "~/.cache/mail-assistant/attachments"
+
+# Version of the extracted text, to invalidate cached results when it changes
+OCR_VERSION = "1"
+
+PDF_PAGE = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+# The dictionary of an object up to the start of its stream, if it has one
+PDF_STREAM = re.compile(rb"\bobj\b(.{0,1000}?)\bstream\r?\n", re.DOTALL)
+
+class AttachmentStore:
+    """Attachments stored in a directory under their content hash"""
+
+    def __init__(self, path: str | Path = DEFAULT_ATTACHMENT_DIR):
+        self.path = Path(path).expanduser()
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def file(self, sha256: str) -> Path:
+        return self.path / sha256[:2] / sha256
+
+    def put(self, filename: str, content_type: str, data: bytes) -> Attachment:
+        """Store an attachment, returning the reference to it"""
+        sha256 = hashlib.sha256(data).hexdigest()
+        file = self.file(sha256)
+        if not file.exists():
+            file.parent.mkdir(exist_ok=True)
+            # Write atomically, so that readers never see a partial file
+            fd, tmp = tempfile.mkstemp(dir=file.parent)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, file)
+        return Attachment(filename=filename, content_type=content_type,
+                          size=len(data), sha256=sha256)
+
+    def get(self, attachment: Attachment) -> bytes:
+        return self.file(attachment.sha256).read_bytes()
+
+def pdf_pages(data: bytes) -> int:
+    """Count the pages of a PDF without parsing it
+
+    Page objects are counted in the file and in its compressed object
+    streams, where PDF 1.5 and later writers usually put them.
+    """
+    pages = len(PDF_PAGE.findall(data))
+    for m in PDF_STREAM.finditer(data):
+        if b"/ObjStm" not in m.group(1) or b"/FlateDecode" not in m.group(1):
+            continue
+        end = data.find(b"endstream", m.end())
+        try:
+            objects = zlib.decompressobj().decompress(data[m.end():end])
+        except zlib.error:
+            continue
+        pages += len(PDF_PAGE.findall(objects))
+    return pages
+
+def extract_text(data: bytes, content_type: str, filename: str = "") -> str:
+    """Extract the text of an image or document using unstructured"""
+    from unstructured.partition.auto import partition
+    elements = partition(file=io.BytesIO(data), content_type=content_type,
+                         metadata_filename=filename or None)
+    return "\n\n".join(el.text for el in elements if el.text)
+
+def enriched_body(email: EmailData, texts: list[str]) -> str:
+    """Append the text of the attachments to the body of the email"""
+    parts = [email.body]
+    for attachment, text in zip(email.attachments, texts):
+        if text:
+            parts.append(f"[Attachment: {attachment.filename or attachment.content_type}]\n{text}")
+    return "\n\n".join(part for part in parts if part)
+
+class AttachmentOCR:
+    """Extract the text of attachments in parallel, caching it by content hash
+
+    Text is extracted by `extract` on `executor`, which should be a process
+    pool so that several attachments are OCR'd in parallel. Attachments
+    larger than `max_bytes` or PDFs with more than `max_pages` pages are
+    skipped. At most `workers` attachments are submitted to the executor at
+    a time, so that extraction is given up on `timeout` seconds after it
+    starts rather than after it is queued.
+    Attachments with the same content are only extracted once, even when
+    several emails with them are processed at the same time.
+    """
+
+    def __init__(self, store: AttachmentStore, executor: Optional[Executor] = None,
+                 cache: Optional[ResultCache] = None, max_bytes: int = 20 * 1024 * 1024,
+                 max_pages: int = 20, timeout: Optional[float] = 120, workers: int = 1,
+                 extract: Callable[[bytes, str, str], str] = extract_text):
+        self.store = store
+        self.executor = executor
+        self.cache = cache
+        self.max_bytes = max_bytes
+        self.max_pages = max_pages
+        self.timeout = timeout
+        self.extract = extract
+        self.slots = asyncio.Semaphore(workers)
+        self.running: dict[str, asyncio.Future] = {}
+
+        self.counts = {"extracted": 0, "cached": 0, "skipped": 0, "failed": 0}
+        self.seconds = 0.0
+        self.slowest = 0.0
+
+    def cache_key(self, attachment: Attachment) -> str:
+        return f"ocr:{OCR_VERSION}:{attachment.sha256}"
+
+    async def extract_attachment(self, attachment: Attachment) -> tuple[str, str]:
+        """Extract the text of an attachment, returning it and the status"""
+        if attachment.size > self.max_bytes:
+            return "", "too large"
+        try:
+            data = await asyncio.to_thread(self.store.get, attachment)
+            if attachment.content_type == "application/pdf" and pdf_pages(data) > self.max_pages:
+                return "", "too many pages"
+
+            await self.slots.acquire()
+            job = asyncio.get_running_loop().run_in_executor(
+                self.executor, self.extract, data, attachment.content_type,
+                attachment.filename)
+            # The slot is freed when the worker is, even after a timeout
+            job.add_done_callback(self.job_done)
+            start = time.perf_counter()
+            try:
+                text = await asyncio.wait_for(asyncio.shield(job), self.timeout)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.seconds += elapsed
+                self.slowest = max(self.slowest, elapsed)
+                logger.info("Extracting %s (%s, %d bytes) took %.2fs", attachment.filename,
+                            attachment.content_type, attachment.size, elapsed)
+        except TimeoutError:
+            # The worker can't be interrupted, but the email isn't held up
+            # and its slot stays taken until the worker is done
+            return "", "timeout"
+        except Exception as e:
+            logger.error("Error extracting %s (%s): %s", attachment.filename,
+                         attachment.sha256, e)
+            return "", "failed"
+
+        if self.cache is not None:
+            self.cache.put(self.cache_key(attachment), text)
+        return text, "extracted"
+
+    def job_done(self, job: asyncio.Future):
+        self.slots.release()
+        if not job.cancelled():
+            # Retrieve errors of jobs that timed out, which nothing awaits
+            job.exception()
+
+    async def process(self, attachment: Attachment) -> tuple[str, str]:
+        """Return the text of an attachment and the status of extracting it"""
+        if self.cache is not None:
+            text = self.cache.get(self.cache_key(attachment))
+            if text is not None:
+                self.counts["cached"] += 1
+                return text, "extracted"
+
+        running = self.running.get(attachment.sha256)
+        if running is not None:
+            # The same attachment in another email being processed
+            self.counts["cached"] += 1
+            return await asyncio.shield(running)
+
+        future = asyncio.ensure_future(self.extract_attachment(attachment))
+        self.running[attachment.sha256] = future
+        try:
+            text, status = await asyncio.shield(future)
+        finally:
+            del self.running[attachment.sha256]
+        if status == "extracted":
+            self.counts["extracted"] += 1
+        elif status in ("failed", "timeout"):
+            self.counts["failed"] += 1
+        else:
+            self.counts["skipped"] += 1
+        return text, status
+
+    async def enrich(self, email: EmailData) -> EmailData:
+        """Return the email with the text of its attachments added to the body"""
+        results = await asyncio.gather(*(self.process(a) for a in email.attachments))
+        attachments = [a.model_copy(update={"status": status})
+                       for a, (_, status) in zip(email.attachments, results)]
+        body = enriched_body(email, [text for text, _ in results])
+        return email.model_copy(update={"body": body, "attachments": attachments})
+
+    def stats(self) -> dict[str, float]:
+        """Return the attachments extracted, cached, skipped and failed, and timings"""
+        return {**self.counts, "seconds": self.seconds, "slowest": self.slowest}
@@ -0,0 +1,131 @@
+from email.utils import parseaddr
+import logging
+from pathlib import Path
+import pydantic
+import re
+from typing import Optional
+import yaml
+
+from models import EmailData, HeaderAnalysis
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RULES_FILE = Path(__file__).parent / "rules.yaml"
+
+def normalise_address(address: str) -> str:
+    """Extract the bare, lower-cased email address from a From/To entry"""
+    return parseaddr(address)[1].lower() or address.strip().lower()
+
+def sender_domains(address: str) -> list[str]:
+    """Return the domain of the address and all its parent domains"""
+    domain = address.rpartition("@")[2]
+    parts = domain.split(".")
+    return [".".join(parts[i:]) for i in range(len(parts) - 1)]
+
+class Rule(pydantic.BaseModel):
+    """Rule for classifying an email without using a model
+
+    A rule matches when at least `min_matches` of its conditions (sender
+    address, sender domain, subject pattern, header) match the email.
+    """
+    name: str
+    senders: list[str] = []
+    domains: list[str] = []
+    subjects: list[str] = []
+    headers: list[str] = []
+    min_matches: int = 1
+    analysis: HeaderAnalysis
+
+def load_rules(path: str | Path = DEFAULT_RULES_FILE) -> list[Rule]:
+    """Load the classification rules from a YAML file"""
+    with open(path, "r") as f:
+        data = yaml.safe_load(f) or {}
+    return [Rule.model_validate(rule) for rule in data.get("rules", [])]
+
+class PreClassifier:
+    """Classify emails using rules, falling back to the model when none match
+
+    The rules are compiled into lookup tables for sender addresses, domains
+    and headers, and into a single regular expression for subjects, so that
+    classifying an email costs a handful of dictionary lookups and one regex
+    match regardless of the number of rules.
+    """
+
+    def __init__(self, rules: list[Rule]):
+        self.rules = rules
+        self.senders: dict[str, set[int]] = {}
+        self.domains: dict[str, set[int]] = {}
+        self.headers: dict[str, set[int]] = {}
+
+        subject_patterns = []
+        for i, rule in enumerate(rules):
+            for sender in rule.senders:
+                self.senders.setdefault(normalise_address(sender), set()).add(i)
+            for domain in rule.domains:
+                self.domains.setdefault(domain.lower().lstrip("."), set()).add(i)
+            for header in rule.headers:
+                self.headers.setdefault(header.lower(), set()).add(i)
+            if rule.subjects:
+                # Each rule gets an optional lookahead from the start of the
+                # subject so that one match reports every rule that applies
+                patterns = "|".join(f"(?:{s})" for s in rule.subjects)
+                subject_patterns.append(f"(?=.*?(?P<r{i}>{patterns}))?")
+
+        self.subjects = None
+        if subject_patterns:
+            self.subjects = re.compile("".join(subject_patterns),
+                                       re.IGNORECASE | re.DOTALL)
+
+        self.matched = 0
+        self.fallthrough = 0
+
+    @classmethod
+    def from_yaml(cls, path: str | Path = DEFAULT_RULES_FILE) -> "PreClassifier":
+        """Create a pre-classifier from the rules in a YAML file"""
+        return cls(load_rules(path))
+
+    def matching_rule(self, email: EmailData) -> Optional[Rule]:
+        """Return the first rule that matches the email, if any"""
+        counts = [0] * len(self.rules)
+
+        sender_rules = set()
+        domain_rules = set()
+        for sender in email.from_:
+            address = normalise_address(sender)
+            sender_rules |= self.senders.get(address, set())
+            for domain in sender_domains(address):
+                domain_rules |= self.domains.get(domain, set())
+
+        header_rules = set()
+        for header in email.headers:
+            header_rules |= self.headers.get(header.lower(), set())
+
+        for matched in (sender_rules, domain_rules, header_rules):
+            for i in matched:
+                counts[i] += 1
+
+        if self.subjects is not None:
+            m = self.subjects.match(email.subject)
+            for group, value in m.groupdict().items():
+                if value is not None:
+                    counts[int(group[1:])] += 1
+
+        for i, rule in enumerate(self.rules):
+            if counts[i] and counts[i] >= rule.min_matches:
+                return rule
+        return None
+
+    def classify(self, email: EmailData) -> Optional[HeaderAnalysis]:
+        """Return the header analysis for the email if a rule matches it"""
+        rule = self.matching_rule(email)
+        if rule is None:
+            self.fallthrough += 1
+            return None
+
+        logger.debug("Email %s matched rule %s", email.message_id, rule.name)
+        self.matched += 1
+        return rule.analysis.model_copy(update={"clean_subject": email.subject})
+
+    def stats(self) -> dict[str, int]:
+        """Return the number of emails classified by rules and by the model"""
+        return {"matched": self.matched, "fallthrough": self.fallthrough}
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from metrics import ERRORS, STEP_SECONDS
+
+logger = logging.getLogger(__name__)
+
+class BatchPublisher:
+    """Coalesce NATS publishes and message acks into batches
+
+    Publishes and acks are queued and sent in batches, either once
+    `max_batch` are queued or `max_delay` seconds after the first one was
+    queued. Durable publishes go through JetStream, and all the publishes in
+    a batch are sent before waiting for any of their confirmations.
+
+    Acks wait for the publishes they depend on: an input message is acked
+    only once all its outputs are confirmed. If any of them fail, it is nak'd
+    for redelivery after `nak_delay` seconds, and terminated instead once it
+    has been delivered `max_deliveries` times.
+
+    With a `stage` name, the time taken by each batch of publishes and acks
+    and the publish errors are recorded in the metrics for the stage.
+    """
+
+    def __init__(self, nc, max_batch: int = 50, max_delay: float = 0.05,
+                 stage: Optional[str] = None, nak_delay: float = 30,
+                 max_deliveries: int = 5):
+        self.nc = nc
+        self.js = nc.jetstream()
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.nak_delay = nak_delay
+        self.max_deliveries = max_deliveries
+
+        self.publishes: list[tuple[str, bytes, Optional[dict], bool, asyncio.Future]] = []
+        self.acks: list[tuple[object, list[asyncio.Future]]] = []
+        self.lock = asyncio.Lock()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.tasks: set[asyncio.Task] = set()
+
+        self.published = 0
+        self.acked = 0
+        self.nakd = 0
+        self.terminated = 0
+
+        self.publish_seconds = self.ack_seconds = None
+        self.publish_errors = self.ack_errors = None
+        if stage:
+            self.publish_seconds = STEP_SECONDS.labels(stage, "publish")
+            self.ack_seconds = STEP_SECONDS.labels(stage, "ack")
+            self.publish_errors = ERRORS.labels(stage, "publish")
+            self.ack_errors = ERRORS.labels(stage, "ack")
+
+    def pending(self) -> int:
+        return len(self.publishes) + len(self.acks)
+
+    async def queued(self):
+        """Flush if the batch is full, and otherwise make sure it will be flushed"""
+        if self.pending() >= self.max_batch:
+            await self.flush()
+        elif self.timer is None:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(self.max_delay, self.flush_later)
+
+    def flush_later(self):
+        self.timer = None
+        task = asyncio.create_task(self.flush())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def publish(self, subject: str, data: bytes, headers: Optional[dict] = None,
+                      durable: bool = True) -> asyncio.Future:
+        """Queue a publish, returning a future that completes once it is confirmed
+
+        Non-durable publishes use core NATS and are confirmed once sent.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.publishes.append((subject, data, headers, durable, future))
+        await self.queued()
+        return future
+
+    async def ack(self, msg, after: list[asyncio.Future] = []):
+        """Queue an ack for the message, to be sent once `after` are confirmed"""
+        self.acks.append((msg, list(after)))
+        await self.queued()
+
+    async def send(self, subject: str, data: bytes, headers: Optional[dict], durable: bool):
+        if durable:
+            await self.js.publish(subject, data, headers=headers)
+        else:
+            await self.nc.publish(subject, data, headers=headers)
+
+    def deliveries(self, msg) -> int:
+        """Return how many times the message has been delivered, if known"""
+        try:
+            return msg.metadata.num_delivered or 0
+        except Exception:
+            return 0
+
+    def reject(self, msg):
+        """Nak the message for a delayed redelivery, or terminate it after too many"""
+        if self.max_deliveries and self.deliveries(msg) >= self.max_deliveries:
+            logger.error("Giving up on message after %d deliveries", self.deliveries(msg))
+            self.terminated += 1
+            return msg.term()
+        self.nakd += 1
+        return msg.nak(delay=self.nak_delay)
+
+    async def flush(self):
+        """Send all queued publishes and acks"""
+        async with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            publishes, self.publishes = self.publishes, []
+            acks, self.acks = self.acks, []
+            if not publishes and not acks:
+                return
+
+            logger.debug("Flushing %d publishes and %d acks", len(publishes), len(acks))
+            start = time.perf_counter()
+            results = await asyncio.gather(
+                *(self.send(subject, data, headers, durable)
+                  for subject, data, headers, durable, _ in publishes),
+                return_exceptions=True)
+            if publishes and self.publish_seconds is not None:
+                self.publish_seconds.observe(time.perf_counter() - start)
+            for (subject, _, _, _, future), result in zip(publishes, results):
+                if isinstance(result, BaseException):
+                    logger.error("Error publishing to %s: %s", subject, result)
+                    if self.publish_errors is not None:
+                        self.publish_errors.inc()
+                    future.set_exception(result)
+                    # Already logged, so don't warn if nothing awaits it
+                    future.exception()
+                else:
+                    self.published += 1
+                    future.set_result(None)
+
+            replies = []
+            for msg, after in acks:
+                # Publishes queued before the ack have been flushed by now
+                if any(f.exception() is not None for f in after):
+                    replies.append(self.reject(msg))
+                else:
+                    replies.append(msg.ack())
+                    self.acked += 1
+            start = time.perf_counter()
+            for result in await asyncio.gather(*replies, return_exceptions=True):
+                if isinstance(result, BaseException):
+                    logger.error("Error acknowledging message: %s", result)
+                    if self.ack_errors is not None:
+                        self.ack_errors.inc()
+            if replies and self.ack_seconds is not None:
+                self.ack_seconds.observe(time.perf_counter() - start)
+
+    async def close(self):
+        """Flush everything still queued"""
+        await self.flush()
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+
+    def stats(self) -> dict[str, int]:
+        return {"published": self.published, "acked": self.acked, "nakd": self.nakd,
+                "terminated": self.terminated}
@@ -0,0 +1,145 @@
+# Store of labelled example emails, from which the few most relevant ones are
+# picked as samples for each prompt, so that the set of examples can grow
+# without every prompt growing with it.
+
+from collections import Counter
+import math
+from pathlib import Path
+import pydantic
+from typing import Any, Callable, Iterable, Optional
+import yaml
+
+from models import EmailData
+from near_duplicates import normalise_token, tokens
+from preclassifier import normalise_address
+
+# Weights of the parts of the relevance score
+SENDER_WEIGHT = 1.0
+DOMAIN_WEIGHT = 0.5
+SUBJECT_WEIGHT = 1.0
+BODY_WEIGHT = 0.5
+
+def terms(text: str) -> Counter:
+    """Count the normalised words of the text, ignoring numbers and dates"""
+    return Counter(t for t in map(normalise_token, tokens(text)) if t != "#")
+
+class SampleStore:
+    """Labelled (email, response) pairs to pick prompt samples from
+
+    Samples are scored against an email by sender address and domain, and
+    by the TF-IDF cosine similarity of their subjects and of their bodies.
+    Only samples sharing the sender domain or a word with the email are
+    scored. Up to `k` samples are selected for an email, within
+    `token_budget` tokens.
+    """
+
+    def __init__(self, samples: Iterable[tuple[EmailData, Any]] = (), k: int = 3,
+                 token_budget: Optional[int] = None):
+        self.k = k
+        self.token_budget = token_budget
+        self.samples: list[tuple[EmailData, Any]] = []
+        self.senders: list[str] = []
+        self.subjects: list[Counter] = []
+        self.bodies: list[Counter] = []
+        # Postings of the samples each subject or body word appears in
+        self.postings: dict[str, set[int]] = {}
+        self.by_domain: dict[str, set[int]] = {}
+        for email, response in samples:
+            self.add(email, response)
+
+    def add(self, email: EmailData, response: Any):
+        """Add a labelled sample"""
+        i = len(self.samples)
+        self.samples.append((email, response))
+        sender = normalise_address(email.from_[0]) if email.from_ else ""
+        self.senders.append(sender)
+        self.by_domain.setdefault(sender.rpartition("@")[2], set()).add(i)
+        subject, body = terms(email.subject), terms(email.body)
+        self.subjects.append(subject)
+        self.bodies.append(body)
+        for term in subject.keys() | body.keys():
+            self.postings.setdefault(term, set()).add(i)
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def idf(self, term: str) -> float:
+        return math.log((1 + len(self.samples)) / (1 + len(self.postings.get(term, ())))) + 1
+
+    def cosine(self, a: Counter, b: Counter) -> float:
+        """TF-IDF cosine similarity of two term counts"""
+        if not a or not b:
+            return 0.0
+        weights = {term: self.idf(term) ** 2 for term in a.keys() | b.keys()}
+        dot = sum(a[t] * b[t] * weights[t] for t in a.keys() & b.keys())
+        norm_a = math.sqrt(sum(n * n * weights[t] for t, n in a.items()))
+        norm_b = math.sqrt(sum(n * n * weights[t] for t, n in b.items()))
+        return dot / (norm_a * norm_b)
+
+    def scores(self, email: EmailData) -> dict[int, float]:
+        """Score the relevance of the candidate samples to the email"""
+        sender = normalise_address(email.from_[0]) if email.from_ else ""
+        domain = sender.rpartition("@")[2]
+        subject, body = terms(email.subject), terms(email.body)
+
+        candidates = set(self.by_domain.get(domain, ()))
+        for term in subject.keys() | body.keys():
+            candidates |= self.postings.get(term, set())
+
+        scores = {}
+        for i in candidates:
+            sample_email = self.samples[i][0]
+            if sample_email.message_id and sample_email.message_id == email.message_id:
+                # Don't use an email as its own sample
+                continue
+            score = (SUBJECT_WEIGHT * self.cosine(subject, self.subjects[i]) +
+                     BODY_WEIGHT * self.cosine(body, self.bodies[i]))
+            if sender and self.senders[i] == sender:
+                score += SENDER_WEIGHT
+            elif domain and self.senders[i].rpartition("@")[2] == domain:
+                score += DOMAIN_WEIGHT
+            scores[i] = score
+        return scores
+
+    def select(self, email: EmailData,
+               cost: Callable[[tuple[EmailData, Any]], int] = lambda sample: 0,
+               ) -> list[tuple[EmailData, Any]]:
+        """Return the most relevant samples for the email
+
+        `cost` returns the number of tokens a sample adds to the prompt.
+        Samples are returned least relevant first, so that the most relevant
+        sample is closest to the email in the prompt.
+        """
+        scores = self.scores(email)
+        selected = []
+        used = 0
+        for i in sorted(scores, key=lambda i: (-scores[i], i)):
+            if len(selected) == self.k:
+                break
+            tokens = cost(self.samples[i])
+            if self.token_budget is not None and used + tokens > self.token_budget:
+                continue
+            selected.append(self.samples[i])
+            used += tokens
+        return selected[::-1]
+
+    @classmethod
+    def from_yaml(cls, paths: Iterable[str | Path], field: str,
+                  schema: type[pydantic.BaseModel], **kwargs) -> "SampleStore":
+        """Load samples from YAML files with an `email` and a labelled response
+
+        `field` is the key of the response in the files, such as
+        `header_analysis` or `action`. Files without it are skipped.
+        """
+        store = cls(**kwargs)
+        for path in paths:
+            path = Path(path).expanduser()
+            files = sorted(path.glob("*.yaml")) if path.is_dir() else [path]
+            for file in files:
+                with open(file, "r") as f:
+                    data = yaml.safe_load(f)
+                if not data or field not in data:
+                    continue
+                store.add(EmailData.model_validate(data["email"]),
+                          schema.model_validate(data[field]))
+        return store
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Builds the sender reputation store from the header analysis results
+# published by mail-headers-analyse.py.
+
+import argparse
+import asyncio
+import logging
+import nats
+import os
+import pydantic
+import sys
+
+from consumer import PullConsumer, add_follow_arguments
+from models import HeaderAnalysis
+from sender_reputation import DEFAULT_HALF_LIFE, DEFAULT_REPUTATION_DB, SenderReputation
+
+async def main():
+    default_nats = os.environ.get("NATS", "nats://localhost:4222")
+    default_db = os.environ.get("SENDER_REPUTATION", DEFAULT_REPUTATION_DB)
+
+    parser = argparse.ArgumentParser(
+        description="Build sender reputation from email header analysis",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--nats", default=default_nats,
+                        help="NATS server URL")
+    parser.add_argument("--nats-stream", default="email_header_analysis",
+                        help="NATS stream to subscribe to")
+    parser.add_argument("--nats-consumer", default="sender-reputation",
+                        help="NATS consumer name")
+    parser.add_argument("--reputation-db", default=default_db,
+                        help="SQLite file to store sender reputation in")
+    parser.add_argument("--half-life", type=float, default=DEFAULT_HALF_LIFE / (24 * 3600),
+                        help="Days after which a verdict counts for half as much (stored "
+                             "with the reputation for mail-headers-analyse.py)")
+    parser.add_argument("--fetch-batch", type=int, default=50,
+                        help="Number of messages to fetch at a time")
+    parser.add_argument("--limit", type=int, default=-1,
+                        help="Number of messages to process (-1 for all)")
+    parser.add_argument("--debug", action=argparse.BooleanOptionalAction,
+                        help="Enable debug logging")
+    add_follow_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s")
+
+    async def error_handler(e):
+        logging.error("Error: %s", e)
+        sys.exit(1)
+
+    logging.debug("Connecting to NATS server at %s", args.nats)
+    nc = await nats.connect(args.nats, error_cb=error_handler)
+    js = nc.jetstream()
+
+    logging.debug("Subscribing to stream %s", args.nats_stream)
+    psub = await js.pull_subscribe("", stream=args.nats_stream,
+                                   durable=args.nats_consumer)
+
+    reputation = SenderReputation(args.reputation_db,
+                                  half_life=args.half_life * 24 * 3600)
+
+    updated = 0
+    consumer = PullConsumer(psub, batch=args.fetch_batch, timeout=2,
+                            limit=args.limit, follow=args.follow,
+                            max_batch=args.max_fetch_batch, max_idle=args.max_idle)
+    consumer.stop_on_signals()
+
+    async for msgs in consumer.batches():
+        acks = []
+        for msg in msgs:
+            acks.append(msg.ack())
+
+            headers = msg.headers or {}
+            sender = headers.get("Email-From")
+            source = headers.get("Analysis-Source")
+
+            # Only learn from verdicts that came from the model, so that
+            # rule and reputation verdicts don't reinforce themselves
+            if not sender or source != "model":
+                logging.debug("Skipping %s analysis for %s", source, sender)
+                continue
+
+            try:
+                analysis = HeaderAnalysis.model_validate_json(msg.data)
+            except pydantic.ValidationError as e:
+                logging.error("Error validating header analysis: %s: %s", e, msg.data)
+                continue
+
+            logging.debug("Updating reputation of %s: %s", sender, analysis)
+            reputation.update(sender, analysis)
+            updated += 1
+
+        await asyncio.gather(*acks)
+
+    logging.info("Updated sender reputation with %d verdicts", updated)
+    reputation.close()
+    await nc.close()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,189 @@
+import logging
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from models import EmailData, HeaderAnalysis
+from preclassifier import normalise_address
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPUTATION_DB = "~/.cache/mail-assistant/senders.db"
+
+# Half-life of verdicts in seconds, unless the store was built with another
+DEFAULT_HALF_LIFE = 30 * 24 * 3600
+
+# Verdicts tracked per sender, as fields of HeaderAnalysis
+VERDICTS = ("is_important", "is_transactional", "notify", "needs_analysis")
+
+# Also tracked: whether the sender's emails have a due date, which only the
+# model can extract
+DUE_DATE = "has_due_date"
+COLUMNS = VERDICTS + (DUE_DATE,)
+
+# Domains shared by unrelated senders, whose emails aren't aggregated
+FREEMAIL_DOMAINS = {
+    "aol.com", "fastmail.com", "gmail.com", "googlemail.com", "gmx.com", "gmx.de",
+    "gmx.net", "hey.com", "hotmail.co.uk", "hotmail.com", "icloud.com", "live.com",
+    "mac.com", "mail.com", "me.com", "msn.com", "outlook.com", "proton.me",
+    "protonmail.com", "web.de", "yahoo.co.uk", "yahoo.com", "yandex.ru", "zoho.com",
+}
+
+class SenderReputation:
+    """Store of header analysis verdicts aggregated per sender
+
+    Verdicts are aggregated per sender address and per sender domain as
+    exponentially decayed counts, so that a sender's recent behaviour
+    outweighs what it did months ago. A sender is trusted once its decayed
+    history weighs at least `min_weight` and every verdict agrees at least
+    `agreement` of the time. The history of the domain only stands in for
+    an address with at least `min_address_weight` of history of its own
+    that agrees with it, and freemail domains are not aggregated.
+
+    The half-life is stored with the history, so that the process building
+    it and the ones looking senders up decay it the same way. Pass
+    `half_life` only when building it.
+    """
+
+    def __init__(self, path: str | Path = DEFAULT_REPUTATION_DB,
+                 half_life: Optional[float] = None,
+                 min_weight: float = 5.0,
+                 min_address_weight: float = 0.5,
+                 agreement: float = 0.9):
+        self.min_weight = min_weight
+        self.min_address_weight = min_address_weight
+        self.agreement = agreement
+        self.lock = threading.Lock()
+
+        path = Path(path).expanduser()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(f"""CREATE TABLE IF NOT EXISTS senders (
+                                sender TEXT PRIMARY KEY,
+                                weight REAL NOT NULL,
+                                {", ".join(f"{v} REAL NOT NULL" for v in COLUMNS)},
+                                updated REAL NOT NULL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS settings (
+                               name TEXT PRIMARY KEY,
+                               value REAL NOT NULL)""")
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(senders)")}
+        if DUE_DATE not in columns:
+            # Unknown for existing history, so count it as undecided
+            self.db.execute(f"ALTER TABLE senders ADD COLUMN {DUE_DATE} REAL NOT NULL DEFAULT 0")
+            self.db.execute(f"UPDATE senders SET {DUE_DATE} = weight / 2")
+
+        if half_life is None:
+            row = self.db.execute("SELECT value FROM settings WHERE name = 'half_life'").fetchone()
+            half_life = row[0] if row is not None else DEFAULT_HALF_LIFE
+        else:
+            self.db.execute("INSERT OR REPLACE INTO settings VALUES ('half_life', ?)",
+                            (half_life,))
+        self.half_life = half_life
+
+        self.trusted = 0
+        self.untrusted = 0
+
+    @staticmethod
+    def sender_keys(sender: str) -> list[str]:
+        """Return the keys the sender is aggregated under, most specific first"""
+        address = normalise_address(sender)
+        domain = address.rpartition("@")[2]
+        if domain in FREEMAIL_DOMAINS:
+            return [address]
+        return [address, "@" + domain]
+
+    def decay(self, updated: float, now: float) -> float:
+        """Return the decay factor for counts last updated at `updated`"""
+        return 0.5 ** (max(now - updated, 0) / self.half_life)
+
+    def history(self, key: str) -> Optional[tuple]:
+        """Return the weight, verdict counts and update time of a key"""
+        return self.db.execute(
+            f"SELECT weight, {', '.join(COLUMNS)}, updated FROM senders WHERE sender = ?",
+            (key,)).fetchone()
+
+    def update(self, sender: str, analysis: HeaderAnalysis, now: Optional[float] = None):
+        """Add a header analysis verdict to the sender's history"""
+        now = time.time() if now is None else now
+        values = [float(getattr(analysis, v)) for v in VERDICTS]
+        values.append(float(analysis.due_date is not None))
+        with self.lock:
+            for key in self.sender_keys(sender):
+                row = self.history(key)
+                if row is None:
+                    counts = [1.0] + values
+                else:
+                    factor = self.decay(row[-1], now)
+                    counts = [row[0] * factor + 1.0] + [
+                        count * factor + value
+                        for count, value in zip(row[1:-1], values)]
+                self.db.execute(
+                    f"""INSERT OR REPLACE INTO senders (sender, weight, {', '.join(COLUMNS)}, updated)
+                        VALUES (?, ?, {', '.join('?' * len(COLUMNS))}, ?)""",
+                    (key, *counts, now))
+
+    def verdicts(self, row: tuple) -> Optional[dict[str, bool]]:
+        """Return the verdicts of a history, if they all agree often enough"""
+        weight = row[0]
+        verdicts = {}
+        for name, count in zip(COLUMNS, row[1:-1]):
+            ratio = count / weight
+            if ratio >= self.agreement:
+                verdicts[name] = True
+            elif ratio <= 1 - self.agreement:
+                verdicts[name] = False
+            else:
+                return None
+        return verdicts
+
+    def lookup(self, sender: str, now: Optional[float] = None) -> Optional[dict[str, bool]]:
+        """Return the stable verdicts for the sender, if it can be trusted"""
+        now = time.time() if now is None else now
+        keys = self.sender_keys(sender)
+        with self.lock:
+            address = self.history(keys[0])
+            if address is None:
+                return None
+            weight = address[0] * self.decay(address[-1], now)
+            if weight >= self.min_weight:
+                return self.verdicts(address)
+            if weight < self.min_address_weight or len(keys) == 1:
+                return None
+
+            # Too little history of the address, but what there is agrees
+            # with the rest of its domain
+            domain = self.history(keys[1])
+            if domain is None or domain[0] * self.decay(domain[-1], now) < self.min_weight:
+                return None
+            verdicts = self.verdicts(domain)
+            if verdicts is None or self.verdicts(address) != verdicts:
+                return None
+            return verdicts
+
+    def classify(self, email: EmailData) -> Optional[HeaderAnalysis]:
+        """Return a header analysis for the email based on its sender's history"""
+        for sender in email.from_:
+            verdicts = self.lookup(sender)
+            # Senders whose emails need further analysis or have due dates
+            # still go to the model
+            if (verdicts is not None and not verdicts["needs_analysis"]
+                    and not verdicts[DUE_DATE]):
+                logger.debug("Trusting reputation of sender %s", sender)
+                self.trusted += 1
+                return HeaderAnalysis(clean_subject=email.subject,
+                                      **{name: verdicts[name] for name in VERDICTS})
+
+        self.untrusted += 1
+        return None
+
+    def stats(self) -> dict[str, int]:
+        """Return the number of emails classified from sender reputation"""
+        return {"trusted": self.trusted, "untrusted": self.untrusted}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
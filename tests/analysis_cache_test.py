@@ -0,0 +1,72 @@
+from conftest import FakeModel
+import time
+
+from analysis_cache import SQLiteCache, cache_key
+from mail_analysis import MailAnalyseHeaders
+from models import EmailData, HeaderAnalysis, EmailAction
+
+def test_cache_key():
+    key = cache_key("model", "email_headers", "prompt", HeaderAnalysis)
+    assert key == cache_key("model", "email_headers", "prompt", HeaderAnalysis)
+    assert key != cache_key("other", "email_headers", "prompt", HeaderAnalysis)
+    assert key != cache_key("model", "email_full", "prompt", HeaderAnalysis)
+    assert key != cache_key("model", "email_headers", "prompt2", HeaderAnalysis)
+    assert key != cache_key("model", "email_headers", "prompt", EmailAction)
+
+def test_get_put(tmp_path):
+    cache = SQLiteCache(tmp_path / "cache.db")
+    assert cache.get("key") is None
+    cache.put("key", "value")
+    assert cache.get("key") == "value"
+    assert cache.stats() == {"hits": 1, "misses": 1}
+
+    # Entries survive reopening the cache
+    cache.close()
+    cache = SQLiteCache(tmp_path / "cache.db")
+    assert cache.get("key") == "value"
+
+def test_ttl(tmp_path):
+    cache = SQLiteCache(tmp_path / "cache.db", ttl=0.01)
+    cache.put("key", "value")
+    time.sleep(0.02)
+    assert cache.get("key") is None
+
+def test_eviction(tmp_path):
+    cache = SQLiteCache(tmp_path / "cache.db", max_entries=2)
+    cache.put("a", "1")
+    time.sleep(0.01)
+    cache.put("b", "2")
+    time.sleep(0.01)
+    assert cache.get("a") == "1"
+    time.sleep(0.01)
+    cache.put("c", "3")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+
+def test_analyser_uses_cache(tmp_path):
+    email = EmailData(
+        from_=[ "someone@somewhere.com" ],
+        to=[ "me@here.com" ],
+        subject="Your statement is ready",
+        date="2025-02-22T09:07:27+00:00",
+        message_id="msg1234567890",
+        body="",
+    )
+    analysis = HeaderAnalysis(
+        clean_subject="Statement ready",
+        is_important=True,
+        is_transactional=True,
+        notify=False,
+        needs_analysis=False,
+    )
+
+    cache = SQLiteCache(tmp_path / "cache.db")
+    analyser = MailAnalyseHeaders(model="4o-mini", cache=cache)
+    analyser.model = FakeModel([analysis.model_dump_json()])
+
+    assert analyser.process(email) == analysis
+    assert analyser.process(email) == analysis
+    assert len(analyser.model.prompts) == 1
+    assert cache.stats() == {"hits": 1, "misses": 1}
@@ -0,0 +1,59 @@
+from body_reduction import (clean_paragraphs, estimate_tokens, reduce_body,
+                            select_sentences, strip_quoted, strip_signature)
+
+def test_strip_quoted():
+    text = ("Sounds good, see you then.\n\n"
+            "On Mon, 24 Feb 2025 at 10:00, Someone <someone@example.com> wrote:\n"
+            "> Shall we meet on Friday?\n")
+    assert strip_quoted(text).strip() == "Sounds good, see you then."
+
+    text = "Thanks\n> quoted line\nMore text"
+    assert strip_quoted(text) == "Thanks\nMore text"
+
+    text = ("FYI\n\n-----Original Message-----\nFrom: a@b.com\nSent: Monday\n\nOld stuff")
+    assert strip_quoted(text).strip() == "FYI"
+
+def test_strip_signature():
+    assert strip_signature("Hello\n\nThanks\n-- \nJohn\n555-1234") == "Hello\n\nThanks\n"
+
+def test_clean_paragraphs():
+    text = ("Your order has shipped.\n\n"
+            "Your order   has shipped.\n\n"
+            "Click here to unsubscribe.\n\n"
+            "Copyright 2025 Shop. All rights reserved.\n\n"
+            "It will arrive on Friday. View this email in your browser.")
+    assert clean_paragraphs(text) == ["Your order has shipped.", "It will arrive on Friday."]
+
+def test_clean_paragraphs_keeps_content_around_boilerplate():
+    text = "Hi,\nPlease pay the invoice by Friday.\nTo unsubscribe click here"
+    assert clean_paragraphs(text) == ["Hi,\nPlease pay the invoice by Friday."]
+
+def test_select_sentences():
+    paragraphs = [
+        "Welcome to our newsletter.",
+        "We have lots of news. Some of it is interesting.",
+        "Please pay your invoice by 2025-03-10.",
+        "Thanks for reading.",
+    ]
+    selected = select_sentences(paragraphs, 20, None)
+    assert selected == "Welcome to our newsletter. Please pay your invoice by 2025-03-10."
+
+def test_reduce_body_within_budget():
+    body = "Hello,\n\nPlease book the meeting for Friday.\n-- \nSignature"
+    assert reduce_body(body, 1000) == "Hello,\n\nPlease book the meeting for Friday."
+
+def test_reduce_body_over_budget():
+    filler = "This is a sentence about nothing in particular. " * 200
+    body = f"Statement ready.\n\n{filler}\n\nPayment is due on 10 March."
+    reduced = reduce_body(body, 50)
+    assert estimate_tokens(reduced) <= 50
+    assert reduced.startswith("Statement ready.")
+    assert reduced.endswith("Payment is due on 10 March.")
+
+def test_reduce_body_keeps_quoted_only_email():
+    assert reduce_body("> Shall we meet on Friday?", 1000) == "> Shall we meet on Friday?"
+
+def test_reduce_body_never_empty():
+    body = "You are receiving this because you signed up. Unsubscribe here."
+    assert reduce_body(body, 1000) == body
+    assert reduce_body("Pay " + "x" * 400, 10) == "Pay " + "x" * 400
@@ -0,0 +1,115 @@
+from conftest import FakeAsyncModel, FakeModel
+import asyncio
+import json
+import pydantic
+import pytest
+
+from cascade import Cascade, Tier, flag_check, load_cascade, rules_check
+from mail_analysis import MailAnalyse, MailAnalyseHeaders
+from models import EmailData, HeaderAnalysis
+from preclassifier import DEFAULT_RULES_FILE, PreClassifier, Rule
+
+EMAIL = EmailData(
+    from_=["news@example.com"],
+    to=["me@here.com"],
+    subject="Weekly digest",
+    date="2025-02-22T09:07:27+00:00",
+    message_id="msg1",
+    body="Body",
+)
+
+def analysis(**kwargs) -> str:
+    fields = {
+        "is_important": False,
+        "is_transactional": False,
+        "notify": False,
+        "needs_analysis": False,
+        **kwargs,
+    }
+    return json.dumps(fields)
+
+def tier(name, responses, **kwargs) -> Tier:
+    analyser = MailAnalyseHeaders(model="4o-mini", retry_invalid=False)
+    analyser.model = FakeModel(responses)
+    return Tier(name, analyser, **kwargs)
+
+def test_no_escalation():
+    small = tier("small", [analysis(confidence=0.9)], min_confidence=0.7, cost_per_call=1)
+    large = tier("large", [])
+    cascade = Cascade([small, large])
+
+    assert cascade.process(EMAIL).confidence == 0.9
+    stats = cascade.stats()
+    assert stats["small"]["calls"] == 1
+    assert stats["small"]["escalation_rate"] == 0
+    assert stats["small"]["cost"] == 1
+    assert stats["large"]["calls"] == 0
+
+@pytest.mark.parametrize("response,reason", [
+    (analysis(confidence=0.5), "confidence"),
+    ("not json", "invalid"),
+    (analysis(needs_analysis=True), "needs_analysis"),
+])
+def test_escalation(response, reason):
+    small = tier("small", [response], min_confidence=0.7,
+                 checks=[flag_check(["needs_analysis"])])
+    large = tier("large", [analysis(is_important=True)])
+    cascade = Cascade([small, large])
+
+    assert cascade.process(EMAIL).is_important
+    stats = cascade.stats()
+    assert stats["small"]["escalated"] == 1
+    assert stats["large"]["calls"] == 1
+    assert stats["escalation_reasons"] == {reason: 1}
+
+def test_rules_check():
+    preclassifier = PreClassifier([Rule(
+        name="digests", subjects=["digest"],
+        analysis=HeaderAnalysis.model_validate_json(analysis()))])
+    check = rules_check(preclassifier)
+
+    assert check(EMAIL, HeaderAnalysis.model_validate_json(analysis())) is None
+    reason = check(EMAIL, HeaderAnalysis.model_validate_json(analysis(notify=True)))
+    assert reason == "disagrees with rule digests on notify"
+
+def test_last_tier_errors_are_raised():
+    cascade = Cascade([tier("small", ["not json"]), tier("large", ["not json"])])
+    with pytest.raises(pydantic.ValidationError):
+        cascade.process(EMAIL)
+    assert cascade.stats()["large"]["failed"] == 1
+
+def test_aprocess_escalates_on_timeout():
+    small = tier("small", [])
+    small.analyser.async_model = FakeAsyncModel([analysis()], delay=1)
+    large = tier("large", [])
+    large.analyser.async_model = FakeAsyncModel([analysis(notify=True)])
+    cascade = Cascade([small, large])
+
+    assert asyncio.run(cascade.aprocess(EMAIL, timeout=0.05)).notify
+    assert cascade.stats()["escalation_reasons"] == {"timeout": 1}
+
+def test_load_cascade(tmp_path):
+    path = tmp_path / "cascade.yaml"
+    path.write_text("""
+tiers:
+  - name: small
+    model: 4o-mini
+    min_confidence: 0.6
+    escalate_if: [needs_analysis]
+  - model: gpt-4o
+""")
+    cascade = load_cascade(path, MailAnalyseHeaders)
+    assert [t.name for t in cascade.tiers] == ["small", "gpt-4o"]
+    assert cascade.tiers[0].min_confidence == 0.6
+    assert len(cascade.tiers[0].checks) == 1
+
+    with pytest.raises(ValueError, match="no rules"):
+        path.write_text("tiers: [{model: 4o-mini, check_rules: true}]")
+        load_cascade(path, MailAnalyseHeaders)
+
+def test_load_cascade_for_full_analysis(tmp_path):
+    # Rules are checked against the fields the full analysis shares with them
+    path = tmp_path / "cascade.yaml"
+    path.write_text("tiers: [{model: 4o-mini, check_rules: true}, {model: gpt-4o}]")
+    cascade = load_cascade(path, MailAnalyse, PreClassifier.from_yaml(DEFAULT_RULES_FILE))
+    assert len(cascade.tiers[0].checks) == 1
@@ -1,8 +1,12 @@
+import asyncio
 import logging
+import nats.js.errors
+import os
 from pathlib import Path
 import pydantic
 import pytest
 import sys
+from types import SimpleNamespace
 import yaml
 
 # Ensure project root is in sys.path
@@ -25,6 +29,28 @@ def load_yaml_data(file_path):
             action = None
         return email, analysis, action
 
+def make_email(sender="someone@somewhere.com", subject="Hello", body="", **fields) -> EmailData:
+    """Return an email, with any other fields replacing the defaults"""
+    return EmailData(**{
+        "from_": [sender],
+        "to": ["me@here.com"],
+        "subject": subject,
+        "date": "2025-02-22T09:07:27+00:00",
+        "message_id": "msg",
+        "body": body,
+        **fields,
+    })
+
+def llm_model(model_id):
+    """Return the model to use for LLM tests
+
+    With $TEST_MODEL_SERVER set, tests use the model from model-server.py
+    instead of loading it for every test case.
+    """
+    if os.environ.get("TEST_MODEL_SERVER"):
+        return f"server:{model_id}"
+    return model_id
+
 def get_test_cases():
     test_cases = {}
     for file in DATA_DIR.glob("*.yaml"):
@@ -44,3 +70,138 @@ def get_test_cases_for_analysis():
             test_cases[test_name] = data
 
     return test_cases
+
+class FakeResponse:
+    def __init__(self, text):
+        self._text = text
+
+    def text(self):
+        return self._text
+
+class FakeModel:
+    """Stand-in for an llm model that returns canned responses"""
+
+    model_id = "fake"
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.prompts = []
+
+    def prompt(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        return FakeResponse(self.responses.pop(0))
+
+class FakeAsyncResponse:
+    def __init__(self, text, delay):
+        self._text = text
+        self.delay = delay
+
+    async def text(self):
+        await asyncio.sleep(self.delay)
+        return self._text
+
+class FakeAsyncModel:
+    """Stand-in for an llm async model that returns canned responses"""
+
+    model_id = "fake"
+
+    def __init__(self, responses, delay=0):
+        self.responses = list(responses)
+        self.delay = delay
+        self.prompts = []
+
+    def prompt(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        return FakeAsyncResponse(self.responses.pop(0), self.delay)
+
+class FakeObjectResult:
+    def __init__(self, data):
+        self.data = data
+
+class FakeObjectStore:
+    """Stand-in for a JetStream Object Store bucket"""
+
+    def __init__(self, config=None):
+        self.config = config
+        self.objects = {}
+
+    async def put(self, name, data):
+        if self.config and self.config.max_bytes and len(data) > self.config.max_bytes:
+            raise RuntimeError("Bucket is full")
+        self.objects[name] = data
+
+    async def get(self, name):
+        if name not in self.objects:
+            raise nats.js.errors.ObjectNotFoundError
+        return FakeObjectResult(self.objects[name])
+
+class FakeJetStream:
+    """Stand-in for a JetStream context, storing messages in a single stream"""
+
+    def __init__(self, nc=None, failing=()):
+        self.nc = nc
+        self.failing = set(failing)
+        self.stores = {}
+        self.messages = []
+
+    async def publish(self, subject, payload, headers=None):
+        if self.nc is not None:
+            self.nc.events.append(("js", subject))
+        if subject in self.failing:
+            raise RuntimeError(f"No stream for {subject}")
+        self.messages.append(SimpleNamespace(subject=subject, data=payload, headers=headers))
+        return SimpleNamespace(stream="emails", seq=len(self.messages))
+
+    async def get_msg(self, stream, seq):
+        return self.messages[seq - 1]
+
+    async def create_object_store(self, bucket, config=None):
+        return self.stores.setdefault(bucket, FakeObjectStore(config))
+
+    async def object_store(self, bucket):
+        if bucket not in self.stores:
+            raise nats.js.errors.BucketNotFoundError
+        return self.stores[bucket]
+
+class FakeNATS:
+    """Stand-in for a NATS connection, recording what is published and acked
+
+    `events` lists core and JetStream publishes and acknowledgements in
+    order, and `published` the core publishes with their data and headers.
+    Publishing to a subject in `failing` through JetStream raises an error.
+    """
+
+    def __init__(self, failing=()):
+        self.events = []
+        self.published = []
+        self.js = FakeJetStream(self, failing)
+
+    def jetstream(self):
+        return self.js
+
+    async def publish(self, subject, data, headers=None):
+        self.events.append(("core", subject))
+        self.published.append((subject, data, headers))
+
+class FakeMsg:
+    """Stand-in for a message from a JetStream pull consumer"""
+
+    def __init__(self, data=b"", headers=None, nc=None, name="msg", delivered=1):
+        self.data = data
+        self.headers = headers
+        self.nc = nc
+        self.name = name
+        self.metadata = SimpleNamespace(num_delivered=delivered)
+
+    def record(self, *event):
+        if self.nc is not None:
+            self.nc.events.append(event)
+
+    async def ack(self):
+        self.record("ack", self.name)
+
+    async def nak(self, delay=None):
+        self.record("nak", self.name, delay)
+
+    async def term(self):
+        self.record("term", self.name)
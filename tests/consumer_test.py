@@ -0,0 +1,62 @@
+import asyncio
+import nats
+
+from consumer import PullConsumer
+
+class FakeSubscription:
+    """Pull subscription serving a fixed number of messages"""
+
+    def __init__(self, count, timeout_error=False):
+        self.remaining = count
+        self.timeout_error = timeout_error
+        self.fetches = []
+
+    async def fetch(self, batch, timeout):
+        self.fetches.append(batch)
+        n = min(batch, self.remaining)
+        if n == 0:
+            if self.timeout_error:
+                raise nats.errors.TimeoutError
+            await asyncio.sleep(0.01)
+            return []
+        self.remaining -= n
+        return list(range(n))
+
+async def collect(consumer):
+    return [msgs async for msgs in consumer.batches()]
+
+def test_stops_when_empty():
+    psub = FakeSubscription(5, timeout_error=True)
+    batches = asyncio.run(collect(PullConsumer(psub, batch=2)))
+    assert [len(msgs) for msgs in batches] == [2, 2, 1]
+
+def test_limit():
+    psub = FakeSubscription(10)
+    batches = asyncio.run(collect(PullConsumer(psub, batch=3, limit=4)))
+    assert [len(msgs) for msgs in batches] == [3, 1]
+    assert psub.fetches == [3, 1]
+
+def test_grows_while_busy():
+    psub = FakeSubscription(20)
+    batches = asyncio.run(collect(PullConsumer(psub, batch=2, max_batch=8)))
+    # Shrinks back to the size of the last short fetch
+    assert psub.fetches == [2, 4, 8, 8, 6]
+    assert sum(len(msgs) for msgs in batches) == 20
+
+def test_follow_until_stopped():
+    psub = FakeSubscription(3)
+
+    async def run():
+        consumer = PullConsumer(psub, batch=2, limit=1, follow=True,
+                                min_idle=0.01, max_idle=0.02)
+        received = 0
+        async for msgs in consumer.batches():
+            received += len(msgs)
+            if received == 3:
+                # Stop while the consumer is idle
+                asyncio.get_running_loop().call_later(0.1, consumer.stop)
+        return received
+
+    # Follow mode ignores the limit and keeps polling the idle stream
+    assert asyncio.run(run()) == 3
+    assert len(psub.fetches) > 3
@@ -0,0 +1,127 @@
+from conftest import FakeMsg, FakeNATS
+import asyncio
+import hashlib
+
+from archiver import archive
+from dedupe import BloomFilter, MSG_ID_HEADER, SeenSet, message_key, msg_id_headers
+
+RAW_EMAIL = b"""From: Someone <someone@somewhere.com>
+To: me@here.com
+Subject: Hello
+Date: Sat, 22 Feb 2025 09:07:27 +0000
+Message-ID: <abc@somewhere.com>
+Content-Type: text/plain
+
+Hello there
+"""
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, 0.01)
+    keys = [f"key{i}" for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    false_positives = sum(f"other{i}" in bloom for i in range(10000))
+    assert false_positives < 300
+
+def test_claim_and_add():
+    seen = SeenSet()
+    assert seen.claim("a")
+    # A duplicate arriving while the first is being handled is dropped
+    assert not seen.claim("a")
+    seen.add("a")
+    assert "a" in seen
+    assert not seen.claim("a")
+    assert seen.stats() == {"checked": 3, "duplicates": 2, "lookups": 2}
+
+def test_release():
+    seen = SeenSet()
+    assert seen.claim("a")
+    seen.release("a")
+    assert "a" not in seen
+    assert seen.claim("a")
+
+def test_empty_key_never_duplicate():
+    seen = SeenSet()
+    seen.add("")
+    assert seen.claim("")
+    assert seen.claim("")
+
+def test_persistence_and_stages(tmp_path):
+    path = tmp_path / "seen.db"
+    seen = SeenSet(path, stage="analysis")
+    seen.add("a")
+    seen.close()
+
+    seen = SeenSet(path, stage="analysis")
+    assert not seen.claim("a")
+    seen.close()
+    seen = SeenSet(path, stage="reminders", bloom=False)
+    assert seen.claim("a")
+    seen.close()
+
+def test_max_entries(tmp_path):
+    path = tmp_path / "seen.db"
+    seen = SeenSet(path, max_entries=2, prune_interval=4)
+    for key in ("a", "b", "c"):
+        seen.add(key)
+    # Keys are only pruned every few keys added
+    assert "a" in seen
+    seen.close()
+    # One process per key, as with the archiver as an MDA
+    seen = SeenSet(path, max_entries=2, prune_interval=4)
+    seen.add("d")
+    seen.close()
+
+    seen = SeenSet(path, max_entries=2)
+    assert "a" not in seen and "b" not in seen
+    assert "c" in seen and "d" in seen
+
+def test_add_when_confirmed():
+    async def run():
+        loop = asyncio.get_running_loop()
+        seen = SeenSet()
+
+        outputs = [loop.create_future(), loop.create_future()]
+        assert seen.claim("ok")
+        seen.add_when_confirmed("ok", outputs)
+        outputs[0].set_result(None)
+        await asyncio.sleep(0)
+        assert "ok" not in seen
+        outputs[1].set_result(None)
+        await asyncio.sleep(0)
+        assert "ok" in seen
+
+        outputs = [loop.create_future(), loop.create_future()]
+        assert seen.claim("failed")
+        seen.add_when_confirmed("failed", outputs)
+        outputs[0].set_exception(RuntimeError("publish failed"))
+        outputs[1].set_result(None)
+        await asyncio.sleep(0)
+        # Released, so that the redelivered message is handled
+        assert "failed" not in seen
+        assert seen.claim("failed")
+
+    asyncio.run(run())
+
+def test_msg_id_headers():
+    assert msg_id_headers("tasks", "msg1") == {MSG_ID_HEADER: "tasks:msg1"}
+    assert msg_id_headers("tasks", "msg1", {"A": "b"}) == {"A": "b", MSG_ID_HEADER: "tasks:msg1"}
+    assert msg_id_headers("tasks", "") is None
+
+def test_message_key():
+    assert message_key(FakeMsg(b"data", {MSG_ID_HEADER: "tasks:msg1"})) == "tasks:msg1"
+    assert message_key(FakeMsg(b"data")) == hashlib.sha256(b"data").hexdigest()
+
+def test_archive_skips_duplicates():
+    async def run():
+        nc = FakeNATS()
+        seen = SeenSet(bloom=False)
+        for _ in range(2):
+            await archive(nc, RAW_EMAIL, "sender", "email.parsed", "email.error",
+                          parser="fast", seen=seen)
+        return [(subject, headers) for subject, _, headers in nc.published], seen.stats()
+
+    published, stats = asyncio.run(run())
+    assert published == [("email.parsed", {MSG_ID_HEADER: "email.parsed:abc@somewhere.com"})]
+    assert stats["duplicates"] == 1
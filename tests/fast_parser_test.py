@@ -0,0 +1,85 @@
+from pathlib import Path
+import pytest
+
+from fast_parser import (email_data, html_to_text, message_attachments, message_id,
+                         needs_unstructured, parse_message)
+
+MIME_DIR = Path(__file__).parent / "data" / "mime"
+
+def load_message(name):
+    return parse_message((MIME_DIR / name).read_bytes())
+
+def normalise_whitespace(text):
+    return " ".join(text.split())
+
+def test_html_to_text():
+    html = """<html><head><title>T</title><script>var x;</script></head>
+              <body><h1>Title</h1><p>Some <b>bold</b>
+              text&amp;more</p>Line<br>break<table><tr><td>a</td><td>b</td></tr></table></body></html>"""
+    assert html_to_text(html) == "Title\n\nSome bold text&more\n\nLine\nbreak\n\na b"
+
+@pytest.mark.parametrize("name, expected", [
+    ("plain.eml", False),
+    ("html.eml", False),
+    ("alternative.eml", False),
+    ("image.eml", True),
+    # Only an inline logo and a tiny icon
+    ("related.eml", False),
+])
+def test_needs_unstructured(name, expected):
+    assert needs_unstructured(load_message(name)) == expected
+
+def test_plain_email():
+    data = email_data(load_message("plain.eml"))
+    assert data.from_ == [ "Billing <billing@utility.example.com>" ]
+    assert data.to == [ "me@here.com" ]
+    assert data.subject == "Your bill is ready"
+    assert data.date == "2025-02-22T09:07:27+00:00"
+    assert data.message_id == "plain-1@utility.example.com"
+    assert data.body == (
+        "Hello,\n\n"
+        "Your electricity bill for February is ready.\n"
+        "The amount due is 42.10 GBP, payable by 2025-03-10.\n\n"
+        "Thanks,\nThe Billing Team")
+    assert data.headers == {}
+
+def test_message_id_normalised():
+    # The key used to dedupe raw emails matches the parsed message_id
+    email = (MIME_DIR / "plain.eml").read_bytes()
+    assert message_id(email) == email_data(parse_message(email)).message_id
+    assert message_id(b"Message-ID:  <a@b.com> \n\nbody") == "a@b.com"
+
+def test_html_email():
+    data = email_data(load_message("html.eml"))
+    assert data.to == [ "Me <me@here.com>" ]
+    assert data.date == "2025-02-24T18:30:00+01:00"
+    assert data.body == (
+        "Spring sale\n\n"
+        "Everything is 20% off this week only.\n\n"
+        "Visit our store\n\nShoes\n\nShirts")
+    assert data.headers == {"List-Unsubscribe": "<mailto:unsubscribe@shop.example.com>"}
+
+def test_message_attachments_skip_decoration():
+    [(filename, content_type, _)] = message_attachments(load_message("image.eml"))
+    assert (filename, content_type) == ("invoice.png", "image/png")
+    assert message_attachments(load_message("related.eml")) == []
+
+def test_alternative_email_prefers_plain_text():
+    data = email_data(load_message("alternative.eml"))
+    assert data.body == "Your booking is confirmed.\n\nLondon to Cobham, 18 April at 09:09."
+
+@pytest.mark.parametrize("path", sorted(MIME_DIR.glob("*.eml")), ids=lambda p: p.stem)
+def test_equivalent_to_unstructured(path):
+    archiver = pytest.importorskip("archiver")
+    pytest.importorskip("unstructured")
+
+    email = path.read_bytes()
+    fast = archiver.parse_email(email, parser="fast")
+    slow = archiver.parse_email(email, parser="unstructured")
+
+    if needs_unstructured(parse_message(email)):
+        # Only unstructured extracts the text of images and documents
+        fast.body = slow.body = ""
+    fast.body = normalise_whitespace(fast.body)
+    slow.body = normalise_whitespace(slow.body)
+    assert fast == slow
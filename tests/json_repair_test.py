@@ -0,0 +1,38 @@
+import pytest
+
+from json_repair import extract_json, repair_response
+from models import EmailAction, HeaderAnalysisBatch
+
+@pytest.mark.parametrize("text", [
+    '{"action": "Pay", "notify": true}',
+    'Here is the JSON:\n{"action": "Pay", "notify": true}\nLet me know!',
+    '```json\n{"action": "Pay", "notify": true}\n```',
+    '{"action": "Pay", "notify": true,}',
+    "{'action': 'Pay', 'notify': True}",
+    'assistant: {"action": "Pay", "notify": true} {"action": "Other"}',
+])
+def test_extract_json(text):
+    assert extract_json(text) == {"action": "Pay", "notify": True}
+
+def test_extract_json_strings():
+    # Braces and quotes inside strings are left alone
+    assert extract_json('{"action": "Reply to {them}", "note": "it\'s \\"done\\""}') == {
+        "action": "Reply to {them}", "note": "it's \"done\""}
+    assert extract_json("{'action': 'Say \"hi\"', 'done': None}") == {
+        "action": 'Say "hi"', "done": None}
+
+@pytest.mark.parametrize("text", ["", "No JSON here", "{unbalanced", "{not: json}"])
+def test_extract_json_failure(text):
+    assert extract_json(text) is None
+
+def test_repair_response():
+    action = repair_response('Sure! {"action": "Pay", "due_date": null, "is_important": "true",}',
+                             EmailAction)
+    assert action == EmailAction(action="Pay", is_important=True)
+
+    batch = repair_response('{"analyses": {"email_id": 0, "is_important": false, '
+                            '"is_transactional": false, "notify": false, '
+                            '"needs_analysis": false}}', HeaderAnalysisBatch)
+    assert [a.email_id for a in batch.analyses] == [0]
+
+    assert repair_response('{"is_important": "maybe"}', EmailAction) is None
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from conftest import get_test_cases, get_test_cases_for_analysis
+from conftest import get_test_cases, get_test_cases_for_analysis, llm_model
 import importlib
 import pytest
 
@@ -14,7 +14,7 @@ def test_mail_analyse(test_case):
     test_name, test_data = test_case
     email_data, expected_analysis, _ = test_data
 
-    m = mail_analyse.MailAnalyseHeaders(model="4o-mini")
+    m = mail_analyse.MailAnalyseHeaders(model=llm_model("4o-mini"))
     response = m.process(email_data)
     assert isinstance(response, HeaderAnalysis), test_name
     assert response.is_important == expected_analysis.is_important, test_name
@@ -28,7 +28,7 @@ def test_mail_analyse_analysis(test_case):
     email_data, _, expected_action = test_data
 
     m = mail_analyse.MailAnalyse(
-        model="mlx-community/Llama-3.2-3B-Instruct-4bit",
+        model=llm_model("mlx-community/Llama-3.2-3B-Instruct-4bit"),
         model_supports_schemas=False)
     m.add_sample(
         EmailData(
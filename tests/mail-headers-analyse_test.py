@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+from conftest import FakeModel, make_email
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import importlib
+import json
+from pathlib import Path
+import sys
+import threading
+import time
+
+import mail_analysis
+from metrics import MESSAGES
+from models import EmailData, HeaderAnalysis
+from preclassifier import PreClassifier, Rule
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "benchmarks"))
+from nats_stand_in import StandInNATS
+
+mail_headers_analyse = importlib.import_module("mail-headers-analyse")
+
+class FakeHeaderAnalyser:
+    """Header analyser that records the order in which emails are analysed"""
+
+    def __init__(self, delay: float = 0.05):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.order = []
+
+    def process(self, email: EmailData) -> HeaderAnalysis:
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+            self.order.append(email.subject)
+        return HeaderAnalysis(
+            clean_subject=email.subject,
+            is_important=False,
+            is_transactional=False,
+            notify=False,
+            needs_analysis=False,
+        )
+
+def run_batch(analyser, emails, workers, preclassifier=None):
+    async def run():
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            analyses = mail_headers_analyse.analyse_batch(
+                pool, analyser, emails, preclassifier)
+            return [(source, await analysis) for source, analysis in analyses]
+    return asyncio.run(run())
+
+def test_analyse_batch_runs_concurrently():
+    analyser = FakeHeaderAnalyser()
+    emails = [make_email(subject=f"Email {i}", message_id=f"msg{i}") for i in range(4)]
+
+    results = run_batch(analyser, emails, workers=4)
+
+    assert [r.clean_subject for _, r in results] == [e.subject for e in emails]
+    assert analyser.max_active > 1
+
+def test_analyse_batch_preserves_message_id_order():
+    analyser = FakeHeaderAnalyser()
+    emails = [
+        make_email(subject="First", message_id="msg1"),
+        make_email(subject="Second", message_id="msg1"),
+        make_email(subject="Third", message_id="msg1"),
+    ]
+
+    results = run_batch(analyser, emails, workers=3)
+
+    assert [r.clean_subject for _, r in results] == ["First", "Second", "Third"]
+    assert analyser.order == ["First", "Second", "Third"]
+    assert analyser.max_active == 1
+
+def test_analyse_batch_skips_preclassified():
+    preclassifier = PreClassifier([
+        Rule(name="newsletters", domains=["somewhere.com"],
+             analysis=HeaderAnalysis(
+                 is_important=False,
+                 is_transactional=False,
+                 notify=False,
+                 needs_analysis=False,
+             )),
+    ])
+    analyser = FakeHeaderAnalyser()
+    emails = [make_email(subject="Newsletter", message_id="msg1")]
+
+    results = run_batch(analyser, emails, workers=1, preclassifier=preclassifier)
+
+    assert [(source, r.clean_subject) for source, r in results] == [
+        ("rules", "Newsletter")]
+    assert analyser.order == []
+
+class FakeBatchAnalyser(FakeHeaderAnalyser):
+    """Batch header analyser that records the batches it is given"""
+
+    def __init__(self):
+        super().__init__(delay=0)
+        self.batches = []
+
+    def process_batch(self, emails: list[EmailData]) -> list[HeaderAnalysis]:
+        self.batches.append([email.subject for email in emails])
+        return [self.process(email) for email in emails]
+
+def test_analyse_batch_batches_prompts():
+    analyser = FakeHeaderAnalyser()
+    batch_analyser = FakeBatchAnalyser()
+    emails = [make_email(subject=f"Email {i}", message_id=f"msg{i}") for i in range(5)]
+
+    async def run():
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            analyses = mail_headers_analyse.analyse_batch(
+                pool, analyser, emails,
+                batch_analyser=batch_analyser, batch_size=2)
+            return [await analysis for _, analysis in analyses]
+    results = asyncio.run(run())
+
+    assert [r.clean_subject for r in results] == [e.subject for e in emails]
+    assert sorted(batch_analyser.batches) == [
+        ["Email 0", "Email 1"], ["Email 2", "Email 3"], ["Email 4"]]
+    assert analyser.order == []
+
+def run_stage(monkeypatch, messages: list[bytes], *argv, model=None):
+    """Run the stage on the messages in a stand-in stream until it is empty
+
+    Returns the number of failed and processed messages, and the consumer.
+    """
+    model = model or FakeModel([])
+    monkeypatch.setattr(mail_analysis, "get_models", lambda model_id: (model, None))
+    nc = StandInNATS({"emails": ["email.parsed"]})
+    monkeypatch.setattr(mail_headers_analyse.nats, "connect", nc.connect)
+    monkeypatch.setattr(sys, "argv", [
+        "mail-headers-analyse.py", "--model", "fake", "--fetch-batch", "3",
+        "--limit", "-1", "--no-preclassify", *argv])
+    failed = MESSAGES.labels("header-analysis", "error")
+    processed = MESSAGES.labels("header-analysis", "processed")
+    before = (failed.value, processed.value)
+
+    async def run():
+        for data in messages:
+            await nc.publish("email.parsed", data)
+        await mail_headers_analyse.main()
+
+    asyncio.run(run())
+    return (failed.value - before[0], processed.value - before[1],
+            nc.consumer("emails", "email-analyser"))
+
+def batch_response(*email_ids):
+    analysis = {"is_important": False, "is_transactional": False, "notify": False,
+                "needs_analysis": False}
+    return json.dumps({"analyses": [{"email_id": i, **analysis} for i in email_ids]})
+
+def test_wrong_email_id_is_acked(monkeypatch):
+    # The first batch of two is split after the wrong ID, and the second
+    # email gets the wrong ID again on its own, which fails the batch
+    model = FakeModel([batch_response(0, 5), batch_response(0), batch_response(3),
+                       batch_response(0)])
+    emails = [make_email(subject=f"Email {i}", message_id=f"msg{i}").model_dump_json().encode()
+              for i in range(3)]
+
+    failed, processed, consumer = run_stage(monkeypatch, emails, "--batch-size", "2",
+                                            model=model)
+    assert (failed, processed) == (2, 1)
+    # Every message is acked, so none is redelivered
+    assert consumer.pending == [] and consumer.delivered == {}
+    assert model.responses == []
+
+def test_invalid_email_is_acked(monkeypatch):
+    failed, processed, consumer = run_stage(monkeypatch, [b"not an email"])
+    assert (failed, processed) == (1, 0)
+    assert consumer.pending == [] and consumer.delivered == {}
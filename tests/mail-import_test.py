@@ -0,0 +1,84 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import importlib
+import json
+import mailbox
+from pathlib import Path
+
+from models import EmailData
+from wire import WireFormat
+
+mail_import = importlib.import_module("mail-import")
+
+MIME_DIR = Path(__file__).parent / "data" / "mime"
+EMAILS = ["plain.eml", "html.eml", "alternative.eml"]
+
+class FailingPool(ThreadPoolExecutor):
+    """Thread pool whose parsing fails for the emails containing `marker`"""
+
+    def __init__(self, marker: bytes):
+        super().__init__(max_workers=2)
+        self.marker = marker
+
+    def submit(self, fn, email, *args):
+        if self.marker in email:
+            raise ValueError("Unparseable email")
+        return super().submit(fn, email, *args)
+
+def fill(box: mailbox.Mailbox) -> mailbox.Mailbox:
+    for name in EMAILS:
+        box.add((MIME_DIR / name).read_bytes())
+    box.flush()
+    return box
+
+def test_open_mailbox(tmp_path):
+    fill(mailbox.mbox(tmp_path / "archive.mbox")).close()
+    fill(mailbox.Maildir(tmp_path / "Maildir")).close()
+
+    expected = sorted((MIME_DIR / name).read_bytes() for name in EMAILS)
+    for path in (tmp_path / "archive.mbox", tmp_path / "Maildir"):
+        box = mail_import.open_mailbox(path)
+        assert sorted(box.get_bytes(key) for key in box.iterkeys()) == expected
+        box.close()
+
+def run_import(box, pool, failing=()):
+    published = []
+
+    async def publish(subject, data, headers=None):
+        if subject in failing:
+            raise TimeoutError(f"No acknowledgement for {subject}")
+        published.append((subject, data))
+
+    async def run():
+        importer = mail_import.MailboxImport(pool, publish, WireFormat(), "fast",
+                                             "email.parsed", "email.error", "archive",
+                                             max_in_flight=2)
+        await importer.run(box)
+        return importer
+
+    return asyncio.run(run()), published
+
+def test_import_counts(tmp_path):
+    box = fill(mailbox.mbox(tmp_path / "archive.mbox"))
+    plain = (MIME_DIR / "plain.eml").read_bytes()
+    marker = plain.split(b"Message-ID: ")[1].split(b"\n")[0]
+
+    with FailingPool(marker) as pool:
+        importer, published = run_import(box, pool)
+    assert (importer.imported, importer.failed) == (2, 1)
+    subjects = [subject for subject, _ in published]
+    assert sorted(subjects) == ["email.error", "email.parsed", "email.parsed"]
+    error = json.loads(next(data for subject, data in published if subject == "email.error"))
+    assert error["sender"].startswith("archive:")
+    for subject, data in published:
+        if subject == "email.parsed":
+            EmailData.model_validate_json(data)
+
+def test_publish_errors_are_counted(tmp_path):
+    box = fill(mailbox.mbox(tmp_path / "archive.mbox"))
+
+    # A failed publish is counted instead of stopping the import
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        importer, published = run_import(box, pool, failing=["email.parsed"])
+    assert (importer.imported, importer.failed) == (0, len(EMAILS))
+    assert published == []
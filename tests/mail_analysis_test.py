@@ -0,0 +1,175 @@
+from conftest import FakeAsyncModel, FakeModel, make_email
+import asyncio
+import json
+import pydantic
+import pytest
+
+from mail_analysis import (MailAnalyse, MailAnalyseHeaders, MailAnalyseHeadersBatch,
+                           load_prompts, split_template)
+from models import EmailAction, EmailData, HeaderAnalysis
+
+def numbered_email(i: int) -> EmailData:
+    return make_email(subject=f"Email {i}", body="Body", message_id=f"msg{i}")
+
+def make_analysis(i: int) -> dict:
+    return {
+        "email_id": i,
+        "clean_subject": f"Email {i}",
+        "is_important": False,
+        "is_transactional": False,
+        "notify": False,
+        "needs_analysis": False,
+    }
+
+def batch_response(ids) -> str:
+    return json.dumps({"analyses": [make_analysis(i) for i in ids]})
+
+def test_batch_prompt():
+    analyser = MailAnalyseHeadersBatch(model="4o-mini")
+    prompt = analyser.get_prompt([numbered_email(0), numbered_email(1)])
+    data = json.loads(prompt.strip().splitlines()[-1])
+    assert [e["email_id"] for e in data] == [0, 1]
+    assert [e["subject"] for e in data] == ["Email 0", "Email 1"]
+    assert "body" not in data[0]
+
+def test_process_batch():
+    analyser = MailAnalyseHeadersBatch(model="4o-mini")
+    # Analyses returned out of order are matched up using the email_id
+    analyser.model = FakeModel([batch_response([2, 0, 1])])
+
+    analyses = analyser.process_batch([numbered_email(i) for i in range(3)])
+    assert [a.clean_subject for a in analyses] == ["Email 0", "Email 1", "Email 2"]
+    assert all(isinstance(a, HeaderAnalysis) for a in analyses)
+    assert len(analyser.model.prompts) == 1
+
+def test_process_batch_splits_on_failure():
+    analyser = MailAnalyseHeadersBatch(model="4o-mini", retry_invalid=False)
+    analyser.model = FakeModel([
+        batch_response([0, 1, 2]),      # Missing an analysis
+        batch_response([0, 1]),
+        "not json",                     # Invalid response
+        batch_response([0]),
+        batch_response([0]),
+    ])
+
+    analyses = analyser.process_batch([numbered_email(i) for i in range(4)])
+    assert [a.clean_subject for a in analyses] == ["Email 0", "Email 1", "Email 0", "Email 0"]
+    assert len(analyser.model.prompts) == 5
+
+def test_process_batch_single_failure():
+    analyser = MailAnalyseHeadersBatch(model="4o-mini", retry_invalid=False)
+    analyser.model = FakeModel(["not json"])
+
+    with pytest.raises(pydantic.ValidationError):
+        analyser.process_batch([numbered_email(0)])
+
+def test_split_template():
+    assert split_template("a {samples} b {prompt_data} c {{x}}") == (
+        "a {samples} b ", " c {{x}}")
+    assert split_template("{prompt_data}") == ("", "")
+
+@pytest.mark.parametrize("model_supports_schemas", [True, False])
+def test_get_prompt(model_supports_schemas):
+    analyser = MailAnalyse(model="4o-mini", model_supports_schemas=model_supports_schemas)
+    analyser.add_sample(numbered_email(0), EmailAction(action="Do something"))
+
+    email = numbered_email(1)
+    prompt_data = email.model_dump_json()
+    if not model_supports_schemas:
+        prompt_data = f"user: {prompt_data}"
+    samples = (f"user: {numbered_email(0).model_dump_json()}\n"
+               f"assistant: {EmailAction(action='Do something').model_dump_json()}\n")
+    expected = load_prompts()["email_full"].format(prompt_data=prompt_data, samples=samples)
+    if not model_supports_schemas:
+        expected = f"{expected}\n\n{load_prompts()['no_schema_instructions']}"
+
+    assert analyser.get_prompt(email) == expected
+
+def test_add_sample_updates_prompt():
+    analyser = MailAnalyse(model="4o-mini")
+    prefix, _ = analyser.prompt_parts()
+    assert analyser.get_prompt(numbered_email(1)).startswith(prefix)
+
+    analyser.add_sample(numbered_email(0), EmailAction(action="Do something"))
+    assert "Do something" in analyser.get_prompt(numbered_email(1))
+
+def test_load_prompts_independent_of_cwd(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    analyser = MailAnalyseHeaders(model="4o-mini")
+    assert analyser.prompt == load_prompts()["email_headers"]
+
+@pytest.mark.parametrize("reduce_body, expected", [
+    (True, "Please reply by Friday."),
+    (False, "Please reply by Friday.\n> Old message"),
+])
+def test_full_prompt_data_reduces_body(reduce_body, expected):
+    analyser = MailAnalyse(model="4o-mini", reduce_body=reduce_body)
+    email = numbered_email(0).model_copy(update={"body": "Please reply by Friday.\n> Old message"})
+    assert json.loads(analyser.prompt_data(email))["body"] == expected
+
+def header_response(i: int) -> str:
+    analysis = make_analysis(i)
+    del analysis["email_id"]
+    return json.dumps(analysis)
+
+def test_aprocess_async_model():
+    analyser = MailAnalyseHeaders(model="4o-mini")
+    analyser.async_model = FakeAsyncModel([header_response(0)])
+
+    analysis = asyncio.run(analyser.aprocess(numbered_email(0)))
+    assert analysis.clean_subject == "Email 0"
+    assert len(analyser.async_model.prompts) == 1
+
+def test_aprocess_executor_fallback():
+    analyser = MailAnalyseHeaders(model="4o-mini")
+    analyser.model = FakeModel([header_response(0)])
+    analyser.async_model = None
+
+    analysis = asyncio.run(analyser.aprocess(numbered_email(0)))
+    assert analysis.clean_subject == "Email 0"
+    assert len(analyser.model.prompts) == 1
+
+def test_aprocess_timeout():
+    analyser = MailAnalyseHeaders(model="4o-mini")
+    analyser.async_model = FakeAsyncModel([header_response(0)], delay=1)
+
+    with pytest.raises(TimeoutError):
+        asyncio.run(analyser.aprocess(numbered_email(0), timeout=0.01))
+
+def test_aprocess_many():
+    analyser = MailAnalyseHeaders(model="4o-mini", retry_invalid=False)
+    analyser.async_model = FakeAsyncModel(
+        [header_response(i) for i in range(3)] + ["not json"], delay=0.01)
+
+    results = asyncio.run(analyser.aprocess_many(
+        [numbered_email(i) for i in range(4)], concurrency=2, return_exceptions=True))
+    assert [r.clean_subject for r in results[:3]] == ["Email 0", "Email 1", "Email 2"]
+    assert isinstance(results[3], pydantic.ValidationError)
+
+def test_repaired_response():
+    analyser = MailAnalyseHeaders(model="4o-mini")
+    analyser.model = FakeModel([f"Here you go:\n```json\n{header_response(0)}\n```"])
+
+    assert analyser.process(numbered_email(0)).clean_subject == "Email 0"
+    assert analyser.repair_stats() == {"valid": 0, "repaired": 1, "retried": 0, "invalid": 0}
+
+def test_retry_invalid_response():
+    analyser = MailAnalyseHeaders(model="4o-mini")
+    analyser.model = FakeModel(['{"clean_subject": "Email 0"}', header_response(0)])
+
+    assert analyser.process(numbered_email(0)).clean_subject == "Email 0"
+    # The follow-up only has the invalid response, not the email
+    retry = analyser.model.prompts[1]
+    assert '{"clean_subject": "Email 0"}' in retry
+    assert "someone@somewhere.com" not in retry
+    assert "is_important" in retry
+    assert analyser.repair_stats() == {"valid": 1, "repaired": 0, "retried": 1, "invalid": 0}
+
+def test_aretry_invalid_response():
+    analyser = MailAnalyseHeaders(model="4o-mini")
+    analyser.async_model = FakeAsyncModel(["not json", "still not json"])
+
+    with pytest.raises(pydantic.ValidationError):
+        asyncio.run(analyser.aprocess(numbered_email(0)))
+    assert len(analyser.async_model.prompts) == 2
+    assert analyser.repair_stats() == {"valid": 0, "repaired": 0, "retried": 1, "invalid": 1}
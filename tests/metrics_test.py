@@ -0,0 +1,79 @@
+from conftest import FakeNATS
+import asyncio
+from datetime import datetime, timezone
+import json
+from types import SimpleNamespace
+import urllib.request
+
+from metrics import MODEL_TOKENS, MetricsExporter, Registry, queue_lag, record_tokens
+
+def make_registry():
+    registry = Registry()
+    steps = registry.histogram("steps_seconds", "Step time", ("stage", "step"),
+                               buckets=(0.1, 1))
+    messages = registry.counter("messages_total", "Messages", ("stage", "outcome"))
+    return registry, steps, messages
+
+def test_render():
+    registry, steps, messages = make_registry()
+    parse = steps.labels("archive", "parse")
+    assert steps.labels("archive", "parse") is parse
+    for value in (0.05, 0.5, 0.5, 5):
+        parse.observe(value)
+    messages.labels("archive", "processed").inc(3)
+
+    lines = registry.render().splitlines()
+    assert "# TYPE steps_seconds histogram" in lines
+    assert 'steps_seconds_bucket{stage="archive",step="parse",le="0.1"} 1' in lines
+    assert 'steps_seconds_bucket{stage="archive",step="parse",le="1"} 3' in lines
+    assert 'steps_seconds_bucket{stage="archive",step="parse",le="+Inf"} 4' in lines
+    assert 'steps_seconds_sum{stage="archive",step="parse"} 6.05' in lines
+    assert 'steps_seconds_count{stage="archive",step="parse"} 4' in lines
+    assert 'messages_total{stage="archive",outcome="processed"} 3' in lines
+
+def test_summary():
+    registry, steps, _ = make_registry()
+    with steps.labels("analysis", "model").time():
+        pass
+    [entry] = registry.summary()["steps_seconds"]
+    assert (entry["stage"], entry["count"], entry["p50"], entry["p99"]) == \
+        ("analysis", 1, 0.1, 0.1)
+    # Metrics without any values are left out
+    assert "messages_total" not in registry.summary()
+
+def test_queue_lag():
+    stored = datetime(2025, 2, 22, 9, 0, 0, tzinfo=timezone.utc)
+    msg = SimpleNamespace(metadata=SimpleNamespace(timestamp=stored))
+    assert queue_lag(msg, stored.timestamp() + 2.5) == 2.5
+    assert queue_lag(SimpleNamespace()) is None
+
+def test_record_tokens():
+    tokens = MODEL_TOKENS.labels("test-model", "input")
+    before = tokens.value
+    record_tokens("test-model", SimpleNamespace(input_tokens=120, output_tokens=None))
+    record_tokens("test-model", object())
+    assert tokens.value == before + 120
+
+def test_exporter():
+    registry, _, messages = make_registry()
+    messages.labels("reminders", "duplicate").inc()
+    nc = FakeNATS()
+
+    async def run():
+        exporter = MetricsExporter(registry, nc=nc, subject="metrics", interval=0.01,
+                                   port=0, source="test")
+        exporter.start()
+        url = f"http://127.0.0.1:{exporter.port}/metrics"
+        body = await asyncio.to_thread(lambda: urllib.request.urlopen(url).read().decode())
+        await asyncio.sleep(0.05)
+        await exporter.close()
+        return body
+
+    body = asyncio.run(run())
+    assert 'messages_total{stage="reminders",outcome="duplicate"} 1' in body
+    assert len(nc.published) >= 2
+    subject, data, _ = nc.published[-1]
+    summary = json.loads(data)
+    assert (subject, summary["source"]) == ("metrics", "test")
+    assert summary["metrics"]["messages_total"] == [
+        {"stage": "reminders", "outcome": "duplicate", "value": 1}]
@@ -0,0 +1,68 @@
+import asyncio
+import pytest
+
+from conftest import get_test_cases
+from mail_analysis import MailAnalyseHeaders
+from model_server import (ModelServer, ModelServerError, ServedModel, StandInModel,
+                          schema_instance)
+from models import EmailAction, HeaderAnalysis, HeaderAnalysisBatch
+
+@pytest.mark.parametrize("schema", [HeaderAnalysis, EmailAction, HeaderAnalysisBatch])
+def test_schema_instance(schema):
+    schema.model_validate(schema_instance(schema.model_json_schema()))
+
+class CountingModel(StandInModel):
+    def __init__(self):
+        self.batches = []
+
+    def prompt_batch(self, prompts, schema=None):
+        self.batches.append(len(prompts))
+        return super().prompt_batch(prompts, schema)
+
+def serve(tmp_path, models, client, **kwargs):
+    """Run the client against a model server on a Unix socket"""
+    path = tmp_path / "model.sock"
+
+    async def run():
+        server = ModelServer(models, **kwargs)
+        server.start()
+        unix_server = await asyncio.start_unix_server(server.handle_client, path=path)
+        try:
+            return await client(path)
+        finally:
+            unix_server.close()
+            await server.stop()
+
+    return asyncio.run(run())
+
+def test_batches_across_clients(tmp_path):
+    model = CountingModel()
+
+    async def client(path):
+        served = ServedModel("local", path)
+        return await asyncio.gather(*(asyncio.to_thread(served.prompt, f"prompt {i}")
+                                      for i in range(6)))
+
+    responses = serve(tmp_path, {"local": model}, client, max_batch=4, max_delay=0.2)
+    assert sorted(r.text() for r in responses) == [f"prompt {i}" for i in range(6)]
+    assert sum(model.batches) == 6
+    assert len(model.batches) < 6
+
+def test_unknown_model(tmp_path):
+    async def client(path):
+        with pytest.raises(ModelServerError, match="Unknown model"):
+            await asyncio.to_thread(ServedModel("missing", path).prompt, "prompt")
+
+    serve(tmp_path, {"local": StandInModel()}, client)
+
+def test_analyser_with_served_model(tmp_path, monkeypatch):
+    monkeypatch.setenv("MODEL_SERVER_SOCKET", str(tmp_path / "model.sock"))
+    email, _, _ = next(iter(get_test_cases().values()))
+
+    async def client(path):
+        analyser = MailAnalyseHeaders(model="server:local")
+        return (await analyser.aprocess(email),
+                await asyncio.to_thread(analyser.process, email))
+
+    results = serve(tmp_path, {"local": StandInModel()}, client)
+    assert all(isinstance(result, HeaderAnalysis) for result in results)
@@ -0,0 +1,89 @@
+from conftest import FakeModel, make_email
+import datetime
+
+from mail_analysis import MailAnalyse, MailAnalyseHeaders
+from models import EmailAction, HeaderAnalysis
+from near_duplicates import (SimilarityIndex, adapt_response, find_dates, fingerprint,
+                             substitutions)
+
+SHIPPED = ("Your order {} has shipped and should arrive by {}. You can track "
+           "your parcel using the link below. Thanks for shopping with us.")
+SHOP = "Shop <orders@shop.example>"
+STATEMENT = ("Your monthly statement is now available. Log in to online banking "
+             "to view it, and contact us if anything looks wrong.")
+
+def test_fingerprint():
+    a = fingerprint(SHIPPED.format("A-1234", "2025-03-03"))
+    assert a == fingerprint(SHIPPED.format("B-98", "2025-04-12"))
+    assert (fingerprint(SHIPPED.format("A-1", "3 March 2025")) ==
+            fingerprint(SHIPPED.format("B-98", "12 April 2025")))
+    assert (a ^ fingerprint(STATEMENT)).bit_count() > 3
+
+def test_find_dates():
+    assert find_dates("By 2025-03-05, 5th March 2025 or Mar 6, 2025, not 2025-02-30") == [
+        datetime.date(2025, 3, 5), datetime.date(2025, 3, 5), datetime.date(2025, 3, 6)]
+
+def test_adapt_response():
+    old = SHIPPED.format("A-1234", "2025-03-03")
+    new = SHIPPED.format("B-98", "2025-04-12")
+    assert substitutions(old, new) == {"A-1234": "B-98", "2025-03-03": "2025-04-12"}
+
+    action = EmailAction(action="Collect order A-1234", due_date="2025-03-03")
+    assert adapt_response(action, old, new) == EmailAction(
+        action="Collect order B-98", due_date="2025-04-12")
+
+    # The due date can't be re-extracted
+    assert adapt_response(action, old, STATEMENT) is None
+
+def test_index_lookup_and_eviction(tmp_path):
+    index = SimilarityIndex(tmp_path / "similar.db", max_entries=2)
+    email = make_email(SHOP)
+    index.add("email_full", email, SHIPPED.format("A-1", "today"), "shipped")
+    index.add("email_full", email, STATEMENT, "statement")
+
+    assert index.lookup("email_full", email, SHIPPED.format("B-2", "today"))[1] == "shipped"
+    assert index.lookup("email_headers", email, STATEMENT) is None
+    assert index.lookup("email_full", make_email("other@shop.example"), STATEMENT) is None
+
+    # The statement is now the least recently used, so it is evicted first
+    index.add("email_full", email, "Your password was changed on your account.", "password")
+    assert index.lookup("email_full", email, STATEMENT) is None
+    assert index.stats()["entries"] == 2
+    index.close()
+
+    # Entries are reloaded from the database
+    index = SimilarityIndex(tmp_path / "similar.db", max_entries=2)
+    assert index.lookup("email_full", email, SHIPPED.format("C-3", "today"))[1] == "shipped"
+
+def test_analyser_reuses_similar():
+    analyser = MailAnalyse(model="4o-mini", similar=SimilarityIndex())
+    analyser.model = FakeModel([
+        EmailAction(action="Collect order A-1234", due_date="2025-03-03").model_dump_json()])
+
+    analyser.process(make_email(SHOP, body=SHIPPED.format("A-1234", "2025-03-03")))
+    action = analyser.process(make_email(SHOP, body=SHIPPED.format("B-98", "2025-04-12")))
+    assert action == EmailAction(action="Collect order B-98", due_date="2025-04-12")
+    assert len(analyser.model.prompts) == 1
+
+def test_header_analyser_needs_same_words():
+    # Even an index lenient enough to match these subjects must not reuse them
+    analyser = MailAnalyseHeaders(model="4o-mini", similar=SimilarityIndex(max_distance=15))
+    shipped = HeaderAnalysis(is_important=False, is_transactional=True, notify=False,
+                             needs_analysis=False)
+    cancelled = shipped.model_copy(update={"is_important": True, "notify": True})
+    analyser.model = FakeModel([shipped.model_dump_json(), cancelled.model_dump_json(),
+                                cancelled.model_dump_json()])
+
+    def email(subject):
+        return make_email(SHOP, subject, headers={"List-Id": "<orders.shop.example>"})
+
+    analyser.process(email("Your order A-1234 from Shop Example has shipped"))
+    assert analyser.process(email("Your order B-98 from Shop Example has shipped")) == shipped
+    assert len(analyser.model.prompts) == 1
+
+    # A single word that changes the analysis is not a near-duplicate
+    assert analyser.process(email("Your order B-98 from Shop Example was cancelled")) == \
+        cancelled
+    assert analyser.process(email("Reminder: your order B-98 from Shop Example has shipped")) \
+        == cancelled
+    assert len(analyser.model.prompts) == 3
@@ -0,0 +1,153 @@
+from conftest import FakeNATS, make_email
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import threading
+import time
+import zlib
+
+from analysis_cache import SQLiteCache
+from archiver import archive, parse_email_deferred
+from dedupe import email_key
+from ocr import AttachmentOCR, AttachmentStore, pdf_pages
+
+MIME_DIR = Path(__file__).parent / "data" / "mime"
+
+class FakeExtractor:
+    """Stand-in for the OCR, returning the content as the text"""
+
+    def __init__(self, delay=0, error=None):
+        self.delay = delay
+        self.error = error
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, data, content_type, filename):
+        with self.lock:
+            self.calls.append(filename)
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return f"text of {data.decode()}"
+
+def scanned_invoice(store, *attachments):
+    """Return an email with the attachments added to the store"""
+    return make_email("scanner@office.example.com", "Scanned invoice",
+                      "Please find the invoice attached.",
+                      attachments=[store.put(name, content_type, data)
+                                   for name, content_type, data in attachments])
+
+def test_attachment_store(tmp_path):
+    store = AttachmentStore(tmp_path)
+    a = store.put("a.png", "image/png", b"logo")
+    b = store.put("b.png", "image/png", b"logo")
+    assert a.sha256 == b.sha256
+    assert a.size == 4
+    assert store.get(b) == b"logo"
+    assert len(list(tmp_path.rglob("*"))) == 2
+
+def test_parse_email_deferred(tmp_path):
+    store = AttachmentStore(tmp_path)
+    data = parse_email_deferred((MIME_DIR / "image.eml").read_bytes(), store)
+    assert data.body == "Please find the scanned invoice attached."
+    [attachment] = data.attachments
+    assert (attachment.filename, attachment.content_type) == ("invoice.png", "image/png")
+    assert store.get(attachment).startswith(b"\x89PNG")
+
+def test_archive_publishes_attachments(tmp_path):
+    async def run(name):
+        nc = FakeNATS()
+        await archive(nc, (MIME_DIR / name).read_bytes(), "sender", "email.parsed",
+                      "email.error", attachments=AttachmentStore(tmp_path),
+                      attachment_subject="email.attachments")
+        return [subject for _, subject in nc.events]
+
+    # Emails with attachments are held back until their text is extracted
+    assert asyncio.run(run("image.eml")) == ["email.attachments"]
+    assert asyncio.run(run("related.eml")) == ["email.parsed"]
+    assert asyncio.run(run("plain.eml")) == ["email.parsed"]
+
+def test_enrich(tmp_path):
+    store = AttachmentStore(tmp_path)
+    email = scanned_invoice(store, ("invoice.png", "image/png", b"invoice"),
+                            ("", "image/gif", b"logo"))
+    extract = FakeExtractor()
+    ocr = AttachmentOCR(store, extract=extract)
+    enriched = asyncio.run(ocr.enrich(email))
+    assert enriched.body == ("Please find the invoice attached.\n\n"
+                             "[Attachment: invoice.png]\ntext of invoice\n\n"
+                             "[Attachment: image/gif]\ntext of logo")
+    assert [a.status for a in enriched.attachments] == ["extracted", "extracted"]
+    # The enriched email is the only one in the pipeline, under the same key
+    assert email_key(enriched) == email_key(email) == "msg"
+
+def test_same_attachment_extracted_once(tmp_path):
+    store = AttachmentStore(tmp_path)
+    emails = [scanned_invoice(store, ("logo.png", "image/png", b"logo"),
+                              (f"scan{i}.png", "image/png", f"scan {i}".encode()))
+              for i in range(3)]
+    cache = SQLiteCache(tmp_path / "cache.db")
+    extract = FakeExtractor(delay=0.05)
+
+    async def run():
+        ocr = AttachmentOCR(store, cache=cache, extract=extract)
+        await asyncio.gather(*(ocr.enrich(email) for email in emails))
+        return ocr.stats()
+
+    stats = asyncio.run(run())
+    assert sorted(extract.calls) == ["logo.png", "scan0.png", "scan1.png", "scan2.png"]
+    assert (stats["extracted"], stats["cached"]) == (4, 2)
+
+    # Later runs use the cache
+    stats = asyncio.run(run())
+    assert len(extract.calls) == 4
+    assert stats["cached"] == 6
+
+def test_limits(tmp_path):
+    store = AttachmentStore(tmp_path)
+    pdf = b"%PDF-1.4 " + b"<< /Type /Pages >> " + b"<< /Type /Page >> " * 3
+    assert pdf_pages(pdf) == 3
+    email = scanned_invoice(store, ("big.png", "image/png", b"x" * 100),
+                            ("long.pdf", "application/pdf", pdf),
+                            ("ok.png", "image/png", b"ok"))
+    extract = FakeExtractor()
+    ocr = AttachmentOCR(store, max_bytes=len(pdf), max_pages=2, extract=extract)
+    enriched = asyncio.run(ocr.enrich(email))
+    assert [a.status for a in enriched.attachments] == ["too large", "too many pages",
+                                                        "extracted"]
+    assert extract.calls == ["ok.png"]
+    assert ocr.stats()["skipped"] == 2
+
+def test_failures(tmp_path):
+    store = AttachmentStore(tmp_path)
+    email = scanned_invoice(store, ("bad.png", "image/png", b"bad"))
+
+    ocr = AttachmentOCR(store, extract=FakeExtractor(error=ValueError("bad image")))
+    enriched = asyncio.run(ocr.enrich(email))
+    assert enriched.attachments[0].status == "failed"
+    assert enriched.body == email.body
+
+    ocr = AttachmentOCR(store, timeout=0.01, extract=FakeExtractor(delay=0.2))
+    enriched = asyncio.run(ocr.enrich(email))
+    assert enriched.attachments[0].status == "timeout"
+    assert ocr.stats()["failed"] == 1
+
+def test_timeout_starts_with_extraction(tmp_path):
+    store = AttachmentStore(tmp_path)
+    email = scanned_invoice(store, *((f"scan{i}.png", "image/png", f"scan {i}".encode())
+                                     for i in range(3)))
+    # Each attachment fits in the timeout, but not waiting behind the others
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        ocr = AttachmentOCR(store, executor=pool, timeout=0.15, workers=1,
+                            extract=FakeExtractor(delay=0.1))
+        enriched = asyncio.run(ocr.enrich(email))
+    assert [a.status for a in enriched.attachments] == ["extracted"] * 3
+
+def test_pdf_pages_in_object_streams():
+    objects = b"3 0 4 40 <</Type/Page/Parent 2 0 R>> <</Type /Page /Parent 2 0 R>>"
+    compressed = zlib.compress(objects)
+    pdf = (b"%PDF-1.5\n1 0 obj\n<</Type/Catalog/Pages 2 0 R>>\nendobj\n"
+           b"5 0 obj\n<</Type/ObjStm/N 2/First 8/Filter/FlateDecode/Length "
+           + str(len(compressed)).encode() + b">>\nstream\n" + compressed
+           + b"\nendstream\nendobj\n6 0 obj\n<</Type/Page>>\nendobj\n%%EOF")
+    assert pdf_pages(pdf) == 3
@@ -0,0 +1,49 @@
+import argparse
+import asyncio
+import importlib.util
+from pathlib import Path
+import sys
+
+BENCHMARKS_DIR = Path(__file__).resolve().parents[1] / "benchmarks"
+
+def load_benchmark():
+    sys.path.append(str(BENCHMARKS_DIR))
+    spec = importlib.util.spec_from_file_location("pipeline_bench",
+                                                  BENCHMARKS_DIR / "pipeline_bench.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+pipeline_bench = load_benchmark()
+
+def bench_args(**kwargs) -> argparse.Namespace:
+    defaults = dict(count=20, body_words=100, body_sigma=1.0, max_body_words=2000, seed=0,
+                    parser="fast", archive_workers=2, workers=2, fetch_batch=10,
+                    preclassify=False, latency=0, jitter=0, escalate=0.5, tasks=0.5)
+    return argparse.Namespace(**{**defaults, **kwargs})
+
+def test_fake_model_is_deterministic():
+    behaviour = pipeline_bench.FakeBehaviour(latency=0.1, jitter=0.5)
+    assert behaviour.respond("prompt", None) == behaviour.respond("prompt", None)
+    assert 0.05 <= behaviour.delay("prompt") <= 0.15
+
+def test_corpus():
+    args = bench_args(count=10)
+    corpus = pipeline_bench.make_corpus(args)
+    assert len(corpus) == 10
+    assert corpus == pipeline_bench.make_corpus(args)
+    assert len({email.split(b"Message-ID: ")[1].split(b"\n")[0] for email in corpus}) == 10
+
+def test_pipeline():
+    results = asyncio.run(pipeline_bench.run_pipeline(bench_args()))
+    stages = results["stages"]
+    assert list(stages) == ["archive", "header-analysis", "analysis", "reminders"]
+    assert stages["archive"]["messages"] == stages["header-analysis"]["messages"] == 20
+    assert 0 < stages["analysis"]["messages"] < 20
+    assert stages["reminders"]["messages"] > 0
+    assert all(stage["p99"] >= stage["p50"] for stage in stages.values())
+
+    assert pipeline_bench.regressions(results, results, 0.25) == []
+    slower = {"stages": {"archive": {**stages["archive"],
+                                     "throughput": stages["archive"]["throughput"] * 2}}}
+    assert len(pipeline_bench.regressions(results, slower, 0.25)) == 1
@@ -0,0 +1,61 @@
+from conftest import get_test_cases, make_email
+import pytest
+
+from models import HeaderAnalysis
+from preclassifier import PreClassifier, Rule, load_rules, normalise_address, sender_domains
+
+ANALYSIS = HeaderAnalysis(
+    is_important=False,
+    is_transactional=False,
+    notify=False,
+    needs_analysis=False,
+)
+
+@pytest.mark.parametrize("address, expected", [
+    ("someone@somewhere.com", "someone@somewhere.com"),
+    ("Some One <Someone@Somewhere.COM>", "someone@somewhere.com"),
+])
+def test_normalise_address(address, expected):
+    assert normalise_address(address) == expected
+
+def test_sender_domains():
+    assert sender_domains("news@mail.example.co.uk") == [
+        "mail.example.co.uk", "example.co.uk", "co.uk"]
+
+def test_rules():
+    classifier = PreClassifier([
+        Rule(name="bank", senders=["Bank <alerts@bank.com>"],
+             analysis=ANALYSIS.model_copy(update={"is_important": True})),
+        Rule(name="newsletters", domains=["substack.com"], analysis=ANALYSIS),
+        Rule(name="marketing", subjects=[r"\d+% off", r"\bsale\b"],
+             headers=["List-Unsubscribe"], min_matches=2, analysis=ANALYSIS),
+    ])
+
+    assert classifier.matching_rule(make_email("alerts@bank.com")).name == "bank"
+    assert classifier.matching_rule(make_email("x@news.substack.com")).name == "newsletters"
+    assert classifier.matching_rule(make_email(subject="50% OFF today")) is None
+    assert classifier.matching_rule(make_email(
+        subject="50% OFF today",
+        headers={"list-unsubscribe": "<mailto:u@shop.com>"})).name == "marketing"
+    assert classifier.matching_rule(make_email(
+        headers={"List-Unsubscribe": "<mailto:u@shop.com>"})) is None
+
+def test_classify():
+    classifier = PreClassifier([
+        Rule(name="newsletters", domains=["substack.com"], analysis=ANALYSIS),
+    ])
+
+    analysis = classifier.classify(make_email("x@substack.com", "Weekly issue"))
+    assert analysis == ANALYSIS.model_copy(update={"clean_subject": "Weekly issue"})
+    assert classifier.classify(make_email()) is None
+    assert classifier.stats() == {"matched": 1, "fallthrough": 1}
+
+@pytest.mark.parametrize("test_case", get_test_cases().items())
+def test_default_rules(test_case):
+    # Any email classified by the default rules must agree with the
+    # expected analysis
+    test_name, (email, expected_analysis, _) = test_case
+    analysis = PreClassifier(load_rules()).classify(email)
+    if analysis is not None:
+        assert analysis.is_important == expected_analysis.is_important, test_name
+        assert analysis.needs_analysis == expected_analysis.needs_analysis, test_name
@@ -0,0 +1,83 @@
+from conftest import FakeMsg, FakeNATS
+import asyncio
+
+from publisher import BatchPublisher
+
+def test_ack_after_outputs():
+    nc = FakeNATS()
+
+    async def run():
+        publisher = BatchPublisher(nc, max_batch=100, max_delay=10)
+        outputs = [
+            await publisher.publish("tasks", b"1"),
+            await publisher.publish("header", b"2", durable=False),
+        ]
+        await publisher.ack(FakeMsg(nc=nc, name="msg1"), outputs)
+        # Nothing is sent until the batch is flushed
+        assert nc.events == []
+        await publisher.close()
+        assert all(output.done() for output in outputs)
+        return publisher.stats()
+
+    assert asyncio.run(run()) == {"published": 2, "acked": 1, "nakd": 0, "terminated": 0}
+    assert nc.events == [("js", "tasks"), ("core", "header"), ("ack", "msg1")]
+
+def test_nak_on_failed_output():
+    nc = FakeNATS(failing=["missing"])
+
+    async def run():
+        publisher = BatchPublisher(nc, max_batch=100, max_delay=10, nak_delay=15,
+                                   max_deliveries=3)
+        await publisher.ack(FakeMsg(nc=nc, name="msg1"), [await publisher.publish("tasks", b"1")])
+        await publisher.ack(FakeMsg(nc=nc, name="msg2"),
+                            [await publisher.publish("missing", b"2")])
+        # Messages whose outputs keep failing are not redelivered forever
+        await publisher.ack(FakeMsg(nc=nc, name="msg3", delivered=3),
+                            [await publisher.publish("missing", b"3")])
+        await publisher.close()
+        return publisher.stats()
+
+    assert asyncio.run(run()) == {"published": 1, "acked": 1, "nakd": 1, "terminated": 1}
+    assert ("ack", "msg1") in nc.events
+    assert ("nak", "msg2", 15) in nc.events
+    assert ("term", "msg3") in nc.events
+
+def test_flush_on_size():
+    nc = FakeNATS()
+
+    async def run():
+        publisher = BatchPublisher(nc, max_batch=2, max_delay=10)
+        await publisher.ack(FakeMsg(nc=nc, name="msg1"))
+        assert nc.events == []
+        await publisher.ack(FakeMsg(nc=nc, name="msg2"))
+        assert nc.events == [("ack", "msg1"), ("ack", "msg2")]
+        await publisher.close()
+
+    asyncio.run(run())
+
+def test_flush_on_delay():
+    nc = FakeNATS()
+
+    async def run():
+        publisher = BatchPublisher(nc, max_batch=100, max_delay=0.01)
+        await publisher.ack(FakeMsg(nc=nc, name="msg1"))
+        await asyncio.sleep(0.05)
+        assert nc.events == [("ack", "msg1")]
+        await publisher.close()
+
+    asyncio.run(run())
+
+def test_stage_metrics():
+    nc = FakeNATS(failing=["missing"])
+
+    async def run():
+        publisher = BatchPublisher(nc, max_batch=100, max_delay=10, stage="test-publisher")
+        await publisher.ack(FakeMsg(nc=nc, name="msg1"),
+                            [await publisher.publish("missing", b"1")])
+        await publisher.close()
+        return publisher
+
+    publisher = asyncio.run(run())
+    assert publisher.publish_seconds.count == 1
+    assert publisher.ack_seconds.count == 1
+    assert publisher.publish_errors.value == 1
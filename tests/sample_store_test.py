@@ -0,0 +1,67 @@
+from conftest import DATA_DIR, get_test_cases_for_analysis, make_email
+
+from mail_analysis import MailAnalyse
+from models import EmailAction, HeaderAnalysis
+from sample_store import SampleStore
+
+SAMPLES = [
+    (make_email("no_reply@apple.com", "Your invoice from Apple",
+                "Invoice for your iCloud storage plan", message_id="a"),
+     EmailAction(action="File the invoice")),
+    (make_email("tickets@trains.example", "Your train booking",
+                "Booking confirmation for your trip to London", message_id="b"),
+     EmailAction(action="Add the trip")),
+    (make_email("friend@mail.example", "Team lunch", "Lunch on Friday?", message_id="c"),
+     EmailAction(action="Reply")),
+    (make_email("no_reply@apple.com", "Your receipt", "Receipt for your App Store purchase",
+                message_id="d"), EmailAction(action="Check the purchase")),
+]
+
+def test_select_most_relevant_last():
+    store = SampleStore(SAMPLES, k=2)
+    email = make_email("no_reply@apple.com", "Your invoice from Apple",
+                       "Invoice for your Apple Music subscription", message_id="new")
+    assert store.select(email) == [SAMPLES[3], SAMPLES[0]]
+
+def test_select_only_related():
+    store = SampleStore(SAMPLES, k=3)
+    email = make_email("other@elsewhere.example", "Booking confirmation",
+                       "London trip booked", message_id="new")
+    assert store.select(email) == [SAMPLES[1]]
+    assert store.select(make_email("x@y.example", "Hello", "Nothing in common")) == []
+
+def test_select_excludes_same_email():
+    store = SampleStore(SAMPLES)
+    assert SAMPLES[2] not in store.select(SAMPLES[2][0])
+
+def test_select_token_budget():
+    store = SampleStore(SAMPLES, k=3, token_budget=10)
+    email = make_email("no_reply@apple.com", "Your invoice from Apple", "Invoice",
+                       message_id="new")
+    cost = {"a": 8, "d": 5}
+    selected = store.select(email, cost=lambda sample: cost.get(sample[0].message_id, 100))
+    assert selected == [SAMPLES[0]]
+
+def test_from_yaml():
+    store = SampleStore.from_yaml([DATA_DIR], "action", EmailAction)
+    assert len(store) == len(get_test_cases_for_analysis())
+    store = SampleStore.from_yaml([DATA_DIR / "email1.yaml"], "header_analysis", HeaderAnalysis)
+    assert len(store) == 1
+
+def test_prompt_includes_selected_samples():
+    analyser = MailAnalyse(model="4o-mini", sample_store=SampleStore(SAMPLES, k=1))
+    analyser.add_sample(make_email(subject="Static", body="Static sample"),
+                        EmailAction(action="Static"))
+    email = make_email("tickets@trains.example", "Your train booking",
+                       "Booking for your trip to Leeds", message_id="new")
+    prompt = analyser.get_prompt(email)
+    assert "Static" in prompt
+    assert "Add the trip" in prompt
+    assert "File the invoice" not in prompt
+    assert prompt.index("Static") < prompt.index("Add the trip")
+
+def test_samples_without_schema_support():
+    analyser = MailAnalyse(model="4o-mini", model_supports_schemas=False,
+                           sample_store=SampleStore(SAMPLES))
+    email = make_email("no_reply@apple.com", "Your receipt", "Receipt for your purchase")
+    assert "Check the purchase" in analyser.get_prompt(email)
@@ -0,0 +1,95 @@
+from conftest import make_email
+from models import HeaderAnalysis
+from sender_reputation import SenderReputation
+
+DAY = 24 * 3600
+
+def make_analysis(is_important=True, needs_analysis=False, due_date=None):
+    return HeaderAnalysis(
+        is_important=is_important,
+        is_transactional=True,
+        notify=False,
+        needs_analysis=needs_analysis,
+        due_date=due_date,
+    )
+
+def test_sender_keys():
+    assert SenderReputation.sender_keys("Bank <Alerts@Bank.com>") == [
+        "alerts@bank.com", "@bank.com"]
+    # Unrelated senders share freemail domains
+    assert SenderReputation.sender_keys("someone@gmail.com") == ["someone@gmail.com"]
+
+def test_stable_sender_is_trusted(tmp_path):
+    reputation = SenderReputation(tmp_path / "senders.db", min_weight=2.5)
+    for _ in range(2):
+        reputation.update("alerts@bank.com", make_analysis())
+    assert reputation.classify(make_email("alerts@bank.com")) is None
+
+    reputation.update("alerts@bank.com", make_analysis())
+    analysis = reputation.classify(make_email("Bank <alerts@bank.com>", "Your statement is ready"))
+    assert analysis == HeaderAnalysis(
+        clean_subject="Your statement is ready",
+        is_important=True,
+        is_transactional=True,
+        notify=False,
+        needs_analysis=False,
+    )
+
+    # Other senders from the same domain need some history of their own,
+    # which agrees with the domain's
+    assert reputation.classify(make_email("statements@bank.com")) is None
+    reputation.update("statements@bank.com", make_analysis())
+    assert reputation.classify(make_email("statements@bank.com")) is not None
+    reputation = SenderReputation(tmp_path / "senders.db", min_weight=2.5, agreement=0.75)
+    reputation.update("offers@bank.com", make_analysis(is_important=False))
+    assert reputation.classify(make_email("offers@bank.com")) is None
+    assert reputation.stats() == {"trusted": 0, "untrusted": 1}
+
+def test_freemail_domain_not_shared(tmp_path):
+    reputation = SenderReputation(tmp_path / "senders.db", min_weight=2.5)
+    for _ in range(3):
+        reputation.update("friend@gmail.com", make_analysis())
+    reputation.update("stranger@gmail.com", make_analysis())
+    assert reputation.lookup("friend@gmail.com") is not None
+    assert reputation.lookup("stranger@gmail.com") is None
+
+def test_senders_with_due_dates_go_to_the_model(tmp_path):
+    reputation = SenderReputation(tmp_path / "senders.db", min_weight=2.5)
+    for _ in range(3):
+        reputation.update("billing@utility.com", make_analysis(due_date="2025-03-10"))
+    assert reputation.lookup("billing@utility.com")["has_due_date"] is True
+    assert reputation.classify(make_email("billing@utility.com")) is None
+
+def test_reputation_persists(tmp_path):
+    reputation = SenderReputation(tmp_path / "senders.db", half_life=DAY, min_weight=0.5)
+    reputation.update("alerts@bank.com", make_analysis())
+    reputation.close()
+
+    # The half-life the history was built with is used to look it up
+    reputation = SenderReputation(tmp_path / "senders.db", min_weight=0.5)
+    assert reputation.half_life == DAY
+    assert reputation.lookup("alerts@bank.com") is not None
+
+def test_inconsistent_sender_is_not_trusted(tmp_path):
+    reputation = SenderReputation(tmp_path / "senders.db", min_weight=2.5)
+    for i in range(10):
+        reputation.update("someone@example.com", make_analysis(is_important=i % 2 == 0))
+    assert reputation.lookup("someone@example.com") is None
+
+def test_needs_analysis_is_not_trusted(tmp_path):
+    reputation = SenderReputation(tmp_path / "senders.db", min_weight=0.5)
+    reputation.update("someone@example.com", make_analysis(needs_analysis=True))
+    assert reputation.lookup("someone@example.com")["needs_analysis"] is True
+    assert reputation.classify(make_email("someone@example.com")) is None
+
+def test_decay(tmp_path):
+    reputation = SenderReputation(tmp_path / "senders.db", half_life=DAY, min_weight=2.5)
+    for _ in range(4):
+        reputation.update("alerts@bank.com", make_analysis(), now=0)
+    assert reputation.lookup("alerts@bank.com", now=0) is not None
+    assert reputation.lookup("alerts@bank.com", now=DAY) is None
+
+    # Recent verdicts outweigh old ones
+    for _ in range(4):
+        reputation.update("alerts@bank.com", make_analysis(is_important=False), now=30 * DAY)
+    assert reputation.lookup("alerts@bank.com", now=30 * DAY)["is_important"] is False
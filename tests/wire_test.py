@@ -0,0 +1,139 @@
+from conftest import FakeJetStream, FakeNATS, make_email
+import asyncio
+import importlib.util
+from pathlib import Path
+import pytest
+
+from archiver import archive
+from models import EmailData, EmailHeaders
+from wire import (BODY_REF_HEADER, EMAIL_SEQ_HEADER, ENCODING_HEADER, ENCODINGS,
+                  BodyUnavailableError, WireFormat, WireFormatError, decode_payload,
+                  encode_payload, fetch_email, header_email, header_record, is_header_record,
+                  wire_headers)
+
+MIME_DIR = Path(__file__).parent / "data" / "mime"
+
+def available(encoding):
+    modules = {"msgpack": "msgpack", "zstd": "zstandard"}
+    return all(importlib.util.find_spec(modules[part]) is not None
+               for part in encoding.split("+") if part in modules)
+
+EMAIL = make_email(body="<p>Hello</p>" * 100, headers={"List-Id": "list"})
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_round_trip(encoding):
+    if not available(encoding):
+        pytest.skip(f"{encoding} is not available")
+
+    async def run():
+        wire = WireFormat(encoding=encoding)
+        payload, headers = await wire.encode(EMAIL)
+        assert len(payload) <= len(EMAIL.model_dump_json())
+        return await WireFormat().decode(payload, headers)
+
+    assert asyncio.run(run()) == EMAIL
+
+def test_plain_json_unchanged():
+    async def run():
+        payload, headers = await WireFormat().encode(EMAIL)
+        assert headers is None
+        assert EmailData.model_validate_json(payload) == EMAIL
+        # Emails published before the wire format are decoded too
+        return await WireFormat().decode(EMAIL.model_dump_json().encode())
+
+    assert asyncio.run(run()) == EMAIL
+
+def test_encoding_errors():
+    with pytest.raises(WireFormatError):
+        encode_payload({}, "xml")
+    with pytest.raises(WireFormatError):
+        decode_payload(b"not compressed", "json+zlib")
+    if not available("msgpack"):
+        with pytest.raises(WireFormatError, match="msgpack package"):
+            encode_payload({}, "msgpack")
+
+def test_claim_check():
+    js = FakeJetStream()
+
+    async def run():
+        wire = WireFormat(js, encoding="json+zlib", claim_check_bytes=100)
+        short = EMAIL.model_copy(update={"body": "short"})
+        small, small_headers = await wire.encode(short)
+        large, large_headers = await wire.encode(EMAIL)
+        assert BODY_REF_HEADER not in small_headers
+        assert large_headers[BODY_REF_HEADER].startswith("email-bodies/")
+        assert large_headers[ENCODING_HEADER] == "json+zlib"
+        assert len(large) < len(small) + 50
+
+        reader = WireFormat(js)
+        assert await reader.decode(small, small_headers) == short
+        assert await reader.decode(large, large_headers) == EMAIL
+        assert (wire.stats()["stored"], reader.stats()["fetched"]) == (1, 1)
+
+        with pytest.raises(WireFormatError):
+            await WireFormat().decode(large, large_headers)
+
+    asyncio.run(run())
+
+def test_claim_check_unavailable():
+    js = FakeJetStream()
+
+    async def run():
+        wire = WireFormat(js, claim_check_bytes=100, body_ttl=3600, body_max_bytes=5000)
+        payload, headers = await wire.encode(EMAIL)
+        assert js.stores["email-bodies"].config.ttl == 3600
+
+        # Bodies that don't fit in the bucket are sent inline
+        big = EMAIL.model_copy(update={"body": "<p>Hello</p>" * 1000})
+        big_payload, big_headers = await wire.encode(big)
+        assert BODY_REF_HEADER not in (big_headers or {})
+        assert await WireFormat(js).decode(big_payload, big_headers) == big
+
+        # Missing objects and buckets are errors of the message, not crashes
+        js.stores["email-bodies"].objects.clear()
+        with pytest.raises(BodyUnavailableError, match="email-bodies/"):
+            await WireFormat(js).decode(payload, headers)
+        missing = {**headers, BODY_REF_HEADER: "other-bucket/x"}
+        with pytest.raises(BodyUnavailableError):
+            await WireFormat(js).decode(payload, missing)
+
+    asyncio.run(run())
+
+def test_wire_headers():
+    headers = {ENCODING_HEADER: "json+zlib", BODY_REF_HEADER: "b/x", "Nats-Msg-Id": "id"}
+    assert wire_headers(headers) == {ENCODING_HEADER: "json+zlib", BODY_REF_HEADER: "b/x"}
+    assert wire_headers(None) == {}
+
+def test_header_record():
+    record = header_record(EMAIL)
+    assert record.body_size == len(EMAIL.body)
+    assert "body" not in record.model_dump()
+    assert header_email(record) == EMAIL.model_copy(update={"body": ""})
+
+def test_archive_publishes_header_records():
+    nc = FakeNATS()
+
+    async def run():
+        await archive(nc, (MIME_DIR / "plain.eml").read_bytes(), "sender", "email.parsed",
+                      "email.error", parser="fast", wire=WireFormat(encoding="json+zlib"),
+                      header_subject="email.headers")
+        # Both are published through JetStream, so the record isn't lost
+        assert nc.published == []
+        _, record_msg = nc.js.messages
+        subject, data, headers = record_msg.subject, record_msg.data, record_msg.headers
+        assert subject == "email.headers"
+        assert is_header_record(headers) and headers[EMAIL_SEQ_HEADER] == "1"
+        record = EmailHeaders.model_validate_json(data)
+
+        # The full email is fetched as published, in its encoding
+        payload, email_headers = await fetch_email(nc.js, headers)
+        assert email_headers == {ENCODING_HEADER: "json+zlib"}
+        email = await WireFormat().decode(payload, email_headers)
+        assert header_email(record) == email.model_copy(update={"body": ""})
+        assert record.body_size == len(email.body.encode()) > 0
+
+        # Emails removed from the stream can't be fetched
+        with pytest.raises(BodyUnavailableError, match="emails/99"):
+            await fetch_email(nc.js, {**headers, EMAIL_SEQ_HEADER: "99"})
+
+    asyncio.run(run())
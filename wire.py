@@ -0,0 +1,244 @@
+# Encoding of emails published on NATS. Emails are plain JSON by default, and
+# can be published in a compact binary envelope, with the encoding named in a
+# header so that consumers decode any message transparently. Large bodies
+# can be stored in a JetStream Object Store bucket, with only a reference to
+# them in the message (a claim check). Header records of emails refer to the
+# full email by its position in the stream, so that it is only fetched when
+# needed.
+
+import hashlib
+import json
+import logging
+from typing import Any, Optional
+import zlib
+
+from nats.js.api import ObjectStoreConfig
+
+from models import EmailData, EmailHeaders
+
+logger = logging.getLogger(__name__)
+
+ENCODING_HEADER = "Payload-Encoding"
+BODY_REF_HEADER = "Body-Ref"
+
+# Headers describing the payload, which are forwarded along with it
+WIRE_HEADERS = (ENCODING_HEADER, BODY_REF_HEADER)
+
+DEFAULT_BODY_BUCKET = "email-bodies"
+
+# Stored bodies expire after this many seconds, as nothing deletes them
+DEFAULT_BODY_TTL = 14 * 24 * 3600
+
+# Stream and sequence number of the full email, on its header record
+EMAIL_STREAM_HEADER = "Email-Stream"
+EMAIL_SEQ_HEADER = "Email-Seq"
+
+# Serialisation and compression of the envelope. msgpack and zstd need the
+# msgpack and zstandard packages.
+FORMATS = ("json", "msgpack")
+COMPRESSIONS = ("zlib", "zstd")
+ENCODINGS = ("json", "json+zlib", "json+zstd", "msgpack", "msgpack+zlib", "msgpack+zstd")
+
+class WireFormatError(ValueError):
+    pass
+
+class BodyUnavailableError(WireFormatError):
+    """The body of an email could not be fetched
+
+    Either from the Object Store, or from the stream a header record refers to.
+    """
+
+def import_codec(name: str):
+    """Import an optional codec library"""
+    module = {"msgpack": "msgpack", "zstd": "zstandard"}[name]
+    try:
+        return __import__(module)
+    except ImportError:
+        raise WireFormatError(f"The {name} encoding needs the {module} package") from None
+
+def split_encoding(encoding: str) -> tuple[str, Optional[str]]:
+    format, _, compression = encoding.partition("+")
+    if format not in FORMATS or (compression and compression not in COMPRESSIONS):
+        raise WireFormatError(f"Unknown payload encoding {encoding}")
+    return format, compression or None
+
+def encode_payload(data: dict[str, Any], encoding: str = "json") -> bytes:
+    """Serialise and compress a payload"""
+    format, compression = split_encoding(encoding)
+    if format == "msgpack":
+        payload = import_codec("msgpack").packb(data)
+    else:
+        payload = json.dumps(data, separators=(",", ":")).encode()
+    if compression == "zlib":
+        payload = zlib.compress(payload)
+    elif compression == "zstd":
+        payload = import_codec("zstd").ZstdCompressor().compress(payload)
+    return payload
+
+def decode_payload(payload: bytes, encoding: str = "json") -> dict[str, Any]:
+    """Decompress and deserialise a payload"""
+    format, compression = split_encoding(encoding)
+    try:
+        if compression == "zlib":
+            payload = zlib.decompress(payload)
+        elif compression == "zstd":
+            payload = import_codec("zstd").ZstdDecompressor().decompress(payload)
+        if format == "msgpack":
+            return import_codec("msgpack").unpackb(payload)
+        return json.loads(payload)
+    except WireFormatError:
+        raise
+    except Exception as e:
+        raise WireFormatError(f"Invalid {encoding} payload: {e}") from e
+
+def wire_headers(headers: Optional[dict]) -> dict[str, str]:
+    """Return the headers describing a payload, to forward along with it"""
+    return {name: value for name, value in (headers or {}).items() if name in WIRE_HEADERS}
+
+def header_record(email: EmailData) -> EmailHeaders:
+    """Return the header record of an email, with the size of its body"""
+    return EmailHeaders(
+        from_=email.from_,
+        to=email.to,
+        subject=email.subject,
+        date=email.date,
+        message_id=email.message_id,
+        headers=email.headers,
+        attachments=email.attachments,
+        body_size=len(email.body.encode()),
+    )
+
+def is_header_record(headers: Optional[dict]) -> bool:
+    return EMAIL_SEQ_HEADER in (headers or {})
+
+def header_email(record: EmailHeaders) -> EmailData:
+    """Return the email data of a header record, without a body"""
+    return EmailData(**record.model_dump(exclude={"body_size"}), body="")
+
+async def fetch_email(js, headers: dict) -> tuple[bytes, dict[str, str]]:
+    """Fetch the full email a header record refers to
+
+    Returns the payload of the email as published, along with the headers
+    describing it. Raises BodyUnavailableError if the email can't be fetched,
+    such as when it has been removed by the retention limits of its stream.
+    """
+    stream, seq = headers.get(EMAIL_STREAM_HEADER), headers[EMAIL_SEQ_HEADER]
+    try:
+        msg = await js.get_msg(stream, int(seq))
+    except Exception as e:
+        raise BodyUnavailableError(f"Error fetching email {stream}/{seq}: {e!r}") from e
+    return msg.data, wire_headers(msg.headers)
+
+class WireFormat:
+    """Encode emails for publishing, and decode emails in any encoding
+
+    Emails are published in `encoding`, with the encoding in the
+    Payload-Encoding header unless it is plain JSON. With a claim check
+    threshold, bodies larger than `claim_check_bytes` are stored in the
+    `bucket` Object Store under their content hash, and the Body-Ref header
+    refers to them. The bucket is created with a TTL of `body_ttl` seconds
+    and a limit of `body_max_bytes`; bodies that don't fit in it are sent
+    in the message instead. Decoding needs the JetStream context `js` for emails whose body
+    is in the Object Store, and raises BodyUnavailableError if the body
+    can't be fetched.
+    """
+
+    def __init__(self, js=None, encoding: str = "json", claim_check_bytes: int = 0,
+                 bucket: str = DEFAULT_BODY_BUCKET, body_ttl: Optional[float] = DEFAULT_BODY_TTL,
+                 body_max_bytes: Optional[int] = None):
+        split_encoding(encoding)
+        if claim_check_bytes and js is None:
+            raise ValueError("Storing bodies in the Object Store needs JetStream")
+        self.js = js
+        self.encoding = encoding
+        self.claim_check_bytes = claim_check_bytes
+        self.bucket = bucket
+        self.body_ttl = body_ttl
+        self.body_max_bytes = body_max_bytes
+        self.stores: dict[str, Any] = {}
+
+        self.bodies_stored = 0
+        self.bodies_fetched = 0
+
+    async def object_store(self, bucket: str, create: bool = False):
+        store = self.stores.get(bucket)
+        if store is None:
+            if create:
+                config = ObjectStoreConfig(bucket=bucket, ttl=self.body_ttl or None,
+                                           max_bytes=self.body_max_bytes or None)
+                store = await self.js.create_object_store(bucket, config=config)
+            else:
+                store = await self.js.object_store(bucket)
+            self.stores[bucket] = store
+        return store
+
+    async def encode(self, email: EmailData,
+                     headers: Optional[dict] = None) -> tuple[bytes, Optional[dict]]:
+        """Encode an email, returning the payload and the headers to publish it with"""
+        data = email.model_dump(mode="json")
+        headers = dict(headers or {})
+
+        body = email.body.encode()
+        if self.claim_check_bytes and len(body) > self.claim_check_bytes:
+            name = hashlib.sha256(body).hexdigest()
+            store = await self.object_store(self.bucket, create=True)
+            try:
+                await store.put(name, body)
+            except Exception as e:
+                logger.warning("Error storing body of %s, sending it inline: %s",
+                               email.message_id, e)
+            else:
+                self.bodies_stored += 1
+                data["body"] = ""
+                headers[BODY_REF_HEADER] = f"{self.bucket}/{name}"
+
+        if self.encoding != "json":
+            headers[ENCODING_HEADER] = self.encoding
+        return encode_payload(data, self.encoding), headers or None
+
+    async def decode(self, payload: bytes, headers: Optional[dict] = None) -> EmailData:
+        """Decode an email published in any encoding"""
+        headers = headers or {}
+        data = decode_payload(payload, headers.get(ENCODING_HEADER, "json"))
+
+        ref = headers.get(BODY_REF_HEADER)
+        if ref:
+            if self.js is None:
+                raise WireFormatError(f"Body {ref} is in the Object Store, which needs JetStream")
+            bucket, _, name = ref.partition("/")
+            try:
+                store = await self.object_store(bucket)
+                body = (await store.get(name)).data
+            except Exception as e:
+                # Missing buckets and objects, including expired ones, and
+                # failed requests
+                raise BodyUnavailableError(f"Error fetching body {ref}: {e!r}") from e
+            data["body"] = body.decode()
+            self.bodies_fetched += 1
+        return EmailData.model_validate(data)
+
+    def stats(self) -> dict[str, int]:
+        return {"stored": self.bodies_stored, "fetched": self.bodies_fetched}
+
+def add_wire_arguments(parser):
+    """Add the options for the encoding of published emails"""
+    parser.add_argument("--wire-encoding", choices=ENCODINGS, default="json",
+                        help="Encoding of published emails (msgpack and zstd need "
+                             "the msgpack and zstandard packages)")
+    parser.add_argument("--claim-check-bytes", type=int, default=0,
+                        help="Store email bodies larger than this in the JetStream Object "
+                             "Store, and publish a reference to them (0 to disable)")
+    parser.add_argument("--body-bucket", default=DEFAULT_BODY_BUCKET,
+                        help="JetStream Object Store bucket to store email bodies in")
+    parser.add_argument("--body-ttl", type=float, default=DEFAULT_BODY_TTL,
+                        help="Seconds to keep email bodies in the Object Store bucket "
+                             "when creating it (0 to keep them)")
+    parser.add_argument("--body-max-bytes", type=int, default=0,
+                        help="Maximum size of the Object Store bucket when creating it; "
+                             "larger bodies are sent inline once it is full (0 for no limit)")
+
+def wire_format(args, js) -> WireFormat:
+    """Create the wire format from the options"""
+    return WireFormat(js, encoding=args.wire_encoding,
+                      claim_check_bytes=args.claim_check_bytes, bucket=args.body_bucket,
+                      body_ttl=args.body_ttl, body_max_bytes=args.body_max_bytes)